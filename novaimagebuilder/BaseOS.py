@@ -31,6 +31,9 @@ class BaseOS(object):
     @param install_script:
     """
 
+    # Seconds after which objects retrieved from install trees are revalidated, or None for never
+    URL_CONTENT_TTL = None
+
     def __init__(self, osinfo_dict, install_type, install_media_location, install_config, install_script = None):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.env = StackEnvironment()
@@ -61,6 +64,29 @@ class BaseOS(object):
         """
         raise NotImplementedError("Function (%s) not implemented" % (inspect.stack()[0][3]))
 
+    def cache_install_media(self):
+        """
+        Fill the cache with the install media prepare_install_instance() retrieves, without
+        preparing an install, so that later builds find it there.  Kernel and ramdisk are
+        kept locally as well, as syslinux installs need them.
+
+        @return: dict mapping each object type to its cached locations
+        """
+        results = { }
+        if self.install_type == "iso":
+            if self.wants_iso_content():
+                for object_type in self.iso_content_dict().keys():
+                    results[object_type] = self.cache.retrieve_and_cache_object_async(
+                            object_type, self, self.install_media_location, True)
+            results["install-iso"] = self.cache.retrieve_and_cache_object_async(
+                    "install-iso", self, self.install_media_location, False)
+        else:
+            for (object_type, path) in self.url_content_dict().items():
+                results[object_type] = self.cache.retrieve_and_cache_object_async(
+                        object_type, self, "%s%s" % (self.install_media_location, path), True,
+                        ttl=self.URL_CONTENT_TTL)
+        return dict([ (object_type, result.get()) for (object_type, result) in results.items() ])
+
     def start_install_instance(self):
         """
 
@@ -0,0 +1,139 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import errno
+import os
+import os.path
+
+
+class BlobStore(object):
+    """
+    Storage of the content cached by CacheManager, keyed by SHA-256.  This class keeps it
+    in a local directory, and is the interface of the other stores:
+
+    SharedBlobStore keeps it on a filesystem shared by several builder hosts.
+    ObjectBlobStore keeps a local copy and shares the content through an object store.
+
+    Stores that are shared with other hosts also record which content each source URL was
+    found to hold, so that a host can take content another host has already fetched instead
+    of going back to the source.
+
+    @param root: Directory the content is kept in
+    """
+
+    # bool indicating whether other hosts see the content stored here
+    shared = False
+
+    def __init__(self, root):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        if not root.endswith('/'):
+            root += '/'
+        self.root = root
+        if not os.path.exists(self.root):
+            os.makedirs(self.root, mode=0755)
+
+    def path(self, sha256):
+        """
+        @return: Local path the content with SHA-256 sha256 is or would be stored under
+        """
+        return "%ssha256/%s/%s" % (self.root, sha256[:2], sha256)
+
+    def store(self, filename, sha256, size):
+        """
+        Move a completed local file into the store.  If identical content is already stored,
+        the new copy is discarded.
+
+        @return: Local path of the stored content
+        """
+        blob_filename = self.path(sha256)
+        if os.path.isfile(blob_filename) and os.path.getsize(blob_filename) == size:
+            self.log.debug("Content of (%s) is already stored as (%s) - discarding the copy" %
+                           (filename, blob_filename))
+            os.remove(filename)
+            os.utime(blob_filename, None)
+            return blob_filename
+        self._make_dirs(blob_filename)
+        os.rename(filename, blob_filename)
+        return blob_filename
+
+    def fetch(self, sha256, size=None):
+        """
+        Make stored content available locally.
+
+        @return: Local path of the content, or None if it is not stored
+        """
+        blob_filename = self.path(sha256)
+        if os.path.isfile(blob_filename) and (size is None or os.path.getsize(blob_filename) == size):
+            return blob_filename
+        return None
+
+    def remove(self, sha256):
+        """
+        Drop the local copy of some content, if there is one.
+        """
+        try:
+            os.remove(self.path(sha256))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def blobs(self):
+        """
+        @return: list with a tuple of modification time, size and SHA-256 of each local copy
+        """
+        blobs = [ ]
+        blob_root = self.root + "sha256/"
+        if os.path.isdir(blob_root):
+            for prefix in os.listdir(blob_root):
+                for sha256 in os.listdir(blob_root + prefix):
+                    if '.' in sha256:
+                        # Copy still being made
+                        continue
+                    try:
+                        stat = os.stat(self.path(sha256))
+                    except OSError:
+                        # Removed by someone else meanwhile
+                        continue
+                    blobs.append((stat.st_mtime, stat.st_size, sha256))
+        return blobs
+
+    def pin_filename(self, sha256):
+        """
+        @return: Path of the file whose flock() pins the content, or None to let the cache
+        keep pins in its own lock directory
+        """
+        return None
+
+    def record_source(self, url, sha256, size, validators):
+        """
+        Remember that url held the content with SHA-256 sha256, served with validators - a
+        dict of its ETag and Last-Modified date.
+        """
+        pass
+
+    def lookup_source(self, url):
+        """
+        @return: dict of the sha256, size, etag and last_modified recorded for url, or None
+        """
+        return None
+
+    def _make_dirs(self, filename):
+        try:
+            os.makedirs(os.path.dirname(filename), 0755)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
@@ -17,6 +17,7 @@
 import logging
 from OSInfo import OSInfo
 from StackEnvironment import StackEnvironment
+from CacheManager import CacheManager
 from time import sleep
 
 
@@ -93,6 +94,8 @@ class Builder(object):
             if self.os_delegate.iso_volume_delete:
                 self.env.cinder.volumes.get(self.os_delegate.iso_volume).delete()
                 self.log.debug("Deleted install ISO volume from cinder: %s" % self.os_delegate.iso_volume)
+            # The install media is no longer in use and may be evicted from the cache
+            CacheManager().release_objects()
             return finished_image_id
         # Leave instance running if install did not finish. Exit with code 1.
         else:
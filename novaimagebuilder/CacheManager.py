@@ -15,16 +15,28 @@
 #   limitations under the License.
 
 import logging
+import hashlib
 import json
+import errno
 import os
 import os.path
-import pycurl
 import guestfs
 import fcntl
+import socket
 import threading
 import time
+from multiprocessing.pool import ThreadPool
 import StackEnvironment
 from Singleton import Singleton
+from Downloader import Downloader
+from SQLiteIndex import SQLiteIndex
+from StreamingDownload import StreamingDownload
+from ISOReader import ISOReader
+from HTTPRangeReader import HTTPRangeReader
+from FileCopier import FileCopier
+from TransferScheduler import TransferScheduler
+from CacheStats import CacheStats
+from BlobStore import BlobStore
 
 
 class CacheManager(Singleton):
@@ -38,14 +50,74 @@ class CacheManager(Singleton):
     names.  The name install_iso is special.  OS plugins are allowed to
     access a local copy before it is sent to glance, even if that local copy
     will eventually be deleted.
+
+    Local copies are stored by SHA-256, so identical content cached under
+    several keys is kept - and uploaded to glance and cinder - only once.
+
+    Local copies are evicted, least recently used first, when the cache grows
+    beyond MAX_SIZE or the filesystem holding it has less than MIN_FREE_SPACE
+    free.  Objects handed out by retrieve_and_cache_object() are pinned until
+    release_objects() is called or the process exits, and are never evicted
+    while pinned - by this or any other process.
+
+    Objects fetched from a URL keep the ETag and Last-Modified date they were
+    served with.  Once an object is older than the TTL it is requested with,
+    it is revalidated with a conditional GET and only fetched and uploaded
+    again if it has changed.
+
+    Local copies are kept in a BlobStore.  With a store shared by several
+    builder hosts, content one host has fetched is taken from the store by
+    the others instead of from its source.
     """
 
     # TODO: Currently assumes the target environment is static - allow this to change
-    # TODO: Sane handling of a pending cache item
     # TODO: Configurable
     CACHE_ROOT = "/var/lib/novaimagebuilder/"
-    INDEX_THREAD_LOCK = threading.Lock()
     INDEX_FILE = "_cache_index"
+    # "sqlite" keeps the index in INDEX_DATABASE, "json" in the single JSON document INDEX_FILE
+    INDEX_BACKEND = "sqlite"
+    INDEX_DATABASE = "_cache_index.sqlite"
+    # Seconds to wait for the cache index lock before giving up
+    INDEX_LOCK_TIMEOUT = 60
+    LOCK_DIR = "_locks/"
+    # Local content is stored once per SHA-256 under BLOB_DIR.  The index keeps the remote copies
+    # made of each blob under the pseudo os_ver_arch BLOB_INDEX so that they are uploaded only once
+    BLOB_DIR = "_blobs/"
+    # BlobStore to keep content in instead of BLOB_DIR, such as a SharedBlobStore or an
+    # ObjectBlobStore shared by several builder hosts
+    BLOB_STORE = None
+    BLOB_INDEX = "_blobs"
+    # Blank root disk templates uploaded to glance are kept under the pseudo os_ver_arch BLANK_DISK_INDEX
+    BLANK_DISK_INDEX = "_blank_disks"
+    # Longest time we are willing to wait on another thread or process filling an object
+    PENDING_TIMEOUT = 3600
+    # A pending fill whose owner has not renewed its lease for this many seconds is taken over
+    PENDING_LEASE = 60
+    # Largest total size in bytes of locally cached content, or None for no limit
+    MAX_SIZE = None
+    # Bytes to leave free on the filesystem holding CACHE_ROOT
+    MIN_FREE_SPACE = 0
+    # Also delete the glance images and cinder volumes made from evicted content
+    EVICT_REMOTE = False
+    # Upload objects that are not kept locally while they download instead of staging them on disk
+    STREAM_UPLOADS = True
+    # Read files from inside install ISOs in place, using byte ranges, rather than downloading the ISO
+    REMOTE_ISO_CONTENT = True
+    # Seconds between checks, on cache hits of an install ISO, that the files taken from it are
+    # still cached and still have their glance images - see _repair_iso_content()
+    ISO_CONTENT_CHECK_INTERVAL = 3600
+    # Most uploads to glance and cinder run at once while filling a single object
+    UPLOAD_WORKERS = 4
+    # Most objects retrieved at once for retrieve_and_cache_object_async()
+    ASYNC_WORKERS = 4
+    # Let local sources on the filesystem holding CACHE_ROOT be cached as hard links to the source
+    # rather than copies.  Only safe when sources are never modified in place.
+    LINK_LOCAL_SOURCES = False
+    # Seconds after which a cached object is revalidated against its source, or None for never.
+    # Used when retrieve_and_cache_object() is not given a ttl.
+    DEFAULT_TTL = None
+    # Totals of the cache stats of every process - see stats()
+    STATS_FILE = "_cache_stats.json"
 
     def _singleton_init(self):
         self.env = StackEnvironment.StackEnvironment()
@@ -53,77 +125,358 @@ class CacheManager(Singleton):
         self.index_filename = self.CACHE_ROOT + self.INDEX_FILE
         if not os.path.exists(self.CACHE_ROOT):
             os.makedirs(self.CACHE_ROOT, mode=0755)
-        if not os.path.isfile(self.index_filename):
+        if not os.path.exists(self.CACHE_ROOT + self.LOCK_DIR):
+            os.makedirs(self.CACHE_ROOT + self.LOCK_DIR, mode=0755)
+        if self.INDEX_BACKEND == "sqlite":
+            self.index_database = self.CACHE_ROOT + self.INDEX_DATABASE
+            # sqlite connections may only be used by the thread that opened them
+            self.index_connections = threading.local()
+            if os.path.isfile(self.index_filename):
+                self._migrate_json_index(self.index_filename)
+        elif not os.path.isfile(self.index_filename):
             self.log.debug("Creating cache index file (%s)" % self.index_filename)
             # TODO: somehow prevent a race here
             index_file = open(self.index_filename, 'w')
             json.dump({}, index_file)
             index_file.close()
         # This should be None except when we are actively working on it and hold a lock
+        self.index_state = threading.local()
         self.index = None
-        self.index_file = None
-        self.locked = False
+        # Shared locks on pin files of the blobs this process is using, keyed by SHA-256
+        self.pins = {}
+        self.pins_lock = threading.Lock()
+        # Started by the first call to retrieve_and_cache_object_async()
+        self.async_pool = None
+        self.async_pool_lock = threading.Lock()
+        # Number of retrieve_and_cache_object_async() calls submitted and not yet finished for
+        # each (os_ver_arch, object_type)
+        self.async_fetches = {}
+        self.cache_stats = CacheStats(self.CACHE_ROOT + self.STATS_FILE)
+        self.blob_store = self.BLOB_STORE or BlobStore(self.CACHE_ROOT + self.BLOB_DIR)
+
+    def _get_index(self):
+        return getattr(self.index_state, "index", None)
 
-    def lock_and_get_index(self):
+    def _set_index(self, index):
+        self.index_state.index = index
+
+    # The index and the file it was read from belong to the thread holding the index lock
+    index = property(_get_index, _set_index)
+
+    def lock_and_get_index(self, shared=False, timeout=None):
         """
-        Obtain an exclusive lock on the cache index and then load it into the
+        Obtain a lock on the cache index and then load it into the
         "index" instance variable.  Tasks done while holding this lock should be
         very brief and non-blocking.  Calls to this should be followed by either
         write_index_and_unlock() or unlock_index() depending upon whether or not the
-        index has been modified.
-        """
-        # We acquire a thread lock under all circumstances
-        # This is the safest approach and should be relatively harmless if we are used
-        # as a module in a non-threaded Python program
-        if self.INDEX_THREAD_LOCK.acquire(False):
-            # atomic create if not present
-            fd = os.open(self.index_filename, os.O_RDWR | os.O_CREAT)
-            # blocking
-            fcntl.flock(fd, fcntl.LOCK_EX)
-            self.index_file = os.fdopen(fd, "r+")
-            index = self.index_file.read()
-            if len(index) == 0:
-                # Empty - possibly because we created it earlier - create empty dict
-                self.index = {}
-            else:
-                self.index = json.loads(index)
+        index has been modified.  With the sqlite backend the entries of an os_ver_arch are
+        read when first accessed and only modified entries are written back.
+
+        The lock and the loaded index belong to the calling thread, so any number of threads
+        may use the index concurrently, each waiting its turn for the lock.
+
+        @param shared: bool indicating a read only lookup.  Shared locks are held alongside
+        each other and only wait for a writer.  The index must then be released with
+        unlock_index().
+        @param timeout: Seconds to wait for the lock (default: INDEX_LOCK_TIMEOUT)
+        """
+        if self.index is not None:
+            raise Exception("Cache index is already locked by this thread")
+        if timeout is None:
+            timeout = self.INDEX_LOCK_TIMEOUT
+        self.index_state.shared = shared
+        if self.INDEX_BACKEND == "sqlite":
+            self.index = SQLiteIndex(self._index_connection(), write=not shared, timeout=timeout)
+            return
+        # atomic create if not present
+        fd = os.open(self.index_filename, os.O_RDWR | os.O_CREAT)
+        if shared:
+            operation = fcntl.LOCK_SH
+        else:
+            operation = fcntl.LOCK_EX
+        if not self._flock_with_timeout(fd, operation, timeout):
+            raise Exception("Timed out after %d seconds waiting for the cache index lock" % timeout)
+        self.index_state.index_file = os.fdopen(fd, "r+")
+        index = self.index_state.index_file.read()
+        if len(index) == 0:
+            # Empty - possibly because we created it earlier - create empty dict
+            self.index = {}
         else:
-            raise Exception("Failed to acquire threading lock...")
+            self.index = json.loads(index)
 
     def write_index_and_unlock(self):
         """
         Write contents of self.index back to the persistent file and then unlock it
         """
-        self.index_file.seek(0)
-        self.index_file.truncate()
-        json.dump(self.index , self.index_file)
+        if self.index_state.shared:
+            self.unlock_index()
+            raise Exception("Attempt made to write the cache index while holding a shared lock")
+        if self.INDEX_BACKEND == "sqlite":
+            try:
+                self.index.commit()
+            finally:
+                self.index = None
+            return
+        index_file = self.index_state.index_file
+        index_file.seek(0)
+        index_file.truncate()
+        json.dump(self.index , index_file)
         # TODO: Double-check that this is safe
-        self.index_file.flush()
-        fcntl.flock(self.index_file, fcntl.LOCK_UN)
-        self.index_file.close()
+        index_file.flush()
+        fcntl.flock(index_file, fcntl.LOCK_UN)
+        index_file.close()
         self.index = None
-        self.INDEX_THREAD_LOCK.release()
+        self.index_state.index_file = None
 
     def unlock_index(self):
         """
         Release the cache index lock without updating the persistent file
         """
+        if self.INDEX_BACKEND == "sqlite":
+            try:
+                self.index.rollback()
+            finally:
+                self.index = None
+            return
         self.index = None
-        fcntl.flock(self.index_file, fcntl.LOCK_UN)
-        self.index_file.close()
-        self.index_file = None
-        self.INDEX_THREAD_LOCK.release()
+        fcntl.flock(self.index_state.index_file, fcntl.LOCK_UN)
+        self.index_state.index_file.close()
+        self.index_state.index_file = None
+
+    def _index_connection(self):
+        connection = getattr(self.index_connections, "connection", None)
+        if connection is None:
+            connection = SQLiteIndex.connect(self.index_database)
+            self.index_connections.connection = connection
+        return connection
+
+    def _migrate_json_index(self, json_filename):
+        """
+        Copy the entries of a JSON index into the index database, then move the JSON file
+        out of the way.  Entries already in the database are kept.
+        """
+        try:
+            fd = os.open(json_filename, os.O_RDWR)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # Another process got here first
+                return
+            raise
+        index_file = os.fdopen(fd, "r+")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if not os.path.isfile(json_filename):
+                return
+            contents = index_file.read()
+            self.log.info("Migrating cache index (%s) to (%s)" % (json_filename, self.index_database))
+            connection = self._index_connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if len(contents) > 0:
+                    for (os_ver_arch, objects) in json.loads(contents).items():
+                        for (name, value) in objects.items():
+                            connection.execute("INSERT OR IGNORE INTO cache_index (os_ver_arch, name, value) "
+                                               "VALUES (?, ?, ?)", (os_ver_arch, name, json.dumps(value, sort_keys=True)))
+                connection.execute("COMMIT")
+            except:
+                connection.execute("ROLLBACK")
+                raise
+            os.rename(json_filename, json_filename + ".migrated")
+        finally:
+            index_file.close()
+
+    def _lock_object(self, os_ver_arch, object_type, timeout=None, shared=False):
+        """
+        Obtain an exclusive lock on the lock file belonging to a single cached object.
+        Whoever fills an object holds this lock for the entire fill, so anyone else asking
+        for the same object blocks here and is woken by the kernel as soon as the filler
+        releases the lock - or exits.  Every call opens its own file description, which
+        makes the lock effective between threads of one process as well as between processes.
+
+        @param os_ver_arch: OS version and architecture string the object belongs to
+        @param object_type: Name of the object
+        @param timeout: Seconds to wait for the lock, 0 to not wait at all, or None to wait forever
+        @param shared: bool requesting a shared lock, which is only held up by a filler.  Used
+        to look objects up without queueing behind other lookups.
+        @return: file descriptor holding the lock, or None if the timeout expired
+        """
+        if shared:
+            operation = fcntl.LOCK_SH
+        else:
+            operation = fcntl.LOCK_EX
+        fd = os.open(self._lock_filename(os_ver_arch, object_type), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return fd
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                os.close(fd)
+                raise
+        if timeout == 0:
+            os.close(fd)
+            return None
+        self.log.debug("Object is being retrieved in another thread or process - Waiting")
+        if self._flock_with_timeout(fd, operation, timeout):
+            return fd
+        return None
+
+    def _lock_filename(self, os_ver_arch, object_type):
+        return self.CACHE_ROOT + self.LOCK_DIR + os_ver_arch + "-" + object_type + ".lock"
+
+    def _unlock_object(self, fd):
+        """
+        Release a lock obtained with _lock_object(), waking up the next waiter
+        """
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _flock_with_timeout(self, fd, operation, timeout):
+        """
+        Blocking flock() that gives up after timeout seconds.  flock() itself cannot time out,
+        so the blocking call is made from a helper thread.  If we give up first, the helper
+        closes the descriptor (dropping the lock) as soon as it is finally granted.
+
+        @return: True if the lock is now held on fd, False if we gave up and fd is no longer ours
+        """
+        if timeout is None:
+            fcntl.flock(fd, operation)
+            return True
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return True
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+
+        acquired = threading.Event()
+        guard = threading.Lock()
+        state = {'abandoned': False}
+
+        def _block():
+            fcntl.flock(fd, operation)
+            guard.acquire()
+            try:
+                if state['abandoned']:
+                    os.close(fd)
+                else:
+                    acquired.set()
+            finally:
+                guard.release()
+
+        waiter = threading.Thread(target=_block, name="flock-waiter")
+        waiter.daemon = True
+        waiter.start()
+        acquired.wait(timeout)
+        guard.acquire()
+        try:
+            if acquired.is_set():
+                return True
+            state['abandoned'] = True
+            return False
+        finally:
+            guard.release()
+
+    def _new_lease(self):
+        """
+        Owner record stored in the index while we fill an object.  The lease is renewed by
+        touching the object lock file, see _start_heartbeat().
+        """
+        return {"host": socket.gethostname(), "pid": os.getpid(), "started": time.time(),
+                "lease": self.PENDING_LEASE}
+
+    def _is_pending(self, value):
+        # Older versions stored the bare string "pending" with no owner information
+        return value == "pending" or (isinstance(value, dict) and "pending" in value)
+
+    def _pending_abandoned(self, os_ver_arch, object_type, value, hold_object_lock):
+        """
+        Decide whether the owner of a pending fill is gone and the fill may be taken over.
+
+        @param value: The pending index entry
+        @param hold_object_lock: bool indicating whether the caller holds the object lock
+        @return: True if the fill should be taken over
+        """
+        owner = value.get("pending") if isinstance(value, dict) else None
+        if not isinstance(owner, dict):
+            # No owner recorded - it can only be dead if nobody holds the object lock
+            return hold_object_lock
+        if owner["host"] == socket.gethostname() and not self._pid_alive(owner["pid"]):
+            self.log.warning("Process (%d) filling version (%s) - object (%s) no longer exists" %
+                             (owner["pid"], os_ver_arch, object_type))
+            return True
+        try:
+            heartbeat = max(os.stat(self._lock_filename(os_ver_arch, object_type)).st_mtime, owner["started"])
+        except OSError:
+            heartbeat = owner["started"]
+        if time.time() - heartbeat > owner["lease"]:
+            self.log.warning("Lease held by %s:%d on version (%s) - object (%s) expired %d seconds ago" %
+                             (owner["host"], owner["pid"], os_ver_arch, object_type,
+                              time.time() - heartbeat - owner["lease"]))
+            return True
+        return False
+
+    def _pid_alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno != errno.ESRCH
+        return True
+
+    def _start_heartbeat(self, os_ver_arch, object_type):
+        """
+        Renew the lease on a pending fill every third of the lease period by touching the
+        object lock file.  Runs in a daemon thread, so the lease stops being renewed as soon
+        as this process dies.
+
+        @return: function to call once the fill has finished
+        """
+        lock_filename = self._lock_filename(os_ver_arch, object_type)
+        stop = threading.Event()
+
+        def _beat():
+            while not stop.is_set():
+                try:
+                    os.utime(lock_filename, None)
+                except OSError, e:
+                    self.log.warning("Unable to renew lease on (%s): %s" % (lock_filename, e))
+                stop.wait(self.PENDING_LEASE / 3.0)
+
+        heartbeat = threading.Thread(target=_beat, name="lease-%s-%s" % (os_ver_arch, object_type))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        def _stop():
+            stop.set()
+            heartbeat.join()
+        return _stop
+
+    def _abandon_pending(self, os_ver_arch, object_type, lease):
+        """
+        Remove our pending entry after a failed fill so the next caller starts over right away
+        """
+        self.lock_and_get_index()
+        existing_cache = self._get_index_value(os_ver_arch, object_type, None)
+        if isinstance(existing_cache, dict) and existing_cache.get("pending") == lease:
+            del self.index[os_ver_arch][object_type]
+            self.write_index_and_unlock()
+        else:
+            self.unlock_index()
 
 
     # INDEX looks like
     #
-    # { "fedora-19-x86_64": { "install_iso":        { "local": "/blah", "glance": "UUID", "cinder": "UUID" },
+    # { "fedora-19-x86_64": { "install_iso":        { "local": "/blah", "glance": "UUID", "cinder": "UUID",
+    #                                                 "sha256": "hex digest", "size": 4000000000 },
     #                         "install_iso_kernel": { "local"
+    #
+    # An object that is still being filled looks like
+    #
+    #   "install_iso": { "pending": { "host": "builder1", "pid": 1234, "started": 1380000000.0, "lease": 60 } }
 
     def _get_index_value(self, os_ver_arch, name, location):
         """
         Utility function to retrieve the location of the named object for the given OS version and architecture.
-        Only use this if your thread has obtained the thread-global lock by using the
+        Only use this if your thread has obtained the index lock by using the
         lock_and_get_index() function above
         """
         if self.index is None:
@@ -147,7 +500,7 @@ class CacheManager(Singleton):
     def _set_index_value(self, os_ver_arch, name, location, value):
         """
         Utility function to set the location of the named object for the given OS version and architecture.
-        Only use this if your thread has obtained the thread-global lock by using the
+        Only use this if your thread has obtained the index lock by using the
         lock_and_get_index() function above
         """
         if self.index is None:
@@ -167,7 +520,8 @@ class CacheManager(Singleton):
 
         self.index[os_ver_arch][name][location] = value
 
-    def retrieve_and_cache_object(self, object_type, os_plugin, source_url, save_local):
+    def retrieve_and_cache_object(self, object_type, os_plugin, source_url, save_local, expected_sha256=None,
+                                  ttl=None):
         """
         Download a file from a URL and store it in the cache.  Uses the object_type and
         data from the OS delegate/plugin to index the file correctly.  Also treats the
@@ -180,127 +534,1075 @@ class CacheManager(Singleton):
         @param os_plugin: Instance of the delegate for the OS associated with the download
         @param source_url: Location from which to retrieve the object/file
         @param save_local: bool indicating whether a local copy of the object should be saved
+        @param expected_sha256: Optional hex SHA-256 the object must have.  A download that does
+        not match fails as soon as it completes, before anything is uploaded.
+        @param ttl: Seconds a cached copy is used before it is revalidated against source_url
+        (default: DEFAULT_TTL)
         @return dict containing the various cached locations of the file
            local: Local path to file
            glance: Glance object UUID
            cinder: Cinder object UUID
+           sha256: Hex SHA-256 of the object
+           size: Size of the object in bytes
+           etag, last_modified: Validators the object was served with, if any
+           validated: Time the object was last fetched or revalidated
+           content_checked: For an install ISO, time the files taken from it were last
+           filled or checked
         """
         # TODO: Gracefully deal with the situation where, for example, we are asked to save_local
         #       and find that the object is already cached but only exists in glance and/or cinder
         # TODO: Allow for local-only caching
 
-        pending_countdown = 360
+        if ttl is None:
+            ttl = self.DEFAULT_TTL
+        if source_url and source_url.startswith('/'):
+            # Plain paths, eg. to install media on an NFS mount
+            source_url = 'file://' + source_url
+        locations = self._retrieve_and_cache_object(object_type, os_plugin, source_url, save_local, expected_sha256,
+                                                    ttl)
+        if object_type == "install-iso" and self._iso_content_dict(os_plugin) and \
+                time.time() - locations.get("content_checked", 0) > self.ISO_CONTENT_CHECK_INTERVAL:
+            self._repair_iso_content(os_plugin, source_url)
+        return locations
+
+    def retrieve_and_cache_object_async(self, object_type, os_plugin, source_url, save_local, expected_sha256=None,
+                                        ttl=None):
+        """
+        Start retrieve_and_cache_object() in the background and return straight away, so that
+        several objects can be retrieved at once.  Up to ASYNC_WORKERS objects are retrieved
+        at the same time, the rest wait their turn.
+
+        @return: multiprocessing.pool.AsyncResult - its get() waits for and returns the dict
+        returned by retrieve_and_cache_object(), or raises the exception it raised
+        """
+        key = (os_plugin.os_ver_arch(), object_type)
+        self.async_pool_lock.acquire()
+        try:
+            if self.async_pool is None:
+                self.async_pool = ThreadPool(self.ASYNC_WORKERS)
+            # Counted from submission rather than from when a worker picks it up, so that an
+            # install ISO submitted afterwards leaves this object to this call - see
+            # _missing_iso_content()
+            self.async_fetches[key] = self.async_fetches.get(key, 0) + 1
+        finally:
+            self.async_pool_lock.release()
+        return self.async_pool.apply_async(self._retrieve_and_cache_object_async,
+                                           (key, object_type, os_plugin, source_url, save_local, expected_sha256,
+                                            ttl))
+
+    def _retrieve_and_cache_object_async(self, key, *args):
+        try:
+            return self.retrieve_and_cache_object(*args)
+        finally:
+            self.async_pool_lock.acquire()
+            try:
+                self.async_fetches[key] -= 1
+                if not self.async_fetches[key]:
+                    del self.async_fetches[key]
+            finally:
+                self.async_pool_lock.release()
+
+    def _async_fetch_pending(self, os_ver_arch, object_type):
+        """
+        @return: bool indicating whether a retrieve_and_cache_object_async() call for the object
+        has been submitted and has not finished yet
+        """
+        self.async_pool_lock.acquire()
+        try:
+            return (os_ver_arch, object_type) in self.async_fetches
+        finally:
+            self.async_pool_lock.release()
+
+    def _retrieve_and_cache_object(self, object_type, os_plugin, source_url, save_local, expected_sha256=None,
+                                   ttl=None):
+        os_ver_arch = os_plugin.os_ver_arch()
+        start = time.time()
+        deadline = start + self.PENDING_TIMEOUT
+        # Time we started waiting on someone else filling the object, if we did
+        waiting_since = None
         while True:
-            self.lock_and_get_index()
-            existing_cache = self._get_index_value(os_plugin.os_ver_arch(), object_type, None)
-            if existing_cache == None:
-                # We are the first - mark as pending and then start to retreive
-                self._set_index_value(os_plugin.os_ver_arch(), object_type, None, "pending")
-                self.write_index_and_unlock()
-                break
-            if isinstance(existing_cache, dict):
-                self.log.debug("Found object in cache")
-                self.unlock_index()
-                return existing_cache
-                # TODO: special case when object is ISO and sub-artifacts are not cached
-            if existing_cache == "pending":
-                # Another thread or process is currently obtaining this object
-                # poll every 10 seconds until we get a dict, then return it
-                # TODO: A graceful event based solution
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception("Waited %s seconds on pending cache fill for version (%s) - object (%s) - giving up" %
+                                ( self.PENDING_TIMEOUT, os_ver_arch, object_type ) )
+            object_lock = self._lock_object(os_ver_arch, object_type, 0, shared=True)
+            if object_lock is None:
+                if waiting_since is None:
+                    waiting_since = time.time()
+                # Wake up at least once per lease period to check that the owner is still alive
+                object_lock = self._lock_object(os_ver_arch, object_type, min(self.PENDING_LEASE, remaining),
+                                                shared=True)
+            if object_lock is not None:
+                # Nobody is filling the object - most of the time it is simply there
+                try:
+                    cached = self._lookup_cached_object(os_ver_arch, object_type, save_local, expected_sha256, ttl)
+                finally:
+                    self._unlock_object(object_lock)
+                if cached is not None:
+                    self._count_lookup("hits", waiting_since)
+                    return cached
+                object_lock = self._lock_object(os_ver_arch, object_type, min(self.PENDING_LEASE, remaining))
+            try:
+                self.lock_and_get_index()
+                existing_cache = self._get_index_value(os_ver_arch, object_type, None)
+                changed = False
+                if object_lock is not None and isinstance(existing_cache, dict) and \
+                        not self._is_pending(existing_cache) and self._is_stale(existing_cache, ttl):
+                    # Nobody else can touch the object while we hold its lock - check it against
+                    # its source without holding up the index
+                    self.unlock_index()
+                    changed = not self._revalidate_object(os_ver_arch, object_type, existing_cache, source_url)
+                    self.lock_and_get_index()
+                    existing_cache = self._get_index_value(os_ver_arch, object_type, None)
+                if existing_cache is None or changed or \
+                        (self._is_pending(existing_cache) and
+                         self._pending_abandoned(os_ver_arch, object_type, existing_cache, object_lock is not None)) or \
+                        (isinstance(existing_cache, dict) and not self._is_pending(existing_cache) and
+                         not self._cached_object_valid(existing_cache, expected_sha256, save_local)):
+                    # We are the first, or the previous owner is gone - mark as pending and then start to retreive
+                    lease = self._new_lease()
+                    self._set_index_value(os_ver_arch, object_type, None, {"pending": lease})
+                    self.write_index_and_unlock()
+                    self._count_lookup("misses", waiting_since)
+                    stop_heartbeat = self._start_heartbeat(os_ver_arch, object_type)
+                    try:
+                        fill_start = time.time()
+                        locations = self._fill_object(object_type, os_plugin, source_url, save_local,
+                                                      expected_sha256)
+                        self.cache_stats.count("fills")
+                        self.cache_stats.count("fill_seconds", time.time() - fill_start)
+                        return locations
+                    except:
+                        self._abandon_pending(os_ver_arch, object_type, lease)
+                        raise
+                    finally:
+                        stop_heartbeat()
+                if self._is_pending(existing_cache):
+                    # Another thread or process is currently obtaining this object and its lease is live
+                    self.unlock_index()
+                    if waiting_since is None:
+                        waiting_since = time.time()
+                    if object_lock is not None:
+                        # The owner took over an expired lease and does not hold the object lock -
+                        # let go of it and check back on the lease later
+                        self._unlock_object(object_lock)
+                        object_lock = None
+                        time.sleep(self.PENDING_LEASE / 3.0)
+                    continue
+                if isinstance(existing_cache, dict):
+                    self.unlock_index()
+                    existing_cache = self._pin_cached_object(existing_cache)
+                    if save_local and not existing_cache.get("local"):
+                        # Evicted between reading the index and pinning it - look again
+                        continue
+                    self.log.debug("Found object in cache")
+                    self._count_lookup("hits", waiting_since)
+                    return existing_cache
                 self.unlock_index()
-                if pending_countdown == 360:
-                    self.log.debug("Object is being retrieved in another thread or process - Waiting")
-                pending_countdown -= 1
-                if pending_countdown == 0:
-                    raise Exception("Waited one hour on pending cache fill for version (%s) - object (%s)- giving up" %
-                                    ( os_plugin.os_ver_arch(), object_type ) ) 
-                time.sleep(10)
-                continue
+                # We should never get here
+                raise Exception("Got unexpected non-string, non-dict, non-None value when reading cache")
+            finally:
+                if object_lock is not None:
+                    self._unlock_object(object_lock)
+
+    def _count_lookup(self, result, waiting_since):
+        """
+        @param result: "hits" or "misses"
+        @param waiting_since: Time the lookup started waiting on someone else filling the object,
+        or None if it did not
+        """
+        self.cache_stats.count(result)
+        if waiting_since is not None:
+            self.cache_stats.count("pending_waits")
+            self.cache_stats.count("pending_wait_seconds", time.time() - waiting_since)
+
+    def stats(self, totals=True):
+        """
+        Counters of how well the cache works - see CacheStats.  Counts are added to the totals
+        shared by every process by flush_stats(), which release_objects() also does.
 
-            # We should never get here
-            raise Exception("Got unexpected non-string, non-dict, non-None value when reading cache")
+        @param totals: bool indicating whether to return the totals of every process rather
+        than only what this process has counted since it last flushed
+        @return: dict of the stats
+        """
+        return self.cache_stats.stats(totals)
+
+    def stats_prometheus(self, totals=True):
+        """
+        @return: stats() in the Prometheus text exposition format
+        """
+        return self.cache_stats.prometheus(self.stats(totals))
+
+    def flush_stats(self):
+        """
+        Add what this process has counted to the totals shared by every process.
+        """
+        try:
+            self.cache_stats.flush()
+        except Exception, e:
+            self.log.warning("Unable to save the cache stats: %s" % e)
+
+    def blank_disk_image(self, size, properties=None):
+        """
+        Retrieve the glance image of a blank qcow2 disk to install onto, creating and uploading
+        it the first time a disk of this size and these image properties is asked for.  The
+        image is only ever used as the source of a new root disk, so one per size and property
+        set serves every build.
+
+        @param size: Size of the disk in GB
+        @param properties: Optional dict of glance image properties, such as the kernel_id,
+        ramdisk_id and os_command_line of a direct boot install
+        @return: Glance image id
+        """
+        if not properties:
+            properties = { }
+        name = "qcow2-%dG" % size
+        if properties:
+            name += "-" + hashlib.sha256(json.dumps(properties, sort_keys=True)).hexdigest()
+        object_lock = self._lock_object(self.BLANK_DISK_INDEX, name, self.PENDING_TIMEOUT)
+        if object_lock is None:
+            raise Exception("Timed out waiting for blank disk image (%s) to be created elsewhere" % name)
+        try:
+            self.lock_and_get_index(shared=True)
+            existing = self._get_index_value(self.BLANK_DISK_INDEX, name, None)
+            self.unlock_index()
+            if existing and self._glance_image_usable(existing["glance"]):
+                self.cache_stats.count("blank_disk_hits")
+                return existing["glance"]
+            self.cache_stats.count("blank_disk_misses")
+            blank_disk_filename = "%s%s.%s.%d" % (self.CACHE_ROOT, name, socket.gethostname(), os.getpid())
+            self._create_blank_disk(blank_disk_filename, size)
+            try:
+                glance_id = self.env.upload_image_to_glance('blank %dG disk' % size, local_path=blank_disk_filename,
+                                                            format='qcow2', properties=properties)
+            finally:
+                os.remove(blank_disk_filename)
+            self.lock_and_get_index()
+            self._set_index_value(self.BLANK_DISK_INDEX, name, None,
+                                  {"glance": str(glance_id), "size": size, "properties": properties})
+            self.write_index_and_unlock()
+            if existing:
+                # The old template is gone or broken - do not leave it behind
+                try:
+                    self.env.delete_image(existing["glance"])
+                except Exception, e:
+                    self.log.debug("Unable to delete blank disk image (%s): %s" % (existing["glance"], e))
+            return str(glance_id)
+        finally:
+            self._unlock_object(object_lock)
+
+    def _create_blank_disk(self, filename, size):
+        rc = os.system("qemu-img create -f qcow2 %s %dG" % (filename, size))
+        if rc != 0:
+            raise Exception("Unable to create blank image")
+
+    def cached_objects(self, os_ver_arch):
+        """
+        @param os_ver_arch: OS version and architecture string, as returned by os_ver_arch() of
+        an OS delegate/plugin
+        @return: dict mapping the name of each object cached for os_ver_arch to its locations,
+        as returned by retrieve_and_cache_object().  Objects being filled are left out.
+        """
+        self.lock_and_get_index(shared=True)
+        try:
+            objects = self.index.get(os_ver_arch) or { }
+            return dict([ (name, dict(value)) for (name, value) in objects.items()
+                          if isinstance(value, dict) and not self._is_pending(value) ])
+        finally:
+            self.unlock_index()
+
+    def _lookup_cached_object(self, os_ver_arch, object_type, save_local, expected_sha256, ttl=None):
+        """
+        Look up a complete, usable cache entry under a shared index lock.  An entry that is due
+        for revalidation is left to the caller.
+
+        @return: The pinned locations of the object, or None if it has to be filled
+        """
+        self.lock_and_get_index(shared=True)
+        try:
+            existing_cache = self._get_index_value(os_ver_arch, object_type, None)
+        finally:
+            self.unlock_index()
+        if not isinstance(existing_cache, dict) or self._is_pending(existing_cache) or \
+                not self._cached_object_valid(existing_cache, expected_sha256, save_local) or \
+                self._is_stale(existing_cache, ttl):
+            return None
+        existing_cache = self._pin_cached_object(existing_cache)
+        if save_local and not existing_cache.get("local"):
+            return None
+        self.log.debug("Found object in cache")
+        return existing_cache
+
+    def _cached_object_valid(self, locations, expected_sha256, save_local=False):
+        """
+        Cheap integrity check of a cache hit against the checksum and size recorded when it was
+        filled - compares metadata and stats the local file, but never reads it.  A hit without
+        a local copy is only good enough for a caller that does not need one.
+        """
+        if save_local and not (locations.get("local") and os.path.isfile(locations["local"])):
+            self.log.debug("Cached object has no local copy (%s) - fetching it again" % locations.get("local"))
+            return False
+        if expected_sha256 and locations.get("sha256") and locations["sha256"] != expected_sha256.lower():
+            self.log.warning("Cached object (%s) has sha256 %s but %s was requested - fetching it again" %
+                             (locations.get("local"), locations["sha256"], expected_sha256))
+            return False
+        local = locations.get("local")
+        if local and locations.get("size") is not None and os.path.isfile(local) and \
+                os.path.getsize(local) != locations["size"]:
+            self.log.warning("Cached file (%s) is %d bytes but %d were recorded - fetching it again" %
+                             (local, os.path.getsize(local), locations["size"]))
+            return False
+        return True
+
+    def _is_stale(self, locations, ttl):
+        return ttl is not None and time.time() - locations.get("validated", 0) > ttl
+
+    def _revalidate_object(self, os_ver_arch, object_type, locations, source_url):
+        """
+        Check a cached object against its source with a conditional GET - see
+        Downloader.revalidate().  Only call this while holding the object lock.  If the source
+        cannot be reached, the cached copy goes on being used.
+
+        @return: False if the object has changed and has to be fetched again
+        """
+        downloader = Downloader(source_url, self.CACHE_ROOT + os_ver_arch + "-" + object_type)
+        try:
+            unchanged = downloader.revalidate(locations.get("etag"), locations.get("last_modified"))
+        except Exception, e:
+            self.log.warning("Unable to revalidate (%s) - using the cached copy: %s" % (source_url, e))
+            return True
+        if not unchanged:
+            self.log.info("Object (%s) for (%s) has changed at (%s) - fetching it again" %
+                          (object_type, os_ver_arch, source_url))
+            return False
+        self.log.debug("Object (%s) for (%s) is unchanged at (%s)" % (object_type, os_ver_arch, source_url))
+        self.lock_and_get_index()
+        existing = self._get_index_value(os_ver_arch, object_type, None)
+        if isinstance(existing, dict) and not self._is_pending(existing):
+            existing["etag"] = downloader.etag
+            existing["last_modified"] = downloader.last_modified
+            existing["validated"] = time.time()
+            self._set_index_value(os_ver_arch, object_type, None, existing)
+            self.write_index_and_unlock()
+        else:
+            self.unlock_index()
+        return True
+
+    def _file_checksum(self, filename):
+        """
+        @return: tuple of hex SHA-256 and size of a local file
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        local_file = open(filename, 'rb')
+        try:
+            while True:
+                buf = local_file.read(1024 * 1024)
+                if not buf:
+                    break
+                sha256.update(buf)
+                size += len(buf)
+        finally:
+            local_file.close()
+        return (sha256.hexdigest(), size)
 
-        # If we have gotten here the object is not yet in the cache
+    def _fill_object(self, object_type, os_plugin, source_url, save_local, expected_sha256=None):
+        """
+        Retrieve an object that is not yet in the cache and record its locations in the index.
+        Only call this while holding the object lock from _lock_object().
+        """
         self.log.debug("Object not in cache")
 
-        # TODO: If not save_local and the plugin doesn't need the iso, direct download in glance
+        if object_type in self._iso_content_dict(os_plugin):
+            return self._fill_iso_content(object_type, os_plugin, source_url)
+
+        claimed = { }
+        if object_type == "install-iso":
+            claimed = self._claim_iso_content(os_plugin)
+        try:
+            return self._fill_whole_object(object_type, os_plugin, source_url, save_local, expected_sha256,
+                                           claimed.keys())
+        finally:
+            for object_lock in claimed.values():
+                self._unlock_object(object_lock)
+
+    def _fill_whole_object(self, object_type, os_plugin, source_url, save_local, expected_sha256, missing):
+        """
+        @param missing: list of the files from inside the install ISO to extract and cache along
+        with it, whose object locks the caller holds
+        """
         object_name = os_plugin.os_ver_arch() + "-" + object_type
+        checked = { }
+        if object_type == "install-iso":
+            # The files from inside the ISO are filled along with it, or by someone else already
+            checked["content_checked"] = time.time()
         local_object_filename = self.CACHE_ROOT + object_name
+        if self.STREAM_UPLOADS and not save_local and not os.path.isfile(local_object_filename) and not missing \
+                and not self.blob_store.shared:
+            # Nothing needs a local copy - send the download straight on to glance.  Content
+            # for a shared store is kept so that other hosts can have it.
+            (glance_id, cinder_id, sha256, size, validators) = \
+                self._stream_remote_uploads(object_name, source_url, expected_sha256)
+            locations = {"local": None, "glance": str(glance_id), "cinder": str(cinder_id),
+                         "sha256": sha256, "size": size, "validated": time.time()}
+            locations.update(validators)
+            locations.update(checked)
+            self._do_index_updates(os_plugin.os_ver_arch(), object_type, locations)
+            return locations
+
+        validators = { }
+        blob_filename = None
+        # Downloads only appear under their final name once complete, so anything found here is whole
+        if os.path.isfile(local_object_filename):
+            (sha256, size) = self._file_checksum(local_object_filename)
+            if expected_sha256 and sha256 != expected_sha256.lower():
+                self.log.warning("Local file (%s) does not match the expected checksum - removing it" %
+                                 local_object_filename)
+                os.remove(local_object_filename)
+            else:
+                self.log.debug("Local file (%s) is already present - using it" % local_object_filename)
         if not os.path.isfile(local_object_filename):
-            self._http_download_file(source_url, local_object_filename)
-        else:
-            self.log.warning("Local file (%s) is already present - assuming it is valid" % local_object_filename)
-
-        if object_type == "install-iso" and os_plugin.wants_iso_content():
-            self.log.debug("The plugin wants to do something with the ISO - extracting stuff now")
-            icd = os_plugin.iso_content_dict()
-            if icd:
-                self.log.debug("Launching guestfs")
-                g = guestfs.GuestFS()
-                g.add_drive_ro(local_object_filename)
-                g.launch()
-                g.mount_options ("", "/dev/sda", "/")
-                for nested_obj_type in icd.keys():
-                    nested_obj_name = os_plugin.os_ver_arch() + "-" + nested_obj_type
-                    nested_object_filename = self.CACHE_ROOT + nested_obj_name
-                    self.log.debug("Downloading ISO file (%s) to local file (%s)" % (icd[nested_obj_type],
-                                                                                     nested_object_filename))
-                    g.download(icd[nested_obj_type],nested_object_filename)
-                    if nested_obj_type == "install-iso-kernel":
-                        image_format = "aki"
-                    elif nested_obj_type == "install-iso-initrd":
-                        image_format = "ari"
-                    else:
-                        raise Exception("Nested object of unknown type requested")
-                    (glance_id, cinder_id) = self._do_remote_uploads(nested_obj_name, nested_object_filename,
-                                                                     format=image_format, container_format=image_format,
-                                                                     use_cinder = False)
-                    locations = {"local": nested_object_filename, "glance": str(glance_id), "cinder": str(cinder_id)}
-                    self._do_index_updates(os_plugin.os_ver_arch(), object_type, locations)
-                g.shutdown()
-                g.close()
-
-        (glance_id, cinder_id) = self._do_remote_uploads(object_name, local_object_filename)
-        locations = {"local": local_object_filename, "glance": str(glance_id), "cinder": str(cinder_id)}
+            shared = self._fetch_shared_blob(source_url, expected_sha256)
+            if shared is not None:
+                (sha256, size, validators, blob_filename) = shared
+            else:
+                (sha256, size, validators) = self._http_download_file(source_url, local_object_filename,
+                                                                      expected_sha256)
+                self.blob_store.record_source(source_url, sha256, size, validators)
+        self._pin_blob(sha256)
+        if blob_filename is None:
+            blob_filename = self._store_blob(local_object_filename, sha256, size)
+        local_object_filename = blob_filename
+
+        # The uploads of the object and of the files taken from it are independent - run them
+        # side by side so that a cold fill takes as long as the longest of them, not their sum
+        pool = ThreadPool(max(1, min(self.UPLOAD_WORKERS, len(missing) + 1)))
+        try:
+            upload = pool.apply_async(self._do_remote_uploads, (object_name, local_object_filename),
+                                      {"sha256": sha256})
+            if missing:
+                self.log.debug("The plugin wants to do something with the ISO - extracting stuff now")
+                icd = self._iso_content_dict(os_plugin)
+                nested_files = { }
+                for nested_obj_type in missing:
+                    nested_files[nested_obj_type] = (icd[nested_obj_type], self._iso_content_part(os_plugin,
+                                                                                                  nested_obj_type))
+                self._extract_iso_files(local_object_filename, nested_files)
+                nested_uploads = [ pool.apply_async(self._cache_iso_content, (os_plugin, nested_obj_type))
+                                   for nested_obj_type in missing ]
+                for nested_upload in nested_uploads:
+                    nested_upload.get()
+            (glance_id, cinder_id) = upload.get()
+        finally:
+            # Never leave uploads running behind a failure
+            pool.close()
+            pool.join()
+        locations = {"local": local_object_filename, "glance": str(glance_id), "cinder": str(cinder_id),
+                     "sha256": sha256, "size": size, "validated": time.time()}
+        locations.update(validators)
+        locations.update(checked)
         self._do_index_updates(os_plugin.os_ver_arch(), object_type, locations)
+        self._make_room()
 
         return locations
 
+    def _iso_content_dict(self, os_plugin):
+        """
+        @return: dict of the files the plugin wants from inside its install ISO
+        """
+        if not os_plugin.wants_iso_content():
+            return { }
+        icd = os_plugin.iso_content_dict() or { }
+        for nested_obj_type in icd.keys():
+            if nested_obj_type not in ("install-iso-kernel", "install-iso-initrd"):
+                raise Exception("Nested object of unknown type requested")
+        return icd
+
+    def _missing_iso_content(self, os_plugin, check_remote=False):
+        """
+        @param check_remote: bool indicating whether files whose glance image is gone also
+        count as missing
+        @return: list of the files from inside the install ISO that are neither cached with a
+        local copy nor being filled by someone else.  Files with a retrieve_and_cache_object_async()
+        call of their own under way count as being filled, whether or not that call has started.
+        """
+        missing = [ ]
+        os_ver_arch = os_plugin.os_ver_arch()
+        for nested_obj_type in self._iso_content_dict(os_plugin).keys():
+            if self._async_fetch_pending(os_ver_arch, nested_obj_type):
+                continue
+            self.lock_and_get_index(shared=True)
+            existing = self._get_index_value(os_ver_arch, nested_obj_type, None)
+            self.unlock_index()
+            if self._is_pending(existing):
+                continue
+            if isinstance(existing, dict) and self._cached_object_valid(existing, None, True) and \
+                    (not check_remote or self._glance_image_usable(existing.get("glance"))):
+                continue
+            missing.append(nested_obj_type)
+        return missing
+
+    def _repair_iso_content(self, os_plugin, iso_url):
+        """
+        Fill in the files from inside the install ISO that are missing from the cache, or whose
+        glance image has gone, while the ISO itself is cached.  Each file is checked on its own
+        and only the missing ones are rebuilt - a file that is still stored locally is uploaded
+        again, anything else is extracted, from the cached ISO where there is a local copy.
+
+        Checking costs a glance call per file, so it is done at most once per
+        ISO_CONTENT_CHECK_INTERVAL rather than on every cache hit of the ISO.  The time of the
+        last check is kept with the ISO in the index.
+        """
+        os_ver_arch = os_plugin.os_ver_arch()
+        for nested_obj_type in self._missing_iso_content(os_plugin, check_remote=True):
+            self.log.info("ISO content (%s) for (%s) is not fully cached - repairing it" %
+                          (nested_obj_type, os_ver_arch))
+            object_lock = self._lock_object(os_ver_arch, nested_obj_type, self.PENDING_TIMEOUT)
+            if object_lock is None:
+                raise Exception("Timed out waiting to repair version (%s) - object (%s)" %
+                                (os_ver_arch, nested_obj_type))
+            try:
+                self.lock_and_get_index(shared=True)
+                existing = self._get_index_value(os_ver_arch, nested_obj_type, None)
+                self.unlock_index()
+                if isinstance(existing, dict) and not self._is_pending(existing) and \
+                        self._cached_object_valid(existing, None, True):
+                    existing = self._pin_cached_object(existing)
+                    if existing.get("local") and not self._glance_image_usable(existing.get("glance")):
+                        self._upload_iso_content(os_plugin, nested_obj_type, existing["local"],
+                                                 existing.get("sha256"), existing.get("size"))
+                    if existing.get("local"):
+                        continue
+            finally:
+                self._unlock_object(object_lock)
+            # No usable local copy - extract it again, with the usual pending/lease handling
+            self._retrieve_and_cache_object(nested_obj_type, os_plugin, iso_url, True)
+        self.lock_and_get_index()
+        existing = self._get_index_value(os_ver_arch, "install-iso", None)
+        if isinstance(existing, dict) and not self._is_pending(existing):
+            existing["content_checked"] = time.time()
+            self._set_index_value(os_ver_arch, "install-iso", None, existing)
+            self.write_index_and_unlock()
+        else:
+            self.unlock_index()
+
+    def _claim_iso_content(self, os_plugin):
+        """
+        Take the object locks of the files from inside the install ISO that are missing and that
+        nobody else is filling right now, so that they can be extracted along with the ISO.
+
+        @return: dict mapping each claimed file to its object lock
+        """
+        claimed = { }
+        os_ver_arch = os_plugin.os_ver_arch()
+        for nested_obj_type in self._missing_iso_content(os_plugin):
+            object_lock = self._lock_object(os_ver_arch, nested_obj_type, 0)
+            if object_lock is not None:
+                claimed[nested_obj_type] = object_lock
+        # Anything filled between the first look and taking its lock is no longer missing
+        missing = self._missing_iso_content(os_plugin)
+        for nested_obj_type in claimed.keys():
+            if nested_obj_type not in missing:
+                self._unlock_object(claimed.pop(nested_obj_type))
+        return claimed
+
+    def _iso_content_part(self, os_plugin, nested_obj_type):
+        return self.CACHE_ROOT + os_plugin.os_ver_arch() + "-" + nested_obj_type + ".part"
+
+    def _fill_iso_content(self, object_type, os_plugin, iso_url):
+        """
+        Fill one of the files from inside the install ISO.  If the ISO is cached with a local
+        copy, the file is extracted from that.  Otherwise, given the location of the ISO, only
+        the parts of it holding the directories and the file itself are read - with HTTP Range
+        requests, or directly from a file:// URL - so the ISO does not have to be downloaded.
+        Failing that, or if the server does not support byte ranges, the ISO is retrieved into
+        the cache and the file extracted from it.
+        """
+        iso_path = self._iso_content_dict(os_plugin)[object_type]
+        part_filename = self._iso_content_part(os_plugin, object_type)
+        extracted = False
+        self.lock_and_get_index(shared=True)
+        iso_locations = self._get_index_value(os_plugin.os_ver_arch(), "install-iso", None)
+        self.unlock_index()
+        if isinstance(iso_locations, dict) and not self._is_pending(iso_locations) and \
+                self._cached_object_valid(iso_locations, None, True):
+            # The ISO is already stored locally - much cheaper than going back to its source
+            iso_locations = self._pin_cached_object(iso_locations)
+            if iso_locations.get("local"):
+                self._extract_iso_files(iso_locations["local"], {object_type: (iso_path, part_filename)})
+                extracted = True
+        if not extracted and self.REMOTE_ISO_CONTENT and iso_url:
+            try:
+                self._extract_remote_iso_file(iso_url, iso_path, part_filename)
+                extracted = True
+            except Exception, e:
+                self.log.warning("Unable to read (%s) from (%s) in place - retrieving the whole ISO: %s" %
+                                 (iso_path, iso_url, e))
+        if not extracted:
+            iso_locations = self._retrieve_and_cache_object("install-iso", os_plugin, iso_url, True)
+            self._extract_iso_files(iso_locations["local"], {object_type: (iso_path, part_filename)})
+        return self._cache_iso_content(os_plugin, object_type)
+
+    def _extract_remote_iso_file(self, iso_url, iso_path, filename):
+        range_reader = None
+        transfer = None
+        start = time.time()
+        if iso_url.startswith("file://"):
+            reader = ISOReader(iso_url[len("file://"):])
+        else:
+            transfer = TransferScheduler().acquire(TransferScheduler.DOWNLOAD, description=iso_url, url=iso_url)
+            range_reader = HTTPRangeReader(iso_url, transfer=transfer)
+            reader = ISOReader(range_reader)
+        try:
+            self.log.debug("Extracting ISO file (%s) from (%s) to local file (%s)" % (iso_path, iso_url, filename))
+            reader.extract(iso_path, filename)
+        finally:
+            reader.close()
+            if range_reader is not None:
+                range_reader.close()
+            if transfer is not None:
+                transfer.release()
+        seconds = time.time() - start
+        self.cache_stats.phase("extract", seconds)
+        if range_reader is not None:
+            self.cache_stats.download(iso_url, range_reader.bytes_fetched, seconds)
+            self.log.debug("Read (%s) with %d requests for %d bytes" % (iso_path, range_reader.requests,
+                                                                        range_reader.bytes_fetched))
+
+    def _cache_iso_content(self, os_plugin, nested_obj_type):
+        """
+        Store a file extracted from the install ISO to its .part file, upload it and index it
+
+        @return: dict containing the various cached locations of the file
+        """
+        nested_obj_name = os_plugin.os_ver_arch() + "-" + nested_obj_type
+        nested_object_filename = self.CACHE_ROOT + nested_obj_name
+        os.rename(nested_object_filename + ".part", nested_object_filename)
+        (nested_sha256, nested_size) = self._file_checksum(nested_object_filename)
+        self._pin_blob(nested_sha256)
+        nested_object_filename = self._store_blob(nested_object_filename, nested_sha256, nested_size)
+        return self._upload_iso_content(os_plugin, nested_obj_type, nested_object_filename, nested_sha256,
+                                        nested_size)
+
+    def _upload_iso_content(self, os_plugin, nested_obj_type, nested_object_filename, nested_sha256, nested_size):
+        """
+        Upload a stored file from inside the install ISO to glance and index it
+
+        @return: dict containing the various cached locations of the file
+        """
+        nested_obj_name = os_plugin.os_ver_arch() + "-" + nested_obj_type
+        if nested_obj_type == "install-iso-kernel":
+            image_format = "aki"
+        else:
+            image_format = "ari"
+        (glance_id, cinder_id) = self._do_remote_uploads(nested_obj_name, nested_object_filename,
+                                                         format=image_format, container_format=image_format,
+                                                         use_cinder = False, sha256=nested_sha256)
+        locations = {"local": nested_object_filename, "glance": str(glance_id), "cinder": str(cinder_id),
+                     "sha256": nested_sha256, "size": nested_size}
+        self._do_index_updates(os_plugin.os_ver_arch(), nested_obj_type, locations)
+        return locations
+
+    def _extract_iso_files(self, iso_filename, files):
+        """
+        Copy files out of an ISO image.  The image is read directly with ISOReader, and
+        libguestfs is only launched for files that could not be read that way.
+
+        @param iso_filename: Path of the ISO image
+        @param files: dict mapping a name to a tuple of the path of a file on the ISO and the
+        local file to copy it to
+        """
+        start = time.time()
+        try:
+            self._extract_iso_files_from(iso_filename, files)
+        finally:
+            self.cache_stats.phase("extract", time.time() - start)
+
+    def _extract_iso_files_from(self, iso_filename, files):
+        remaining = files.keys()
+        try:
+            reader = ISOReader(iso_filename)
+            try:
+                for name in files.keys():
+                    (iso_path, local_filename) = files[name]
+                    self.log.debug("Extracting ISO file (%s) to local file (%s)" % (iso_path, local_filename))
+                    reader.extract(iso_path, local_filename)
+                    remaining.remove(name)
+            finally:
+                reader.close()
+        except Exception, e:
+            self.log.warning("Unable to read (%s) directly - falling back to guestfs: %s" % (iso_filename, e))
+        if not remaining:
+            return
+
+        self.log.debug("Launching guestfs")
+        g = guestfs.GuestFS()
+        g.add_drive_ro(iso_filename)
+        g.launch()
+        g.mount_options ("", "/dev/sda", "/")
+        for name in remaining:
+            (iso_path, local_filename) = files[name]
+            self.log.debug("Downloading ISO file (%s) to local file (%s)" % (iso_path, local_filename))
+            g.download(iso_path, local_filename)
+        g.shutdown()
+        g.close()
+
     def _do_index_updates(self, os_ver_arch, object_type, locations):
         self.lock_and_get_index()
         self._set_index_value(os_ver_arch, object_type, None, locations )
         self.write_index_and_unlock()
 
     def _do_remote_uploads(self, object_name, local_object_filename, format='raw', container_format='bare',
-                           use_cinder=True):
+                           use_cinder=True, sha256=None):
+        """
+        Upload a local object to glance and, if available and requested, cinder.  When the
+        SHA-256 of the object is given, content that has already been uploaded in the same
+        format - under any os_ver_arch and object name - is reused instead of uploaded again.
+
+        @return: tuple of glance image id and cinder volume id (or None)
+        """
+        if not sha256:
+            return self._upload(object_name, local_object_filename, format, container_format, use_cinder)
+
+        upload_key = "%s/%s" % (format, container_format)
+        blob_lock = self._lock_object(self.BLOB_INDEX, sha256)
+        try:
+            remote = self._reuse_remote_copy(object_name, sha256, upload_key, use_cinder)
+            if remote is None:
+                remote = self._upload(object_name, local_object_filename, format, container_format, use_cinder)
+            self._record_remote_copy(sha256, upload_key, remote[0], remote[1], os.path.getsize(local_object_filename))
+        finally:
+            self._unlock_object(blob_lock)
+        return remote[:2]
+
+    def _stream_remote_uploads(self, object_name, source_url, expected_sha256=None):
+        """
+        Upload an object to glance and, if available, cinder while it downloads, without
+        staging it on local disk - see StreamingDownload.  When the SHA-256 is known up front
+        and the content is already in glance, nothing is downloaded at all.
+
+        @return: tuple of glance image id, cinder volume id (or None), hex SHA-256, size and a
+        dict of the ETag and Last-Modified validators of the object
+        """
+        upload_key = "raw/bare"
+        blob_lock = None
+        if expected_sha256:
+            expected_sha256 = expected_sha256.lower()
+            blob_lock = self._lock_object(self.BLOB_INDEX, expected_sha256)
+        try:
+            if expected_sha256:
+                remote = self._reuse_remote_copy(object_name, expected_sha256, upload_key, True)
+                if remote is not None:
+                    self._record_remote_copy(expected_sha256, upload_key, remote[0], remote[1], remote[2])
+                    return (remote[0], remote[1], expected_sha256, remote[2], { })
+            transfer = TransferScheduler().acquire(TransferScheduler.DOWNLOAD, description=source_url,
+                                                   url=source_url)
+            try:
+                start = time.time()
+                stream = StreamingDownload(source_url, expected_sha256=expected_sha256, transfer=transfer).start()
+                try:
+                    (glance_id, cinder_id) = self._upload(object_name, None, 'raw', 'bare', True, stream)
+                finally:
+                    stream.close()
+                # The download ran alongside the upload, so its time is that of the glance_upload phase
+                self.cache_stats.download(source_url, transfer.bytes, time.time() - start)
+            finally:
+                transfer.release()
+            if stream.sha256 is None:
+                raise Exception("Upload of (%s) finished before the whole object was read" % source_url)
+        finally:
+            if blob_lock is not None:
+                self._unlock_object(blob_lock)
+
+        blob_lock = self._lock_object(self.BLOB_INDEX, stream.sha256)
+        try:
+            remote = self._reuse_remote_copy(object_name, stream.sha256, upload_key, True)
+            if remote is not None and remote[0] != str(glance_id):
+                # The same content was uploaded before - keep that copy and drop ours
+                self._delete_remote_copies({upload_key: {"glance": str(glance_id), "cinder": cinder_id}})
+                (glance_id, cinder_id) = remote[:2]
+            self._record_remote_copy(stream.sha256, upload_key, glance_id, cinder_id, stream.size)
+        finally:
+            self._unlock_object(blob_lock)
+        return (glance_id, cinder_id, stream.sha256, stream.size,
+                {"etag": stream.etag, "last_modified": stream.last_modified})
+
+    def _reuse_remote_copy(self, object_name, sha256, upload_key, use_cinder):
+        """
+        Only call this while holding the blob lock of sha256.
+
+        @return: tuple of glance image id, cinder volume id (or None) and size of content that
+        is already uploaded, or None
+        """
+        self.lock_and_get_index(shared=True)
+        existing = self._get_index_value(self.BLOB_INDEX, sha256, upload_key)
+        self.unlock_index()
+        if not existing or not self._glance_image_usable(existing["glance"]):
+            return None
+        self.log.debug("Content of (%s) is already in glance as (%s)" % (object_name, existing["glance"]))
+        cinder_id = None
         if self.env.is_cinder() and use_cinder:
-            (glance_id, cinder_id) = self.env.upload_volume_to_cinder(object_name, local_path=local_object_filename,
-                                                                      format=format, container_format=container_format)
+            cinder_id = existing.get("cinder")
+            if not cinder_id:
+                cinder_id = self.env.create_volume_from_image(existing["glance"])
+        return (existing["glance"], cinder_id, existing.get("size"))
+
+    def _record_remote_copy(self, sha256, upload_key, glance_id, cinder_id, size):
+        """
+        Remember the remote copies made of a blob.  Only call this while holding its blob lock.
+        """
+        self.lock_and_get_index()
+        existing = self._get_index_value(self.BLOB_INDEX, sha256, upload_key)
+        record = {"glance": str(glance_id), "cinder": None, "size": size}
+        if cinder_id:
+            record["cinder"] = str(cinder_id)
+        elif existing:
+            record["cinder"] = existing.get("cinder")
+        self._set_index_value(self.BLOB_INDEX, sha256, upload_key, record)
+        self.write_index_and_unlock()
+
+    def _upload(self, object_name, local_object_filename, format, container_format, use_cinder, stream=None):
+        size = None
+        if stream is not None:
+            size = stream.size
+        start = time.time()
+        glance_id = self.env.upload_image_to_glance(object_name, local_path=local_object_filename,
+                                                    format=format, container_format=container_format,
+                                                    data=stream, size=size)
+        self.cache_stats.phase("glance_upload", time.time() - start)
+        if stream is not None:
+            self.cache_stats.count("bytes_uploaded", stream.size or 0)
         else:
-            cinder_id = None
-            glance_id = self.env.upload_image_to_glance(object_name, local_path=local_object_filename,
-                                                        format=format, container_format=container_format)
+            self.cache_stats.count("bytes_uploaded", os.path.getsize(local_object_filename))
+        cinder_id = None
+        if self.env.is_cinder() and use_cinder:
+            start = time.time()
+            cinder_id = self.env.create_volume_from_image(glance_id)
+            self.cache_stats.phase("cinder_migrate", time.time() - start)
         return (glance_id, cinder_id)
 
-    def _http_download_file(self, url, filename):
-        # Function to download a file from url to filename
-        # Borrowed and modified from Oz by Chris Lalancette
-        # https://github.com/clalancette/oz
+    def _glance_image_usable(self, image_id):
+        try:
+            return self.env.get_image_status(image_id).lower() == 'active'
+        except Exception, e:
+            self.log.debug("Unable to use glance image (%s): %s" % (image_id, e))
+            return False
+
+    def _blob_filename(self, sha256):
+        return self.blob_store.path(sha256)
 
-        def _data(buf):
-            # Function that is called back from the pycurl perform() method to
-            # actually write data to disk.
-            os.write(fd, buf)
+    def _store_blob(self, filename, sha256, size):
+        """
+        Move a completed local file into the content addressed store - see BlobStore.  If
+        identical content is already stored, the new copy is discarded.
 
-        fd = os.open(filename,os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+        @return: Path of the stored blob
+        """
+        return self.blob_store.store(filename, sha256, size)
+
+    def _fetch_shared_blob(self, source_url, expected_sha256=None):
+        """
+        Take the content of source_url from the blob store, if another host has already put it
+        there.  Without an expected SHA-256, the content recorded for source_url is only used
+        if the source confirms it has not changed since, or cannot be reached.
+
+        @return: tuple of hex SHA-256, size, dict of validators and local path of the content,
+        or None if it has to be fetched from its source
+        """
+        if not self.blob_store.shared:
+            return None
+        validators = { }
+        size = None
+        if expected_sha256:
+            sha256 = expected_sha256.lower()
+        else:
+            record = self.blob_store.lookup_source(source_url)
+            if not record or not record.get("sha256"):
+                return None
+            (sha256, size) = (record["sha256"], record.get("size"))
+            validators = {"etag": record.get("etag"), "last_modified": record.get("last_modified")}
+            downloader = Downloader(source_url, self.CACHE_ROOT + sha256)
+            try:
+                if not downloader.revalidate(validators["etag"], validators["last_modified"]):
+                    return None
+            except Exception, e:
+                self.log.warning("Unable to revalidate (%s) - using the shared copy: %s" % (source_url, e))
+        blob_filename = self.blob_store.fetch(sha256, size)
+        if blob_filename is None:
+            return None
+        self.log.debug("Took the content of (%s) from the blob store" % source_url)
+        return (sha256, os.path.getsize(blob_filename), validators, blob_filename)
 
+    def _http_download_file(self, url, filename, expected_sha256=None):
+        """
+        Download a file from url to filename.  Large objects are fetched as parallel byte range
+        segments and an interrupted download resumes from its .part file - see Downloader.
+        file:// URLs are copied by reflink, or by the kernel, where possible - see FileCopier.
+        filename only exists once the download is complete.  Remote downloads run in a
+        download slot of the TransferScheduler.
+
+        @return: tuple of hex SHA-256 and size, computed while the data streamed in, and a dict
+        of the ETag and Last-Modified validators of the object
+        """
+        if url.startswith('file://'):
+            start = time.time()
+            downloader = FileCopier(url[len('file://'):], filename, expected_sha256=expected_sha256,
+                                    reserve_space=self._make_room, link=self.LINK_LOCAL_SOURCES)
+            downloader.copy()
+        else:
+            transfer = TransferScheduler().acquire(TransferScheduler.DOWNLOAD, description=url, url=url)
+            try:
+                # Time waiting for a slot is not the mirror's fault
+                start = time.time()
+                downloader = Downloader(url, filename, expected_sha256=expected_sha256, reserve_space=self._make_room,
+                                        transfer=transfer)
+                downloader.download()
+            finally:
+                transfer.release()
+        seconds = time.time() - start
+        self.cache_stats.phase("download", seconds)
+        self.cache_stats.download(url, downloader.size or 0, seconds)
+        return (downloader.sha256, downloader.size,
+                {"etag": downloader.etag, "last_modified": downloader.last_modified})
+
+    def _pin_filename(self, sha256):
+        return self.blob_store.pin_filename(sha256) or self._lock_filename(self.BLOB_INDEX, sha256 + ".pin")
+
+    def _pin_blob(self, sha256):
+        """
+        Protect a blob from eviction for as long as this process is using it, see
+        release_objects().  The pin is a shared lock on the pin file of the blob, so any
+        number of processes can pin the same blob and the pin goes away when a process dies.
+        Blocks while the blob is being evicted.
+        """
+        self.pins_lock.acquire()
+        try:
+            if sha256 in self.pins:
+                return
+            fd = os.open(self._pin_filename(sha256), os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            except:
+                os.close(fd)
+                raise
+            self.pins[sha256] = fd
+        finally:
+            self.pins_lock.release()
+
+    def _pin_cached_object(self, locations):
+        """
+        Pin the local copy of a cache hit and mark it as recently used.
+
+        @return: The locations, without the local copy if it has gone away in the meantime
+        """
+        local = locations.get("local")
+        if not local:
+            return locations
+        if locations.get("sha256"):
+            self._pin_blob(locations["sha256"])
+        try:
+            os.utime(local, None)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            locations = dict(locations)
+            locations["local"] = None
+        return locations
+
+    def release_objects(self):
+        """
+        Drop the pins on every object this process has retrieved, allowing them to be evicted
+        again.  Call this once the objects returned by retrieve_and_cache_object() are no
+        longer needed.  Also saves the cache stats - see flush_stats().
+        """
+        self.pins_lock.acquire()
         try:
-            c = pycurl.Curl()
-            c.setopt(c.URL, url)
-            c.setopt(c.CONNECTTIMEOUT, 15)
-            c.setopt(c.WRITEFUNCTION, _data)
-            c.setopt(c.FOLLOWLOCATION, 1)
-            c.perform()
-            c.close()
+            for fd in self.pins.values():
+                os.close(fd)
+            self.pins = {}
+        finally:
+            self.pins_lock.release()
+        self.flush_stats()
+
+    def _over_quota(self, total, needed):
+        if self.MAX_SIZE is not None and total + needed > self.MAX_SIZE:
+            return True
+        if self.MIN_FREE_SPACE:
+            stat = os.statvfs(self.blob_store.root)
+            if stat.f_bavail * stat.f_frsize - needed < self.MIN_FREE_SPACE:
+                return True
+        return False
+
+    def _make_room(self, needed=0):
+        """
+        Evict local copies, least recently used first, until the cache fits within MAX_SIZE
+        and MIN_FREE_SPACE with room for needed more bytes.  Pinned blobs are skipped.
+
+        @param needed: Number of bytes about to be added to the cache
+        """
+        if self.MAX_SIZE is None and not self.MIN_FREE_SPACE:
+            return
+        blobs = self.blob_store.blobs()
+        blobs.sort()
+        total = sum([blob[1] for blob in blobs])
+        for (mtime, size, sha256) in blobs:
+            if not self._over_quota(total, needed):
+                return
+            if self._evict_blob(sha256):
+                total -= size
+        if self._over_quota(total, needed):
+            self.log.warning("Unable to free enough cache space - all remaining objects are in use")
+
+    def _evict_blob(self, sha256):
+        """
+        Remove a blob that nobody has pinned, along with every index reference to it.  When
+        EVICT_REMOTE is set, the glance images and cinder volumes made from it go too.
+
+        @return: True if the blob was evicted, False if it is in use
+        """
+        fd = os.open(self._pin_filename(sha256), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    return False
+                raise
+            blob_filename = self._blob_filename(sha256)
+            self.log.info("Evicting (%s) from the cache" % blob_filename)
+            self.lock_and_get_index()
+            try:
+                for os_ver_arch in self.index.keys():
+                    if os_ver_arch == self.BLOB_INDEX:
+                        continue
+                    for name, locations in self.index[os_ver_arch].items():
+                        if not isinstance(locations, dict) or self._is_pending(locations) or \
+                                locations.get("local") != blob_filename:
+                            continue
+                        if self.EVICT_REMOTE:
+                            del self.index[os_ver_arch][name]
+                        else:
+                            locations["local"] = None
+                remote_copies = None
+                if self.EVICT_REMOTE and self.BLOB_INDEX in self.index:
+                    remote_copies = self.index[self.BLOB_INDEX].pop(sha256, None)
+            except:
+                self.unlock_index()
+                raise
+            self.write_index_and_unlock()
+            self.blob_store.remove(sha256)
+            if remote_copies:
+                self._delete_remote_copies(remote_copies)
+            return True
         finally:
             os.close(fd)
+
+    def _delete_remote_copies(self, remote_copies):
+        for record in remote_copies.values():
+            try:
+                if record.get("cinder") and record["cinder"] != "None":
+                    self.env.delete_volume(record["cinder"])
+                if record.get("glance") and record["glance"] != "None":
+                    self.env.delete_image(record["glance"])
+            except Exception, e:
+                self.log.warning("Unable to delete remote copies (%s) of evicted object: %s" % (record, e))
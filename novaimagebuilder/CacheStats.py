@@ -0,0 +1,196 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import fcntl
+import json
+import os
+import threading
+import urlparse
+
+
+class CacheStats(object):
+    """
+    Counters of how well the cache works, kept by CacheManager.  Counts are gathered in
+    memory and added to the totals in a JSON file by flush(), under a lock, so the totals
+    cover every process sharing the cache.
+
+    The stats are a dict of:
+        hits: Objects found in the cache
+        misses: Objects that had to be filled
+        pending_waits: Retrievals that waited on another thread or process filling the object
+        pending_wait_seconds: Time spent in those waits
+        bytes_downloaded: Bytes fetched from the sources of objects
+        bytes_uploaded: Bytes uploaded to glance
+        fills, fill_seconds: Objects filled and the time taken
+        blank_disk_hits, blank_disk_misses: Blank root disk templates found in glance and
+        created - kept apart from hits and misses, which only count cached objects
+        phases: dict mapping each of PHASES to a dict of its count and seconds
+        hosts: dict mapping each host downloaded from to a dict of its bytes and seconds
+    """
+
+    PHASES = ("download", "extract", "glance_upload", "cinder_migrate")
+    # Prefix of the metric names of prometheus()
+    METRIC_PREFIX = "novaimagebuilder_cache_"
+
+    def __init__(self, filename):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._counts = self._empty()
+
+    def _empty(self):
+        counts = {"hits": 0, "misses": 0, "pending_waits": 0, "pending_wait_seconds": 0.0,
+                  "bytes_downloaded": 0, "bytes_uploaded": 0, "fills": 0, "fill_seconds": 0.0,
+                  "blank_disk_hits": 0, "blank_disk_misses": 0, "phases": { }, "hosts": { }}
+        for phase in self.PHASES:
+            counts["phases"][phase] = {"count": 0, "seconds": 0.0}
+        return counts
+
+    def count(self, name, amount=1):
+        """
+        Add amount to the counter name.
+        """
+        self._lock.acquire()
+        try:
+            self._counts[name] += amount
+        finally:
+            self._lock.release()
+
+    def phase(self, name, seconds):
+        """
+        Record a fill phase, one of PHASES, that took seconds.
+        """
+        self._lock.acquire()
+        try:
+            self._counts["phases"][name]["count"] += 1
+            self._counts["phases"][name]["seconds"] += seconds
+        finally:
+            self._lock.release()
+
+    def download(self, url, size, seconds):
+        """
+        Record a download of size bytes from url that took seconds.
+        """
+        host = urlparse.urlparse(url).hostname or "localhost"
+        self._lock.acquire()
+        try:
+            self._counts["bytes_downloaded"] += size
+            host_counts = self._counts["hosts"].setdefault(host, {"bytes": 0, "seconds": 0.0})
+            host_counts["bytes"] += size
+            host_counts["seconds"] += seconds
+        finally:
+            self._lock.release()
+
+    def stats(self, totals=True):
+        """
+        @param totals: bool indicating whether to include the totals flushed by every process,
+        rather than only the counts of this process that have not been flushed yet
+        @return: dict of the stats
+        """
+        self._lock.acquire()
+        try:
+            counts = json.loads(json.dumps(self._counts))
+        finally:
+            self._lock.release()
+        if not totals:
+            return counts
+        stats = self._empty()
+        fd = self._open_locked(fcntl.LOCK_SH)
+        try:
+            self._add(stats, self._read(fd))
+        finally:
+            os.close(fd)
+        self._add(stats, counts)
+        return stats
+
+    def flush(self):
+        """
+        Add the counts of this process to the totals in the stats file and start counting afresh.
+        """
+        self._lock.acquire()
+        try:
+            counts = self._counts
+            self._counts = self._empty()
+        finally:
+            self._lock.release()
+        fd = self._open_locked(fcntl.LOCK_EX)
+        try:
+            stats = self._empty()
+            self._add(stats, self._read(fd))
+            self._add(stats, counts)
+            data = json.dumps(stats)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def prometheus(self, stats=None):
+        """
+        @param stats: dict of stats (default: the totals)
+        @return: stats in the Prometheus text exposition format
+        """
+        if stats is None:
+            stats = self.stats()
+        lines = [ ]
+
+        def _metric(name, kind, samples):
+            lines.append("# TYPE %s%s %s" % (self.METRIC_PREFIX, name, kind))
+            for (labels, value) in samples:
+                lines.append("%s%s%s %s" % (self.METRIC_PREFIX, name, labels, repr(value)))
+
+        for name in ("hits", "misses", "pending_waits", "pending_wait_seconds", "fills", "fill_seconds",
+                     "bytes_downloaded", "bytes_uploaded", "blank_disk_hits", "blank_disk_misses"):
+            _metric(name + "_total", "counter", [ ("", stats[name]) ])
+        for (key, name) in (("count", "phase_total"), ("seconds", "phase_seconds_total")):
+            _metric(name, "counter", [ ('{phase="%s"}' % phase, stats["phases"][phase][key])
+                                       for phase in sorted(stats["phases"].keys()) ])
+        for (key, name) in (("bytes", "host_bytes_downloaded_total"), ("seconds", "host_download_seconds_total")):
+            _metric(name, "counter", [ ('{host="%s"}' % host, stats["hosts"][host][key])
+                                       for host in sorted(stats["hosts"].keys()) ])
+        return "\n".join(lines) + "\n"
+
+    def _open_locked(self, operation):
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, operation)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def _read(self, fd):
+        data = ''
+        while True:
+            buf = os.read(fd, 65536)
+            if not buf:
+                break
+            data += buf
+        if not data:
+            return { }
+        try:
+            return json.loads(data)
+        except ValueError:
+            self.log.warning("Cache stats file (%s) is damaged - starting the totals afresh" % self.filename)
+            return { }
+
+    def _add(self, totals, counts):
+        for (name, value) in counts.items():
+            if isinstance(value, dict):
+                self._add(totals.setdefault(name, { }), value)
+            else:
+                totals[name] = totals.get(name, 0) + value
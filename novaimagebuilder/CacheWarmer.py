@@ -0,0 +1,129 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import time
+from multiprocessing.pool import ThreadPool
+from OSInfo import OSInfo
+from Builder import Builder
+from CacheManager import CacheManager
+
+
+class CacheWarmer(object):
+    """
+    Fill the cache with the install media of a list of OSes ahead of time, for instance
+    overnight, so that the builds that follow are all cache hits.  The OSes are worked on
+    by a pool of at most workers threads.  Bandwidth per mirror is limited through
+    TransferScheduler.HOST_RATES.
+
+    @param arch: Architecture to cache the install media of
+    @param workers: Most OSes to work on at once (default: WORKERS)
+    """
+
+    WORKERS = 2
+
+    def __init__(self, arch='x86_64', workers=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.arch = arch
+        self.workers = workers or self.WORKERS
+        self.osinfo = OSInfo()
+        self.cache = CacheManager()
+        self.targets = [ ]
+
+    def add(self, shortid, install_type=None, location=None):
+        """
+        Queue the install media of an OS for caching.
+
+        @param shortid: The shortid of the OS
+        @param install_type: "iso" or "tree".  Defaults to an ISO if one is known for the OS.
+        @param location: Location of the ISO or install tree.  Defaults to the media listed for
+        the OS and architecture by libosinfo.
+        """
+        self.targets.append({'shortid': shortid, 'install_type': install_type, 'location': location})
+
+    def run(self):
+        """
+        Cache the install media of every queued OS.  A failure only affects its own OS.
+
+        @return: list with a dict per OS:
+            shortid, install_type, location
+            objects: dict mapping each object type to a dict of its cached locations, with
+                     'fetched' True if it was retrieved now rather than already cached, and
+                     'uploaded' True if it went to glance now
+            seconds: Time taken
+            error: The exception raised, or None
+        """
+        pool = ThreadPool(max(1, min(self.workers, len(self.targets))))
+        try:
+            return pool.map(self._warm, self.targets)
+        finally:
+            pool.close()
+            pool.join()
+            # Nothing is being built - let the media be evicted again if need be
+            self.cache.release_objects()
+
+    def _warm(self, target):
+        report = dict(target)
+        report.update({'objects': { }, 'seconds': 0, 'error': None})
+        start = time.time()
+        try:
+            os_dict = self.osinfo.os_for_shortid(target['shortid'])
+            if not os_dict:
+                raise Exception("Unknown OS (%s)" % target['shortid'])
+            if not report['location']:
+                (report['install_type'], report['location']) = self._default_media(os_dict, target['install_type'])
+            elif not report['install_type']:
+                if report['location'].lower().endswith('.iso'):
+                    report['install_type'] = 'iso'
+                else:
+                    report['install_type'] = 'tree'
+            install_config = {'admin_password': '', 'license_key': None, 'arch': self.arch, 'disk_size': 10,
+                              'flavor': None, 'storage': 'glance', 'name': None, 'direct_boot': True,
+                              'public': False, 'timeout': None, 'floating_ip': False}
+            builder = Builder(target['shortid'], install_location=report['location'],
+                              install_type=report['install_type'], install_config=install_config)
+            os_delegate = builder.os_delegate
+            before = self.cache.cached_objects(os_delegate.os_ver_arch())
+            self.log.info("Caching %s install media of (%s) from (%s)" %
+                          (report['install_type'], target['shortid'], report['location']))
+            for (object_type, locations) in os_delegate.cache_install_media().items():
+                previous = before.get(object_type) or { }
+                locations = dict(locations)
+                locations['fetched'] = previous.get('sha256') != locations.get('sha256') or \
+                    previous.get('local') != locations.get('local')
+                locations['uploaded'] = previous.get('glance') != locations.get('glance')
+                report['objects'][object_type] = locations
+        except Exception, e:
+            self.log.exception("Unable to cache the install media of (%s)" % target['shortid'])
+            report['error'] = e
+        report['seconds'] = time.time() - start
+        return report
+
+    def _default_media(self, os_dict, install_type):
+        """
+        @return: tuple of install type and location of the install media libosinfo lists for
+        the OS and architecture
+        """
+        candidates = [ ]
+        if install_type in (None, 'iso'):
+            candidates += [ ('iso', media) for media in os_dict['media_list'] if media.get_installer() ]
+        if install_type in (None, 'tree'):
+            candidates += [ ('tree', tree) for tree in os_dict['tree_list'] ]
+        for (candidate_type, media) in candidates:
+            if media.get_architecture() == self.arch and media.get_url():
+                return (candidate_type, media.get_url())
+        raise Exception("No %s install media known for (%s) on (%s)" %
+                        (install_type or 'iso or tree', os_dict['shortid'], self.arch))
@@ -0,0 +1,171 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+class CapabilityCache(object):
+    """
+    Results of probing what an OpenStack cloud supports, such as whether nova can map volumes
+    as cdrom drives, kept by StackEnvironment so that the probes are not repeated on every
+    check.  Results are kept in memory and in a JSON file shared by every process, and are
+    probed again once they are older than the TTL.
+
+    The file holds a dict keyed by endpoint, each mapping the name of a capability to a dict
+    of its value and the time it was probed.  Values must be JSON serializable.  The directory
+    holding the file is created if it is missing.  When the file cannot be written, results
+    are only kept in memory.
+
+    @param filename: JSON file the results are kept in, or None to keep them in memory only
+    @param ttl: Seconds a result is used before it is probed again, or None for ever
+    """
+
+    def __init__(self, filename=None, ttl=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.filename = filename
+        self.ttl = ttl
+        self._results = { }
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, name, probe):
+        """
+        @param endpoint: String identifying the cloud, such as its auth URL and tenant
+        @param name: Name of the capability
+        @param probe: function called without arguments to find the value when no fresh
+        result is cached
+        @return: The value of the capability
+        """
+        self._lock.acquire()
+        try:
+            result = self._results.get(endpoint, { }).get(name)
+        finally:
+            self._lock.release()
+        if not self._fresh(result):
+            result = self._read().get(endpoint, { }).get(name)
+            if not self._fresh(result):
+                self.log.debug("Probing (%s) of (%s)" % (name, endpoint))
+                result = {"value": probe(), "probed": time.time()}
+                self._write(endpoint, name, result)
+            self._lock.acquire()
+            try:
+                self._results.setdefault(endpoint, { })[name] = result
+            finally:
+                self._lock.release()
+        return result["value"]
+
+    def invalidate(self, endpoint=None):
+        """
+        Forget the results for endpoint, or for every endpoint, so that they are probed again.
+        """
+        self._lock.acquire()
+        try:
+            if endpoint is None:
+                self._results = { }
+            else:
+                self._results.pop(endpoint, None)
+        finally:
+            self._lock.release()
+        if self.filename is None:
+            return
+        try:
+            fd = self._open_locked(fcntl.LOCK_EX)
+        except (IOError, OSError), e:
+            self.log.debug("Unable to open capability cache (%s): %s" % (self.filename, e))
+            return
+        try:
+            results = { }
+            if endpoint is not None:
+                results = self._load(fd)
+                results.pop(endpoint, None)
+            self._save(fd, results)
+        finally:
+            os.close(fd)
+
+    def _fresh(self, result):
+        if not isinstance(result, dict) or "probed" not in result:
+            return False
+        return self.ttl is None or time.time() - result["probed"] < self.ttl
+
+    def _read(self):
+        if self.filename is None or not os.path.isfile(self.filename):
+            return { }
+        try:
+            fd = self._open_locked(fcntl.LOCK_SH)
+        except (IOError, OSError), e:
+            self.log.debug("Unable to open capability cache (%s): %s" % (self.filename, e))
+            return { }
+        try:
+            return self._load(fd)
+        finally:
+            os.close(fd)
+
+    def _write(self, endpoint, name, result):
+        if self.filename is None:
+            return
+        try:
+            fd = self._open_locked(fcntl.LOCK_EX)
+        except (IOError, OSError), e:
+            self.log.debug("Unable to open capability cache (%s) - keeping results in memory: %s" %
+                           (self.filename, e))
+            return
+        try:
+            results = self._load(fd)
+            results.setdefault(endpoint, { })[name] = result
+            self._save(fd, results)
+        finally:
+            os.close(fd)
+
+    def _open_locked(self, operation):
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0755)
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, operation)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def _load(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = ""
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+        if not data:
+            return { }
+        try:
+            results = json.loads(data)
+        except ValueError:
+            self.log.warning("Ignoring unreadable capability cache (%s)" % self.filename)
+            return { }
+        if not isinstance(results, dict):
+            return { }
+        return results
+
+    def _save(self, fd, results):
+        data = json.dumps(results)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.ftruncate(fd, 0)
+        os.write(fd, data)
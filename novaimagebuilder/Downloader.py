@@ -0,0 +1,471 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import hashlib
+import json
+import os
+import os.path
+import time
+import email.utils
+import pycurl
+
+
+class Downloader(object):
+    """
+    Segmented, resumable downloader for install media and other large objects.
+
+    Objects of at least SEGMENT_MIN_SIZE on servers that accept byte ranges are split into
+    up to CONNECTIONS HTTP Range requests which are fetched in parallel.  Data is written to
+    <filename>.part and progress is recorded in <filename>.part.state, so an interrupted
+    download picks up where it stopped.  The file only appears under its final name once
+    every byte has arrived.  Servers that do not honour ranges get a single stream.
+
+    The ETag and Last-Modified date of the object are kept so that a cached copy can later be
+    checked against the server with revalidate().
+
+    The SHA-256 of the object is computed while it streams in.  Bytes that arrive in order are
+    hashed straight from the network buffer; bytes of later segments are hashed as soon as
+    the contiguous part of the file reaches them, while they are still in the page cache.
+    Only a resumed download has to hash the part it already had on disk.
+
+    @param url: Location to download from
+    @param filename: Local path the completed download is stored under
+    @param connections: Maximum number of parallel connections (default: CONNECTIONS)
+    @param expected_sha256: Optional hex SHA-256 the completed object must match
+    @param reserve_space: Optional function called with the number of bytes still to be
+    downloaded, once known, before any of them are written
+    @param transfer: Optional TransferScheduler Transfer every byte received is counted against,
+    holding the download to the rates of the scheduler
+    """
+
+    CONNECTIONS = 4
+    SEGMENT_MIN_SIZE = 32 * 1024 * 1024
+    CONNECT_TIMEOUT = 15
+    # Connections slower than LOW_SPEED_LIMIT bytes/s for LOW_SPEED_TIME seconds are dropped and retried
+    LOW_SPEED_LIMIT = 1024
+    LOW_SPEED_TIME = 60
+    RETRIES = 3
+    STATE_SAVE_INTERVAL = 5
+    # Most bytes hashed back from the .part file per pass through the transfer loop
+    HASH_CATCHUP_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, url, filename, connections=None, expected_sha256=None, reserve_space=None, transfer=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.url = url
+        self.filename = filename
+        self.part_filename = filename + ".part"
+        self.state_filename = filename + ".part.state"
+        self.connections = connections or self.CONNECTIONS
+        self.size = None
+        self.validator = None
+        self.etag = None
+        self.last_modified = None
+        self.ranges = False
+        self.expected_sha256 = expected_sha256
+        self.reserve_space = reserve_space
+        self.transfer = transfer
+        self.sha256 = None
+        self._ranges_ignored = False
+        self._hash = None
+        self._hashed = 0
+
+    def download(self):
+        """
+        Fetch the object, resuming a previous partial download of the same object if possible.
+
+        @return: Path of the completed file
+        """
+        if self.url.split(':', 1)[0].lower() in ('http', 'https'):
+            self._probe()
+        elif self.url.startswith('file://'):
+            self.last_modified = self._file_last_modified()
+
+        segments = self._resume_segments()
+        if segments is None:
+            if self.reserve_space and self.size is not None:
+                self.reserve_space(self.size)
+            segments = self._plan_segments()
+            self._create_part_file()
+        else:
+            done = sum([segment['done'] for segment in segments])
+            self.log.debug("Resuming download of (%s) at %d of %d bytes" % (self.url, done, self.size))
+            if self.reserve_space:
+                self.reserve_space(self.size - done)
+
+        if not self._fetch(segments):
+            self.log.warning("Server for (%s) ignored byte range request - falling back to a single stream" %
+                             self.url)
+            self.ranges = False
+            segments = self._plan_segments()
+            self._create_part_file()
+            if not self._fetch(segments):
+                raise Exception("Unable to download (%s)" % self.url)
+
+        received = sum([segment['done'] for segment in segments])
+        if self.size is not None and received != self.size:
+            raise Exception("Download of (%s) is incomplete: got %d of %d bytes" % (self.url, received, self.size))
+        self.size = received
+
+        while self._advance_hash(segments, None):
+            pass
+        self.sha256 = self._hash.hexdigest()
+        if self.expected_sha256 and self.sha256 != self.expected_sha256.lower():
+            # Do not keep or resume a download we know to be bad
+            os.remove(self.part_filename)
+            self._remove_state()
+            raise Exception("Checksum mismatch for (%s): expected sha256 %s but got %s" %
+                            (self.url, self.expected_sha256, self.sha256))
+
+        os.rename(self.part_filename, self.filename)
+        self._remove_state()
+        self.log.debug("Finished download of (%s) to (%s)" % (self.url, self.filename))
+        return self.filename
+
+    def _probe(self):
+        """
+        Ask the server for the size of the object, whether it accepts byte ranges and a
+        validator we can use to make sure a partial download belongs to the same object.
+        """
+        headers = {}
+
+        def _header(line):
+            if line.startswith('HTTP/'):
+                # Start of a new response after a redirect
+                headers.clear()
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        c = pycurl.Curl()
+        try:
+            c.setopt(c.URL, self.url)
+            c.setopt(c.NOBODY, 1)
+            c.setopt(c.FOLLOWLOCATION, 1)
+            c.setopt(c.CONNECTTIMEOUT, self.CONNECT_TIMEOUT)
+            c.setopt(c.NOSIGNAL, 1)
+            c.setopt(c.HEADERFUNCTION, _header)
+            c.perform()
+            response_code = c.getinfo(c.RESPONSE_CODE)
+            size = c.getinfo(c.CONTENT_LENGTH_DOWNLOAD)
+        except pycurl.error, e:
+            self.log.debug("Unable to probe (%s) - using a single stream: %s" % (self.url, e))
+            return
+        finally:
+            c.close()
+
+        if response_code >= 400:
+            self.log.debug("Probe of (%s) returned %d - using a single stream" % (self.url, response_code))
+            return
+        if size >= 0:
+            self.size = int(size)
+        self.etag = headers.get('etag')
+        self.last_modified = headers.get('last-modified')
+        self.validator = self.etag or self.last_modified
+        self.ranges = self.size is not None and headers.get('accept-ranges', '').lower() == 'bytes'
+
+    def revalidate(self, etag=None, last_modified=None):
+        """
+        Check whether the object is still the one that was fetched with the given validators,
+        using a conditional GET.  An unchanged object costs a single round trip and the body
+        of a changed one is never read.  file:// objects are checked against their mtime.
+
+        @param etag: ETag the object had when it was fetched
+        @param last_modified: Last-Modified date the object had when it was fetched
+        @return: True if the object is unchanged, False if it has changed or has no validators
+        to check.  The current validators are left in etag and last_modified.
+        """
+        if self.url.startswith('file://'):
+            self.last_modified = self._file_last_modified()
+            return last_modified is not None and last_modified == self.last_modified
+        if not (etag or last_modified):
+            return False
+
+        headers = {}
+
+        def _header(line):
+            if line.startswith('HTTP/'):
+                headers.clear()
+            elif ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        def _data(buf):
+            # The object has changed - it is fetched again separately, so stop right away
+            return 0
+
+        request_headers = []
+        if etag:
+            request_headers.append('If-None-Match: %s' % etag)
+        if last_modified:
+            request_headers.append('If-Modified-Since: %s' % last_modified)
+        c = pycurl.Curl()
+        try:
+            c.setopt(c.URL, self.url)
+            c.setopt(c.HTTPHEADER, request_headers)
+            c.setopt(c.FOLLOWLOCATION, 1)
+            c.setopt(c.CONNECTTIMEOUT, self.CONNECT_TIMEOUT)
+            c.setopt(c.NOSIGNAL, 1)
+            c.setopt(c.HEADERFUNCTION, _header)
+            c.setopt(c.WRITEFUNCTION, _data)
+            try:
+                c.perform()
+            except pycurl.error, e:
+                if e.args[0] != pycurl.E_WRITE_ERROR:
+                    raise Exception("Unable to revalidate (%s): %s" % (self.url, e))
+            response_code = c.getinfo(c.RESPONSE_CODE)
+        finally:
+            c.close()
+
+        if response_code >= 400:
+            raise Exception("Unable to revalidate (%s): server returned %d" % (self.url, response_code))
+        # A 304 may leave out validators that did not change
+        self.etag = headers.get('etag', etag if response_code == 304 else None)
+        self.last_modified = headers.get('last-modified', last_modified if response_code == 304 else None)
+        return response_code == 304
+
+    def _file_last_modified(self):
+        return email.utils.formatdate(os.path.getmtime(self.url[len('file://'):]), usegmt=True)
+
+    def _plan_segments(self):
+        if not self.ranges:
+            end = None
+            if self.size is not None:
+                end = self.size - 1
+            return [{'start': 0, 'end': end, 'done': 0}]
+
+        count = max(1, min(self.connections, self.size / self.SEGMENT_MIN_SIZE))
+        length = self.size / count
+        segments = []
+        for index in range(count):
+            start = index * length
+            if index == count - 1:
+                end = self.size - 1
+            else:
+                end = start + length - 1
+            segments.append({'start': start, 'end': end, 'done': 0})
+        return segments
+
+    def _create_part_file(self):
+        part_file = open(self.part_filename, 'wb')
+        if self.size is not None:
+            # Sparse file of the final size so that segments can be written in place
+            part_file.truncate(self.size)
+        part_file.close()
+        self._save_state(None)
+
+    def _resume_segments(self):
+        """
+        @return: The segment list of an earlier, interrupted download of this same object, or None
+        """
+        if not (os.path.isfile(self.part_filename) and os.path.isfile(self.state_filename)):
+            return None
+        try:
+            state_file = open(self.state_filename)
+            try:
+                state = json.load(state_file)
+            finally:
+                state_file.close()
+        except ValueError:
+            state = {}
+
+        if not self.ranges or state.get('segments') is None or state.get('url') != self.url or \
+                state.get('size') != self.size or state.get('validator') != self.validator or \
+                os.path.getsize(self.part_filename) != self.size:
+            self.log.debug("Discarding partial download (%s) - it cannot be resumed" % self.part_filename)
+            return None
+        return state['segments']
+
+    def _save_state(self, segments):
+        state = {'url': self.url, 'size': self.size, 'validator': self.validator, 'segments': segments}
+        state_file = open(self.state_filename + ".tmp", 'w')
+        json.dump(state, state_file)
+        state_file.close()
+        os.rename(self.state_filename + ".tmp", self.state_filename)
+
+    def _remove_state(self):
+        if os.path.exists(self.state_filename):
+            os.remove(self.state_filename)
+
+    def _segment_remaining(self, segment):
+        if segment['end'] is None:
+            return None
+        return segment['end'] + 1 - segment['start'] - segment['done']
+
+    def _fetch(self, segments):
+        """
+        Run all incomplete segments to completion over a single CurlMulti.
+
+        @return: False if the server answered a byte range request with the whole object
+        """
+        multi = pycurl.CurlMulti()
+        active = {}
+        self._ranges_ignored = False
+        self._hash = hashlib.sha256()
+        self._hashed = 0
+        try:
+            for segment in segments:
+                if self._segment_remaining(segment) != 0:
+                    self._start_segment(multi, active, segment)
+
+            last_save = time.time()
+            while active:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+                while True:
+                    num_queued, ok_list, err_list = multi.info_read()
+                    for c in ok_list:
+                        self._finish_segment(multi, active, c, None)
+                    for c, errno, errmsg in err_list:
+                        self._finish_segment(multi, active, c, errmsg)
+                    if num_queued == 0:
+                        break
+                if self._ranges_ignored:
+                    return False
+                self._advance_hash(segments, self.HASH_CATCHUP_SIZE)
+                if time.time() - last_save > self.STATE_SAVE_INTERVAL:
+                    self._save_state(segments)
+                    last_save = time.time()
+                    if self.size:
+                        done = sum([segment['done'] for segment in segments])
+                        self.log.debug("Downloaded %d%% of (%s)" % (done * 100 / self.size, self.url))
+                if active:
+                    multi.select(1.0)
+        finally:
+            for c in active.keys():
+                multi.remove_handle(c)
+                c.close()
+                active[c]['file'].close()
+            multi.close()
+            if not self._ranges_ignored and self.ranges:
+                self._save_state(segments)
+        return True
+
+    def _start_segment(self, multi, active, segment, retries=0):
+        position = segment['start'] + segment['done']
+        # Unbuffered, so that whatever is counted as done - in the saved state, or by the hash
+        # reading the .part file back - really is in the file
+        part_file = open(self.part_filename, 'r+b', 0)
+        part_file.seek(position)
+        if segment['end'] is None:
+            # Restarting a stream of unknown length - drop whatever an earlier attempt left behind
+            part_file.truncate()
+        ranged = position > 0 or (segment['end'] is not None and segment['end'] + 1 != self.size)
+
+        # getinfo() is not allowed from inside callbacks, so track the status line ourselves
+        response = {'code': None}
+
+        def _header(line):
+            if line.startswith('HTTP/'):
+                fields = line.split()
+                if len(fields) > 1 and fields[1].isdigit():
+                    response['code'] = int(fields[1])
+
+        def _data(buf):
+            if ranged and response['code'] == 200:
+                # The server sent the whole object instead of our range - abort this transfer
+                self._ranges_ignored = True
+                return 0
+            if self.transfer is not None:
+                self.transfer.consume(len(buf))
+            remaining = self._segment_remaining(segment)
+            if remaining is not None and len(buf) > remaining:
+                buf = buf[:remaining]
+            if segment['start'] + segment['done'] == self._hashed:
+                self._hash.update(buf)
+                self._hashed += len(buf)
+            part_file.write(buf)
+            segment['done'] += len(buf)
+
+        c = pycurl.Curl()
+        c.setopt(c.URL, self.url)
+        c.setopt(c.CONNECTTIMEOUT, self.CONNECT_TIMEOUT)
+        c.setopt(c.LOW_SPEED_LIMIT, self.LOW_SPEED_LIMIT)
+        c.setopt(c.LOW_SPEED_TIME, self.LOW_SPEED_TIME)
+        c.setopt(c.HEADERFUNCTION, _header)
+        c.setopt(c.WRITEFUNCTION, _data)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        c.setopt(c.FAILONERROR, 1)
+        c.setopt(c.NOSIGNAL, 1)
+        if ranged:
+            if segment['end'] is None:
+                c.setopt(c.RANGE, "%d-" % position)
+            else:
+                c.setopt(c.RANGE, "%d-%d" % (position, segment['end']))
+        multi.add_handle(c)
+        active[c] = {'segment': segment, 'file': part_file, 'retries': retries}
+
+    def _finish_segment(self, multi, active, c, error):
+        transfer = active.pop(c)
+        multi.remove_handle(c)
+        c.close()
+        transfer['file'].close()
+        if self._ranges_ignored:
+            return
+
+        segment = transfer['segment']
+        remaining = self._segment_remaining(segment)
+        if error is None and not remaining:
+            return
+
+        if error is None:
+            error = "connection closed with %d bytes outstanding" % remaining
+        if transfer['retries'] >= self.RETRIES:
+            raise Exception("Failed to download (%s): %s" % (self.url, error))
+        self.log.warning("Retrying segment at %d of (%s): %s" % (segment['start'], self.url, error))
+        if not self.ranges:
+            # No way to pick up in the middle - start the stream over
+            segment['done'] = 0
+            self._hash = hashlib.sha256()
+            self._hashed = 0
+        self._start_segment(multi, active, segment, transfer['retries'] + 1)
+
+    def _advance_hash(self, segments, limit):
+        """
+        Hash data that is already in the .part file but arrived ahead of the contiguous
+        region hashed so far.
+
+        @param limit: Maximum number of bytes to read back, or None for no limit
+        @return: Number of bytes hashed
+        """
+        available = 0
+        for segment in segments:
+            if segment['start'] <= self._hashed <= segment['start'] + segment['done']:
+                available = segment['start'] + segment['done'] - self._hashed
+                # A finished segment runs straight into the next one
+                if self._segment_remaining(segment) != 0 or segment is segments[-1]:
+                    break
+        if available <= 0:
+            return 0
+        if limit is not None:
+            available = min(available, limit)
+
+        start = self._hashed
+        part_file = open(self.part_filename, 'rb')
+        try:
+            part_file.seek(self._hashed)
+            while available > 0:
+                buf = part_file.read(min(available, 1024 * 1024))
+                if not buf:
+                    break
+                self._hash.update(buf)
+                self._hashed += len(buf)
+                available -= len(buf)
+        finally:
+            part_file.close()
+        return self._hashed - start
@@ -0,0 +1,228 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import hashlib
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import os.path
+import email.utils
+
+
+class FileCopier(object):
+    """
+    Copy a local file - on the same machine or an NFS mount - into the cache with as little
+    data movement as the filesystems allow.  The methods below are tried in order:
+
+    reflink: the copy shares the extents of the source until either is modified (FICLONE,
+    btrfs, XFS and others).  Instant, and uses no space.
+    hardlink: only if link is set, as the copy is then the very same file as the source and
+    changes to one show up in the other.
+    copy_file_range: the kernel copies the data without passing it through user space, and
+    NFS 4.2 servers copy it on the server side.
+    sendfile: the kernel copies the data between the page caches of the two files.
+    read/write: a plain streaming copy.
+
+    Like Downloader, the copy is made to <filename>.part and only appears under its final
+    name once complete, and the SHA-256 of the content is computed along the way.  The
+    methods that do not pass the data through user space read it once more to hash it, which
+    is still far cheaper than reading and writing it.
+
+    @param path: Path of the source file
+    @param filename: Local path the copy is stored under
+    @param expected_sha256: Optional hex SHA-256 the copy must match
+    @param reserve_space: Optional function called with the number of bytes about to be
+    written, before the data is actually copied
+    @param link: bool allowing the copy to be a hard link to the source
+    """
+
+    # Linux ioctl sharing the extents of one file with another - _IOW(0x94, 9, int)
+    FICLONE = 0x40049409
+    # Most bytes handed to a single copy_file_range() or sendfile() call
+    CHUNK_SIZE = 64 * 1024 * 1024
+    # Buffer size for reading and writing, and hashing
+    BUFFER_SIZE = 1024 * 1024
+    # Errors that mean a method is not available for this pair of files
+    UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+                          errno.EBADF, errno.EPERM)
+
+    _libc = None
+
+    def __init__(self, path, filename, expected_sha256=None, reserve_space=None, link=False):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.path = path
+        self.filename = filename
+        self.part_filename = filename + ".part"
+        self.expected_sha256 = expected_sha256
+        self.reserve_space = reserve_space
+        self.link = link
+        self.size = None
+        self.sha256 = None
+        self.etag = None
+        self.last_modified = None
+        # Method the copy was made with, once complete
+        self.method = None
+
+    def copy(self):
+        """
+        @return: Path of the completed copy
+        """
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+        if os.path.exists(self.part_filename):
+            os.remove(self.part_filename)
+
+        hashed = False
+        if self.link and self._hardlink():
+            self.method = "hardlink"
+        else:
+            source = open(self.path, 'rb')
+            try:
+                target = open(self.part_filename, 'wb')
+                try:
+                    if self._reflink(source, target):
+                        self.method = "reflink"
+                    else:
+                        if self.reserve_space:
+                            self.reserve_space(self.size)
+                        for (method, function) in (("copy_file_range", self._copy_file_range),
+                                                   ("sendfile", self._sendfile)):
+                            if function(source, target):
+                                self.method = method
+                                break
+                        if self.method is None:
+                            self._stream(source, target)
+                            self.method = "read/write"
+                            hashed = True
+                finally:
+                    target.close()
+            except:
+                if os.path.exists(self.part_filename):
+                    os.remove(self.part_filename)
+                raise
+            finally:
+                source.close()
+
+        if not hashed:
+            self.sha256 = self._hash(self.part_filename)
+        copied = os.path.getsize(self.part_filename)
+        if copied != self.size:
+            os.remove(self.part_filename)
+            raise Exception("Copy of (%s) is incomplete: got %d of %d bytes" % (self.path, copied, self.size))
+        if self.expected_sha256 and self.sha256 != self.expected_sha256.lower():
+            os.remove(self.part_filename)
+            raise Exception("Checksum mismatch for (%s): expected sha256 %s but got %s" %
+                            (self.path, self.expected_sha256, self.sha256))
+        os.rename(self.part_filename, self.filename)
+        self.log.debug("Copied (%s) to (%s) by %s" % (self.path, self.filename, self.method))
+        return self.filename
+
+    def _unsupported(self, method, e):
+        if e.errno not in self.UNSUPPORTED_ERRORS:
+            raise
+        self.log.debug("Unable to copy (%s) by %s: %s" % (self.path, method, os.strerror(e.errno)))
+        return False
+
+    def _hardlink(self):
+        try:
+            os.link(self.path, self.part_filename)
+            return True
+        except OSError, e:
+            return self._unsupported("hardlink", e)
+
+    def _reflink(self, source, target):
+        try:
+            fcntl.ioctl(target.fileno(), self.FICLONE, source.fileno())
+            return True
+        except IOError, e:
+            return self._unsupported("reflink", e)
+
+    @classmethod
+    def _libc_function(cls, name):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        return getattr(cls._libc, name, None)
+
+    def _kernel_copy(self, method, source, target, call):
+        """
+        Run a copy that happens inside the kernel to completion, restarting from scratch if
+        it turns out not to be supported.
+
+        @param call: function taking the number of bytes to copy and returning the number copied
+        @return: False if the method is not supported
+        """
+        copied = 0
+        while copied < self.size:
+            done = call(min(self.CHUNK_SIZE, self.size - copied))
+            if done < 0:
+                e = ctypes.get_errno()
+                if copied == 0 and e in self.UNSUPPORTED_ERRORS:
+                    self.log.debug("Unable to copy (%s) by %s: %s" % (self.path, method, os.strerror(e)))
+                    return False
+                raise OSError(e, "%s of (%s) failed: %s" % (method, self.path, os.strerror(e)))
+            if done == 0:
+                break
+            copied += done
+        return True
+
+    def _copy_file_range(self, source, target):
+        function = self._libc_function("copy_file_range")
+        if function is None:
+            return False
+        function.restype = ctypes.c_ssize_t
+        function.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_uint)
+        return self._kernel_copy("copy_file_range", source, target,
+                                 lambda length: function(source.fileno(), None, target.fileno(), None, length, 0))
+
+    def _sendfile(self, source, target):
+        function = self._libc_function("sendfile")
+        if function is None:
+            return False
+        function.restype = ctypes.c_ssize_t
+        function.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t)
+        return self._kernel_copy("sendfile", source, target,
+                                 lambda length: function(target.fileno(), source.fileno(), None, length))
+
+    def _stream(self, source, target):
+        sha256 = hashlib.sha256()
+        source.seek(0)
+        target.seek(0)
+        target.truncate()
+        while True:
+            buf = source.read(self.BUFFER_SIZE)
+            if not buf:
+                break
+            sha256.update(buf)
+            target.write(buf)
+        self.sha256 = sha256.hexdigest()
+
+    def _hash(self, filename):
+        sha256 = hashlib.sha256()
+        local_file = open(filename, 'rb')
+        try:
+            while True:
+                buf = local_file.read(self.BUFFER_SIZE)
+                if not buf:
+                    break
+                sha256.update(buf)
+        finally:
+            local_file.close()
+        return sha256.hexdigest()
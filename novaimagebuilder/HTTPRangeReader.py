@@ -0,0 +1,143 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import pycurl
+from collections import OrderedDict
+from cStringIO import StringIO
+from Downloader import Downloader
+
+
+class HTTPRangeReader(object):
+    """
+    Random access to a remote object through HTTP Range requests.  Instances are called
+    with an offset and a length and return those bytes, which makes them usable as the
+    source of an ISOReader.
+
+    Small reads, such as the volume descriptors and directories of an ISO, are rounded out
+    to whole blocks of BLOCK_SIZE which are kept in a least recently used cache of
+    CACHE_BLOCKS blocks.  Large reads, such as file extents, go straight to the server
+    without passing through the cache.  A single connection is kept open for all requests.
+
+    @param url: Location of the object
+    @param transfer: Optional TransferScheduler Transfer every byte received is counted against
+    """
+
+    BLOCK_SIZE = 64 * 1024
+    CACHE_BLOCKS = 256
+    # Reads of at least this many bytes bypass the block cache
+    DIRECT_READ_SIZE = 4 * BLOCK_SIZE
+
+    def __init__(self, url, transfer=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.url = url
+        # Size of the object, known after the first request
+        self.size = None
+        self.requests = 0
+        self.bytes_fetched = 0
+        self._blocks = OrderedDict()
+        self._curl = None
+        self._transfer = transfer
+
+    def __call__(self, offset, length):
+        if self.size is not None:
+            length = max(0, min(length, self.size - offset))
+        if length == 0:
+            return ''
+        if length >= self.DIRECT_READ_SIZE:
+            return self._fetch(offset, length)
+
+        first = offset / self.BLOCK_SIZE
+        last = (offset + length - 1) / self.BLOCK_SIZE
+        missing = [ block for block in range(first, last + 1) if block not in self._blocks ]
+        if missing:
+            # Contiguous read covering every block we do not have yet
+            start = missing[0] * self.BLOCK_SIZE
+            data = self._fetch(start, (missing[-1] + 1) * self.BLOCK_SIZE - start)
+            for block in missing:
+                position = block * self.BLOCK_SIZE - start
+                self._blocks[block] = data[position:position + self.BLOCK_SIZE]
+        pieces = [ ]
+        for block in range(first, last + 1):
+            data = self._blocks.pop(block)
+            # Re-insert to mark the block as most recently used
+            self._blocks[block] = data
+            pieces.append(data)
+        while len(self._blocks) > self.CACHE_BLOCKS:
+            self._blocks.popitem(last=False)
+        position = offset - first * self.BLOCK_SIZE
+        return ''.join(pieces)[position:position + length]
+
+    def close(self):
+        if self._curl is not None:
+            self._curl.close()
+            self._curl = None
+
+    def _fetch(self, offset, length):
+        if self.size is not None:
+            length = max(0, min(length, self.size - offset))
+            if length == 0:
+                return ''
+        response = {'code': None, 'range': None}
+
+        def _header(line):
+            if line.startswith('HTTP/'):
+                fields = line.split()
+                response['range'] = None
+                if len(fields) > 1 and fields[1].isdigit():
+                    response['code'] = int(fields[1])
+            elif line.lower().startswith('content-range:'):
+                response['range'] = line.split(':', 1)[1].strip()
+
+        body = StringIO()
+
+        def _data(buf):
+            if response['code'] != 206:
+                # The server is sending the whole object - stop right away
+                return 0
+            if self._transfer is not None:
+                self._transfer.consume(len(buf))
+            body.write(buf)
+
+        if self._curl is None:
+            self._curl = pycurl.Curl()
+        c = self._curl
+        c.setopt(c.URL, self.url)
+        c.setopt(c.CONNECTTIMEOUT, Downloader.CONNECT_TIMEOUT)
+        c.setopt(c.LOW_SPEED_LIMIT, Downloader.LOW_SPEED_LIMIT)
+        c.setopt(c.LOW_SPEED_TIME, Downloader.LOW_SPEED_TIME)
+        c.setopt(c.HEADERFUNCTION, _header)
+        c.setopt(c.WRITEFUNCTION, _data)
+        c.setopt(c.FOLLOWLOCATION, 1)
+        c.setopt(c.FAILONERROR, 1)
+        c.setopt(c.NOSIGNAL, 1)
+        c.setopt(c.RANGE, "%d-%d" % (offset, offset + length - 1))
+        try:
+            c.perform()
+        except pycurl.error, e:
+            if response['code'] is not None and response['code'] != 206:
+                raise Exception("Server for (%s) does not support byte range requests" % self.url)
+            raise Exception("Range request for (%s) failed: %s" % (self.url, e))
+        if response['code'] != 206:
+            raise Exception("Server for (%s) does not support byte range requests" % self.url)
+        if response['range'] and '/' in response['range']:
+            total = response['range'].rsplit('/', 1)[1]
+            if total.isdigit():
+                self.size = int(total)
+        self.requests += 1
+        data = body.getvalue()
+        self.bytes_fetched += len(data)
+        return data
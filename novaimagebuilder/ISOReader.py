@@ -0,0 +1,331 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import mmap
+import os
+import struct
+
+
+class ISOReader(object):
+    """
+    Read-only access to the files on an ISO9660 image without mounting it or starting a
+    libguestfs appliance.  Names are resolved using the Rock Ridge extension when present,
+    then Joliet, then plain ISO9660 names, which are matched without regard to case or
+    version suffix.  File data is read straight from the extents recorded in the directory.
+
+    The image is read through a function of (offset, length), so it does not have to be a
+    local file.  A local image is memory mapped.
+
+    @param source: Path of an ISO image, or a function taking an offset and a length and
+    returning that many bytes of the image
+    """
+
+    SECTOR_SIZE = 2048
+    # Largest number of bytes returned by each step of read_file()
+    CHUNK_SIZE = 1024 * 1024
+    # Joliet supplementary volume descriptors carry one of these UCS-2 escape sequences
+    JOLIET_ESCAPES = ('%/@', '%/C', '%/E')
+    # Symbolic links followed while resolving a single path
+    MAX_SYMLINKS = 16
+    FLAG_DIRECTORY = 0x02
+    FLAG_MULTI_EXTENT = 0x80
+
+    def __init__(self, source):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self._file = None
+        self._map = None
+        if callable(source):
+            self._read = source
+        else:
+            self._file = open(source, 'rb')
+            size = os.fstat(self._file.fileno()).st_size
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+            self._read = self._read_map
+        self.block_size = self.SECTOR_SIZE
+        self.volume_id = None
+        self.primary_root = None
+        self.joliet_root = None
+        # Rock Ridge: number of bytes to skip at the start of each system use area, or None
+        self.rock_ridge_skip = None
+        self._read_volume_descriptors()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_map(self, offset, length):
+        return self._map[offset:offset + length]
+
+    def _read_volume_descriptors(self):
+        sector = 16
+        while True:
+            descriptor = self._read(sector * self.SECTOR_SIZE, self.SECTOR_SIZE)
+            if len(descriptor) < self.SECTOR_SIZE or descriptor[1:6] != "CD001":
+                raise Exception("Not an ISO9660 image: no volume descriptor at sector %d" % sector)
+            desc_type = ord(descriptor[0])
+            if desc_type == 1 and self.primary_root is None:
+                self.block_size = struct.unpack("<H", descriptor[128:130])[0]
+                self.volume_id = descriptor[40:72].strip()
+                self.primary_root = self._parse_record(descriptor[156:190], False)
+            elif desc_type == 2 and descriptor[88:91] in self.JOLIET_ESCAPES:
+                self.joliet_root = self._parse_record(descriptor[156:190], True)
+            elif desc_type == 255:
+                break
+            sector += 1
+        if self.primary_root is None:
+            raise Exception("Not an ISO9660 image: no primary volume descriptor")
+        self._detect_rock_ridge()
+
+    def _detect_rock_ridge(self):
+        # Rock Ridge is announced by an SP entry in the "." record of the root directory
+        first = self._read(self.primary_root['extent'] * self.block_size, self.block_size)
+        length = ord(first[0])
+        if length == 0:
+            return
+        name_length = ord(first[32])
+        system_use = first[33 + name_length + (1 - name_length % 2):length]
+        if system_use[0:2] == "SP" and system_use[4:6] == "\xbe\xef":
+            self.rock_ridge_skip = ord(system_use[6])
+
+    def _parse_record(self, data, joliet):
+        (extent, ) = struct.unpack("<L", data[2:6])
+        (size, ) = struct.unpack("<L", data[10:14])
+        flags = ord(data[25])
+        name_length = ord(data[32])
+        raw_name = data[33:33 + name_length]
+        if raw_name in ("\x00", "\x01"):
+            name = raw_name
+        elif joliet:
+            name = raw_name.decode("utf-16-be").encode("utf-8")
+        else:
+            name = raw_name
+        record = {'name': name, 'extent': extent, 'size': size, 'flags': flags,
+                  'extents': [ (extent, size) ], 'symlink': None, 'joliet': joliet, 'alternate': False}
+        if self.rock_ridge_skip is not None and not joliet:
+            system_use = data[33 + name_length + (1 - name_length % 2) + self.rock_ridge_skip:]
+            self._parse_rock_ridge(record, system_use)
+        return record
+
+    def _parse_rock_ridge(self, record, system_use):
+        """
+        Pick the alternate name (NM) and symbolic link target (SL) out of the SUSP entries
+        of a directory record, following continuation areas (CE).
+        """
+        name = None
+        link = None
+        areas = [ system_use ]
+        while areas:
+            area = areas.pop(0)
+            position = 0
+            while position + 4 <= len(area):
+                signature = area[position:position + 2]
+                length = ord(area[position + 2])
+                if length < 4:
+                    break
+                data = area[position + 4:position + length]
+                if signature == "NM":
+                    if name is None:
+                        name = ""
+                    if not ord(data[0]) & 0x06:
+                        name += data[1:]
+                elif signature == "SL":
+                    if link is None:
+                        link = [ ]
+                    link.append(data)
+                elif signature == "CE":
+                    (block, offset, continued) = struct.unpack("<L4xL4xL", data[0:20])
+                    areas.append(self._read(block * self.block_size + offset, continued))
+                elif signature == "ST":
+                    break
+                position += length
+        if name:
+            record['name'] = name
+            record['alternate'] = True
+        if link is not None:
+            record['symlink'] = self._symlink_target(link)
+
+    def _symlink_target(self, entries):
+        components = [ ]
+        continued = False
+        for data in entries:
+            position = 1
+            while position + 2 <= len(data):
+                flags = ord(data[position])
+                length = ord(data[position + 1])
+                content = data[position + 2:position + 2 + length]
+                if flags & 0x02:
+                    content = "."
+                elif flags & 0x04:
+                    content = ".."
+                elif flags & 0x08:
+                    content = ""
+                    components = [ ]
+                if continued:
+                    components[-1] += content
+                else:
+                    components.append(content)
+                continued = bool(flags & 0x01)
+                position += 2 + length
+        if components and components[0] == "":
+            return "/" + "/".join(components[1:])
+        return "/".join(components)
+
+    def _records(self, directory):
+        """
+        @return: list of the records of a directory, without "." and "..", with the extents
+        of multi-extent files merged into one record
+        """
+        joliet = directory['joliet']
+        data = self._read(directory['extent'] * self.block_size, directory['size'])
+        records = [ ]
+        position = 0
+        while position < len(data):
+            length = ord(data[position])
+            if length == 0:
+                # Records do not cross sector boundaries - continue in the next sector
+                position = (position / self.block_size + 1) * self.block_size
+                continue
+            record = self._parse_record(data[position:position + length], joliet)
+            position += length
+            if record['name'] in ("\x00", "\x01"):
+                continue
+            if records and records[-1]['flags'] & self.FLAG_MULTI_EXTENT:
+                records[-1]['extents'].append((record['extent'], record['size']))
+                records[-1]['size'] += record['size']
+                records[-1]['flags'] = record['flags']
+                continue
+            records.append(record)
+        return records
+
+    def _match(self, record, name):
+        if record['joliet'] or record['alternate']:
+            return record['name'] == name
+        # Plain ISO9660 names are upper case and carry a version, eg. VMLINUZ.;1
+        plain = record['name'].split(';')[0]
+        if plain.endswith('.'):
+            plain = plain[:-1]
+        return plain.upper() == name.upper()
+
+    def _roots(self):
+        roots = [ ]
+        if self.rock_ridge_skip is not None:
+            roots.append(self.primary_root)
+        if self.joliet_root is not None:
+            roots.append(self.joliet_root)
+        if self.rock_ridge_skip is None:
+            roots.append(self.primary_root)
+        return roots
+
+    def _lookup(self, path):
+        for root in self._roots():
+            record = self._resolve(root, path, 0)
+            if record is not None:
+                return record
+        return None
+
+    def _resolve(self, root, path, symlinks):
+        parents = [ ]
+        current = root
+        components = [ component for component in path.split('/') if component not in ('', '.') ]
+        while components:
+            component = components.pop(0)
+            if component == '..':
+                if parents:
+                    current = parents.pop()
+                continue
+            if not current['flags'] & self.FLAG_DIRECTORY:
+                return None
+            found = None
+            for record in self._records(current):
+                if self._match(record, component):
+                    found = record
+                    break
+            if found is None:
+                return None
+            if found['symlink'] is not None:
+                symlinks += 1
+                if symlinks > self.MAX_SYMLINKS:
+                    raise Exception("Too many symbolic links resolving (%s)" % path)
+                target = found['symlink']
+                if target.startswith('/'):
+                    parents = [ ]
+                    current = root
+                components = [ part for part in target.split('/') if part not in ('', '.') ] + components
+                continue
+            parents.append(current)
+            current = found
+        return current
+
+    def exists(self, path):
+        return self._lookup(path) is not None
+
+    def listdir(self, path):
+        """
+        @return: list of the names in a directory
+        """
+        directory = self._lookup(path)
+        if directory is None or not directory['flags'] & self.FLAG_DIRECTORY:
+            raise Exception("No directory (%s) on ISO" % path)
+        return [ record['name'] for record in self._records(directory) ]
+
+    def getsize(self, path):
+        record = self._lookup(path)
+        if record is None:
+            raise Exception("No file (%s) on ISO" % path)
+        return record['size']
+
+    def extents(self, path):
+        """
+        @return: list of (offset, length) tuples locating the data of a file within the image
+        """
+        record = self._lookup(path)
+        if record is None or record['flags'] & self.FLAG_DIRECTORY:
+            raise Exception("No file (%s) on ISO" % path)
+        return [ (extent * self.block_size, length) for (extent, length) in record['extents'] ]
+
+    def read_file(self, path):
+        """
+        Generator returning the content of a file in chunks of at most CHUNK_SIZE bytes
+        """
+        for (offset, length) in self.extents(path):
+            while length > 0:
+                chunk = self._read(offset, min(length, self.CHUNK_SIZE))
+                if not chunk:
+                    raise Exception("ISO image ends inside (%s)" % path)
+                offset += len(chunk)
+                length -= len(chunk)
+                yield chunk
+
+    def extract(self, path, filename):
+        """
+        Copy a file from the image to a local file
+
+        @return: Number of bytes written
+        """
+        written = 0
+        local_file = open(filename, 'wb')
+        try:
+            for chunk in self.read_file(path):
+                local_file.write(chunk)
+                written += len(chunk)
+        finally:
+            local_file.close()
+        return written
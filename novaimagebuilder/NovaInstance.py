@@ -16,7 +16,9 @@
 
 import logging
 import os
-from time import sleep
+import time
+from Waiter import WaitTimeout
+from StatusMonitor import StatusMonitor
 
 
 class NovaInstance(object):
@@ -27,6 +29,13 @@ class NovaInstance(object):
     @param stack_env: An instance of novaimagebuilder.StackEnvironment to use for communication with OpenStack
     """
 
+    # Seconds to wait for the instance to become active before adding a floating IP
+    ACTIVE_TIMEOUT = 120
+    # Seconds to wait for a snapshot to become active, or None for ever
+    SNAPSHOT_TIMEOUT = None
+    # Seconds to wait for the instance to be deleted, or None for ever
+    TERMINATE_TIMEOUT = None
+
     def __init__(self, instance, stack_env, key_pair=None, floating_ip=False):
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
         self.last_disk_activity = 0
@@ -52,17 +61,20 @@ class NovaInstance(object):
 
         if floating_ip :
             # Wait for the instance to be active before assigning floaiting ip
-            for index in range(1, 120, 5):
-                status = self.stack_env.nova.servers.get(instance.id).status
-                if status == 'ACTIVE':
-                    self.add_floating_ip()
-                    return
-                elif status == 'ERROR':
-                    self.log.debug('Instance (%s: %s) has status %s.' % (instance.name, instance.id, instance.status))
-                    return
-                else:
-                    self.log.debug('Waiting for instance (%s) to become active...' % instance.name)
-                    sleep(5)
+            def _started(server):
+                if server.status in ('ACTIVE', 'ERROR'):
+                    return server.status
+            try:
+                status = self.stack_env.monitor.wait(StatusMonitor.SERVER, instance.id, _started,
+                                                     'instance (%s) to become active' % instance.name,
+                                                     self.ACTIVE_TIMEOUT)
+            except WaitTimeout, e:
+                self.log.debug(str(e))
+                return
+            if status == 'ACTIVE':
+                self.add_floating_ip()
+            else:
+                self.log.debug('Instance (%s: %s) has status %s.' % (instance.name, instance.id, status))
 
     @property
     def instance(self):
@@ -100,7 +112,8 @@ class NovaInstance(object):
         """
         disk_activity = 0
         net_activity = 0
-        diagnostics = self.instance.diagnostics()[1]
+        # Diagnostics are fetched by id, so there is no need to fetch the instance first
+        diagnostics = self._instance.diagnostics()[1]
         if not diagnostics:
             return 0, 0
         for key, value in diagnostics.items():
@@ -178,24 +191,21 @@ class NovaInstance(object):
             self.log.debug('Unable to check for disk and network activity. Setting timeout to 1 hour. %s' % e)
             _timeout = 216000
 
-        index = 0
-        while(True):
-            _status = self.status
-            if _status == 'SHUTOFF':
+        self.log.debug('Waiting for instance status SHUTOFF')
+        last_active = [ time.time() ]
+
+        def _shutoff(server):
+            self._instance = server
+            if server.status == 'SHUTOFF':
                 self.log.debug('Instance (%s) has entered SHUTOFF state' % self.id)
                 return True
-            if index % 10 == 0:
-                self.log.debug(
-                    'Waiting for instance status SHUTOFF')
-            if not self.is_active():
-                _timeout -= 1
-            else:
-                _timeout = timeout
-            if _timeout == 0:
+            if self.is_active():
+                last_active[0] = time.time()
+            elif time.time() - last_active[0] >= _timeout:
                 self.log.debug('Instance has become inactive but running. Please investigate the actual nova instance.')
                 return False
-            index += 1
-            sleep(1)
+        return self.stack_env.monitor.wait(StatusMonitor.SERVER, self.id, _shutoff,
+                                           'instance (%s) to enter SHUTOFF state' % self.id)
 
     def terminate(self):
         """
@@ -209,10 +219,14 @@ class NovaInstance(object):
         self._instance.delete()
         self.log.debug('Waiting for instance (%s) to be terminated.' % _id)
 
+        def _status(server):
+            self.log.debug('Nova instance %s has status %s...' % (_id, server.status))
         try:
-            while self.instance:
-                self.log.debug('Nova instance %s has status %s...' % (_id, self.status))
-                sleep(5)
+            # Only ends when the instance can no longer be fetched
+            self.stack_env.monitor.wait(StatusMonitor.SERVER, _id, _status, 'instance (%s) to be terminated' % _id,
+                                        self.TERMINATE_TIMEOUT)
+        except WaitTimeout, e:
+            self.log.warning(str(e))
         except:
             self.log.debug('Nova instance %s deleted.' % _id)
 
@@ -239,16 +253,17 @@ class NovaInstance(object):
         """
         snapshot_id = self._instance.create_image(image_name)
         self.log.debug('Waiting for glance image id (%s) to become active' % snapshot_id)
-        snapshot = self.stack_env.glance.images.get(snapshot_id)
-        while snapshot:
-            self.log.debug('Current image status: %s' % snapshot.status)
-            if snapshot.status == 'error':
+
+        def _active(image):
+            self.log.debug('Current image status: %s' % image.status)
+            if image.status == 'error':
                 raise Exception('Image entered error status while waiting for completion')
-            elif snapshot.status == 'active':
-                self.log.debug('Glance image id (%s) is now active' % snapshot_id)
-                break
-            sleep(2)
-            snapshot = self.stack_env.glance.images.get(snapshot_id)
+            elif image.status == 'active':
+                return image
+        snapshot = self.stack_env.monitor.wait(StatusMonitor.IMAGE, snapshot_id, _active,
+                                               'glance image id (%s) to become active' % snapshot_id,
+                                               self.SNAPSHOT_TIMEOUT)
+        self.log.debug('Glance image id (%s) is now active' % snapshot_id)
         metadata = {'is_public': public}
         properties = {}
         # remove all properties generated from snapshot
@@ -0,0 +1,127 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+import os
+import os.path
+from BlobStore import BlobStore
+
+
+class ObjectBlobStore(BlobStore):
+    """
+    BlobStore sharing its content through an S3 or Swift style object store.  Content is
+    used from a local copy under root as with BlobStore, and every piece of content stored
+    is also uploaded to the object store, unless it is there already.  Content missing
+    locally is downloaded from the object store, and checked against its SHA-256, before
+    anyone goes back to its source for it.  Removing content only drops the local copy -
+    what is kept in the object store is left to its own expiry policies.
+
+    The client is an object with the following methods, see SwiftObjectStore:
+        head(key): Size of the object key, or None if there is no such object
+        download(key, filename): Store the object key in the local file filename
+        upload(key, filename): Store the local file filename as the object key
+        read(key): Content of the small object key as a string, or None if there is no such object
+        write(key, data): Store the string data as the object key
+
+    @param root: Local directory the content is kept in
+    @param client: Client of the object store
+    """
+
+    shared = True
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, root, client):
+        super(ObjectBlobStore, self).__init__(root)
+        self.client = client
+
+    def _key(self, sha256):
+        return "sha256/%s" % sha256
+
+    def store(self, filename, sha256, size):
+        blob_filename = super(ObjectBlobStore, self).store(filename, sha256, size)
+        try:
+            if self.client.head(self._key(sha256)) != size:
+                self.log.debug("Uploading (%s) to the object store" % blob_filename)
+                self.client.upload(self._key(sha256), blob_filename)
+        except Exception, e:
+            # Other hosts lose out, but this one still has its local copy
+            self.log.warning("Unable to upload (%s) to the object store: %s" % (blob_filename, e))
+        return blob_filename
+
+    def fetch(self, sha256, size=None):
+        blob_filename = super(ObjectBlobStore, self).fetch(sha256, size)
+        if blob_filename is not None:
+            return blob_filename
+        try:
+            remote_size = self.client.head(self._key(sha256))
+        except Exception, e:
+            self.log.warning("Unable to look up (%s) in the object store: %s" % (sha256, e))
+            return None
+        if remote_size is None or (size is not None and remote_size != size):
+            return None
+        blob_filename = self.path(sha256)
+        part_filename = "%s.%d.part" % (blob_filename, os.getpid())
+        self._make_dirs(blob_filename)
+        self.log.debug("Downloading (%s) from the object store" % sha256)
+        try:
+            self.client.download(self._key(sha256), part_filename)
+            if self._file_sha256(part_filename) != sha256:
+                raise Exception("content does not match its SHA-256")
+        except Exception, e:
+            self.log.warning("Unable to download (%s) from the object store: %s" % (sha256, e))
+            if os.path.exists(part_filename):
+                os.remove(part_filename)
+            return None
+        os.rename(part_filename, blob_filename)
+        return blob_filename
+
+    def record_source(self, url, sha256, size, validators):
+        record = {"url": url, "sha256": sha256, "size": size}
+        record.update(validators)
+        try:
+            self.client.write(self._source_key(url), json.dumps(record))
+        except Exception, e:
+            self.log.warning("Unable to record the content of (%s) in the object store: %s" % (url, e))
+
+    def lookup_source(self, url):
+        try:
+            data = self.client.read(self._source_key(url))
+            if data is None:
+                return None
+            record = json.loads(data)
+        except Exception, e:
+            self.log.warning("Unable to look up the content of (%s) in the object store: %s" % (url, e))
+            return None
+        if record.get("url") != url:
+            return None
+        return record
+
+    def _source_key(self, url):
+        return "sources/%s" % hashlib.sha256(url).hexdigest()
+
+    def _file_sha256(self, filename):
+        sha256 = hashlib.sha256()
+        local_file = open(filename, 'rb')
+        try:
+            while True:
+                buf = local_file.read(self.BUFFER_SIZE)
+                if not buf:
+                    break
+                sha256.update(buf)
+        finally:
+            local_file.close()
+        return sha256.hexdigest()
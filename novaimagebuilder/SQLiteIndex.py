@@ -0,0 +1,174 @@
+#!/usr/bin/python
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import json
+import sqlite3
+
+
+class SQLiteIndex(dict):
+    """
+    The cache index as stored in an SQLite database, one row per object.  Behaves like the
+    dict of dicts read from the JSON index, { os_ver_arch: { name: value } }, but only reads
+    the rows of an os_ver_arch the first time it is accessed and only writes the rows that
+    changed when the transaction is committed.
+
+    The database runs in WAL mode, so readers are never blocked by a writer and a crash
+    during a write leaves the previous index intact.
+
+    @param connection: Connection returned by SQLiteIndex.connect()
+    @param write: bool indicating whether the transaction may modify the index.  Only one
+    writing transaction runs at a time, any number of read only ones run alongside it.
+    @param timeout: Seconds to wait for another writer (default: TIMEOUT)
+    """
+
+    # Seconds to wait for another writer before giving up
+    TIMEOUT = 60
+
+    @classmethod
+    def connect(cls, filename):
+        """
+        Open the index database, creating it if needed.  A connection must only be used by
+        the thread that opened it.
+
+        @param filename: Path of the database
+        @return: sqlite3 connection
+        """
+        connection = sqlite3.connect(filename, timeout=cls.TIMEOUT, isolation_level=None)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS cache_index (os_ver_arch TEXT NOT NULL, name TEXT NOT NULL, "
+                           "value TEXT NOT NULL, PRIMARY KEY (os_ver_arch, name))")
+        return connection
+
+    def __init__(self, connection, write=True, timeout=None):
+        dict.__init__(self)
+        self.connection = connection
+        self.write = write
+        # os_ver_arch values whose rows have been read
+        self._loaded = set()
+        self._all_loaded = False
+        # Serialized value of every row as read, keyed by (os_ver_arch, name)
+        self._original = {}
+        if timeout is None:
+            timeout = self.TIMEOUT
+        self.connection.execute("PRAGMA busy_timeout = %d" % int(timeout * 1000))
+        try:
+            if write:
+                self.connection.execute("BEGIN IMMEDIATE")
+            else:
+                self.connection.execute("BEGIN")
+        except sqlite3.OperationalError, e:
+            raise Exception("Unable to lock the cache index within %d seconds: %s" % (timeout, e))
+
+    def _load(self, os_ver_arch):
+        if self._all_loaded or os_ver_arch in self._loaded:
+            return
+        self._loaded.add(os_ver_arch)
+        rows = self.connection.execute("SELECT name, value FROM cache_index WHERE os_ver_arch = ?",
+                                       (os_ver_arch, )).fetchall()
+        if rows:
+            objects = {}
+            for (name, value) in rows:
+                self._original[(os_ver_arch, name)] = value
+                objects[name] = json.loads(value)
+            dict.__setitem__(self, os_ver_arch, objects)
+
+    def _load_all(self):
+        if self._all_loaded:
+            return
+        for (os_ver_arch, ) in self.connection.execute("SELECT DISTINCT os_ver_arch FROM cache_index").fetchall():
+            self._load(os_ver_arch)
+        self._all_loaded = True
+
+    def __contains__(self, os_ver_arch):
+        self._load(os_ver_arch)
+        return dict.__contains__(self, os_ver_arch)
+
+    def has_key(self, os_ver_arch):
+        return os_ver_arch in self
+
+    def __getitem__(self, os_ver_arch):
+        self._load(os_ver_arch)
+        return dict.__getitem__(self, os_ver_arch)
+
+    def get(self, os_ver_arch, default=None):
+        self._load(os_ver_arch)
+        return dict.get(self, os_ver_arch, default)
+
+    def __setitem__(self, os_ver_arch, objects):
+        self._load(os_ver_arch)
+        dict.__setitem__(self, os_ver_arch, objects)
+
+    def setdefault(self, os_ver_arch, default=None):
+        self._load(os_ver_arch)
+        return dict.setdefault(self, os_ver_arch, default)
+
+    def __delitem__(self, os_ver_arch):
+        self._load(os_ver_arch)
+        dict.__delitem__(self, os_ver_arch)
+
+    def pop(self, os_ver_arch, *default):
+        self._load(os_ver_arch)
+        return dict.pop(self, os_ver_arch, *default)
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def commit(self):
+        """
+        Write the rows that were added, changed or removed and end the transaction
+        """
+        if not self.write:
+            raise Exception("Attempt made to modify the cache index in a read only transaction")
+        current = {}
+        for (os_ver_arch, objects) in dict.items(self):
+            for (name, value) in objects.items():
+                current[(os_ver_arch, name)] = json.dumps(value, sort_keys=True)
+        try:
+            for (key, value) in current.items():
+                if self._original.get(key) != value:
+                    self.connection.execute("INSERT OR REPLACE INTO cache_index (os_ver_arch, name, value) "
+                                            "VALUES (?, ?, ?)", key + (value, ))
+            for key in self._original.keys():
+                if key not in current:
+                    self.connection.execute("DELETE FROM cache_index WHERE os_ver_arch = ? AND name = ?", key)
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+
+    def rollback(self):
+        """
+        End the transaction without writing anything
+        """
+        self.connection.execute("ROLLBACK")
@@ -0,0 +1,100 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import errno
+import json
+import os
+import os.path
+import socket
+from BlobStore import BlobStore
+from FileCopier import FileCopier
+
+
+class SharedBlobStore(BlobStore):
+    """
+    BlobStore on a filesystem mounted by several builder hosts, such as NFS, so that content
+    fetched by one of them is there for all of them.  Content is copied in under a name
+    unique to the host and process and renamed into place once complete, so other hosts
+    never see part of it.  Pins live on the shared filesystem too, so content one host is
+    using is not evicted by another.  The filesystem must support flock() across hosts, as
+    NFSv4 does.
+
+    @param root: Directory on the shared filesystem the content is kept in
+    """
+
+    shared = True
+
+    def store(self, filename, sha256, size):
+        blob_filename = self.path(sha256)
+        if os.path.isfile(blob_filename) and os.path.getsize(blob_filename) == size:
+            self.log.debug("Content of (%s) is already stored as (%s) - discarding the copy" %
+                           (filename, blob_filename))
+            os.remove(filename)
+            os.utime(blob_filename, None)
+            return blob_filename
+        self._make_dirs(blob_filename)
+        try:
+            os.rename(filename, blob_filename)
+            return blob_filename
+        except OSError, e:
+            if e.errno != errno.EXDEV:
+                raise
+        # The local cache is on another filesystem - copy the content over, server side where
+        # the filesystem can, and check it arrived intact
+        copy_filename = "%s.%s.%d" % (blob_filename, socket.gethostname(), os.getpid())
+        FileCopier(filename, copy_filename, expected_sha256=sha256).copy()
+        os.rename(copy_filename, blob_filename)
+        os.remove(filename)
+        return blob_filename
+
+    def pin_filename(self, sha256):
+        filename = "%spins/%s/%s.pin" % (self.root, sha256[:2], sha256)
+        self._make_dirs(filename)
+        return filename
+
+    def _source_filename(self, url):
+        return "%ssources/%s.json" % (self.root, hashlib.sha256(url).hexdigest())
+
+    def record_source(self, url, sha256, size, validators):
+        filename = self._source_filename(url)
+        self._make_dirs(filename)
+        record = {"url": url, "sha256": sha256, "size": size}
+        record.update(validators)
+        temp_filename = "%s.%s.%d" % (filename, socket.gethostname(), os.getpid())
+        record_file = open(temp_filename, 'w')
+        try:
+            json.dump(record, record_file)
+        finally:
+            record_file.close()
+        os.rename(temp_filename, filename)
+
+    def lookup_source(self, url):
+        try:
+            record_file = open(self._source_filename(url))
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            record = json.load(record_file)
+        except ValueError:
+            return None
+        finally:
+            record_file.close()
+        if record.get("url") != url:
+            return None
+        return record
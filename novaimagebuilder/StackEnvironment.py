@@ -17,12 +17,20 @@
 from keystoneclient.v2_0 import client as keystone_client
 from novaclient.v1_1 import client as nova_client
 from glanceclient import client as glance_client
+from glanceclient import exc as glance_exc
 from cinderclient import client as cinder_client
 from Singleton import Singleton
-from time import sleep
 from novaclient.v1_1.contrib.list_extensions import ListExtManager
 import os
+import sys
+import calendar
+import threading
 from NovaInstance import NovaInstance
+from TransferScheduler import TransferScheduler
+from Waiter import WaitTimeout
+from StatusMonitor import StatusMonitor
+from CapabilityCache import CapabilityCache
+from TokenCache import TokenCache
 import logging
 from tempfile import NamedTemporaryFile
 
@@ -33,6 +41,21 @@ class StackEnvironment(Singleton):
     StackEnvironment
     """
 
+    # Seconds to wait for an uploaded image to become active, or None for ever
+    IMAGE_TIMEOUT = None
+    # Seconds to wait for a volume created from an image to become available, or None for ever
+    VOLUME_TIMEOUT = None
+    # Seconds to wait for a launched instance to become active
+    INSTANCE_TIMEOUT = 360
+    # What each cloud supports is probed once and kept in CAPABILITY_CACHE, shared by every process,
+    # for CAPABILITY_TTL seconds (None for ever)
+    CAPABILITY_FILE = "_capabilities.json"
+    # File the capabilities are kept in (default: CAPABILITY_FILE under CacheManager.CACHE_ROOT)
+    CAPABILITY_CACHE = None
+    CAPABILITY_TTL = 3600
+    # Keystone tokens are kept between runs in TOKEN_CACHE, readable only by its owner, or not at all if None
+    TOKEN_CACHE = "~/.novaimagebuilder/tokens.json"
+
     def _singleton_init(self):
         super(StackEnvironment, self)._singleton_init()
         self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
@@ -44,30 +67,150 @@ class StackEnvironment(Singleton):
             auth_url = os.environ['OS_AUTH_URL']
         except Exception, e:
             raise Exception("Unable to retrieve auth info from environment variables. exception: %s" % e.message)
+        # Capabilities are probed once per cloud and tenant
+        self.endpoint = "%s|%s" % (auth_url, tenant)
+        capability_cache = self.CAPABILITY_CACHE
+        if capability_cache is None:
+            # Imported here as CacheManager itself uses this module
+            from CacheManager import CacheManager
+            capability_cache = CacheManager.CACHE_ROOT + self.CAPABILITY_FILE
+        self.capabilities = CapabilityCache(capability_cache, self.CAPABILITY_TTL)
+
+        self.credentials = (username, password, tenant, auth_url)
+        self.tokens = None
+        if self.TOKEN_CACHE:
+            self.tokens = TokenCache(os.path.expanduser(self.TOKEN_CACHE))
+        # The clients are only made, and keystone only contacted, when first used
+        self._clients = { }
+        self._clients_lock = threading.RLock()
+        # Shared by every wait on a server, image or volume - see StatusMonitor
+        self.monitor = StatusMonitor(self)
+
+    @property
+    def keystone(self):
+        return self._client('keystone', self._connect_keystone)
+
+    @property
+    def nova(self):
+        return self._client('nova', self._connect_nova)
+
+    @property
+    def glance(self):
+        return self._client('glance', self._connect_glance)
 
+    @property
+    def cinder(self):
+        return self._client('cinder', self._connect_cinder)
+
+    def _client(self, name, connect):
+        self._clients_lock.acquire()
         try:
-            self.keystone = keystone_client.Client(username=username,  password=password, tenant_name=tenant,
-                                                   auth_url=auth_url)
-            self.keystone.authenticate()
+            if name not in self._clients:
+                self._clients[name] = connect()
+            return self._clients[name]
+        finally:
+            self._clients_lock.release()
+
+    def _connect_keystone(self):
+        (username, password, tenant, auth_url) = self.credentials
+        auth_ref = None
+        if self.tokens:
+            auth_ref = self.tokens.get(auth_url, username, tenant)
+        try:
+            if auth_ref:
+                self.log.debug("Using cached keystone token for (%s) on (%s)" % (username, auth_url))
+                # The credentials are still given so that the client can get a new token if need be
+                keystone = keystone_client.Client(auth_ref=auth_ref, username=username, password=password,
+                                                  tenant_name=tenant, auth_url=auth_url)
+            else:
+                keystone = keystone_client.Client(username=username,  password=password, tenant_name=tenant,
+                                                  auth_url=auth_url)
+                if keystone.auth_ref is None:
+                    keystone.authenticate()
+                if self.tokens:
+                    self.tokens.store(auth_url, username, tenant, dict(keystone.auth_ref),
+                                      calendar.timegm(keystone.auth_ref.expires.utctimetuple()))
         except Exception, e:
             raise Exception('Error authenticating with keystone. Original exception: %s' % e.message)
+        return keystone
+
+    def _reauthenticate(self, rejected_token):
+        """
+        Forget a token that was rejected, both in the token cache and in the clients made with
+        it, so that the next use of a client authenticates with keystone again.
+
+        @param rejected_token: The token that was rejected.  Nothing is done if the clients have
+        moved on to another token since.
+        """
+        (username, password, tenant, auth_url) = self.credentials
+        self._clients_lock.acquire()
+        try:
+            keystone = self._clients.get('keystone')
+            if keystone is None or keystone.auth_token != rejected_token:
+                return
+            self.log.info("Keystone token for (%s) on (%s) was rejected - authenticating again" %
+                          (username, auth_url))
+            if self.tokens:
+                self.tokens.remove(auth_url, username, tenant)
+            self._clients.clear()
+        finally:
+            self._clients_lock.release()
+
+    def call_authenticated(self, operation, retry=True):
+        """
+        Call a function that uses the glance client.  The glance client is made with a fixed
+        token and cannot authenticate again by itself, so when the token is rejected - revoked,
+        or expired in the middle of a long build - the token and clients are dropped, and the
+        function is called once more with a new glance client.
+
+        @param operation: Function of no arguments, which must look up self.glance itself
+        @param retry: bool indicating whether operation may be called again.  If not, the
+        rejection is still passed on, but whatever is done next gets a new token.
+        @return: What operation returned
+        """
+        token = self.keystone.auth_token
         try:
-            self.nova = nova_client.Client(username, password, tenant, auth_url=auth_url, insecure=True)
+            return operation()
+        except glance_exc.HTTPUnauthorized:
+            exc_info = sys.exc_info()
+            self._reauthenticate(token)
+            if not retry:
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return operation()
+
+    def _connect_nova(self):
+        (username, password, tenant, auth_url) = self.credentials
+        try:
+            # Starting from the keystone token and catalog rather than authenticating again.  Nova
+            # authenticates with the credentials itself if the token is rejected.
+            nova_url = self.keystone.auth_ref.service_catalog.url_for(service_type='compute',
+                                                                      endpoint_type='publicURL')
+            return nova_client.Client(username, password, tenant, auth_url=auth_url, insecure=True,
+                                      auth_token=self.keystone.auth_token, bypass_url=nova_url)
         except Exception, e:
             raise Exception('Error connecting to Nova.  Nova is required for \
                     building images. Original exception: %s' % e.message)
+
+    def _connect_glance(self):
         try:
-            glance_url = self.keystone.service_catalog.get_endpoints()['image'][0]['adminURL']
-            self.glance = glance_client.Client('1', endpoint=glance_url, token=self.keystone.auth_token)
+            glance_url = self.capabilities.get(self.endpoint, "glance_endpoint", self._probe_glance_endpoint)
+            return glance_client.Client('1', endpoint=glance_url, token=self.keystone.auth_token)
         except Exception, e:
             raise Exception('Error connecting to glance. Glance is required for\
                     building images. Original exception: %s' % e.message)
-        
+
+    def _connect_cinder(self):
+        (username, password, tenant, auth_url) = self.credentials
         try:
-            self.cinder = cinder_client.Client('1', username, password, tenant,
+            cinder = cinder_client.Client('1', username, password, tenant,
                     auth_url)
+            # As for nova, start from the keystone token and catalog
+            cinder.client.auth_token = self.keystone.auth_token
+            cinder.client.management_url = self.keystone.auth_ref.service_catalog.url_for(
+                service_type='volume', endpoint_type='publicURL')
+            return cinder
         except:
-            self.cinder = None
+            return None
 
     @property
     def keystone_server(self):
@@ -97,12 +240,15 @@ class StackEnvironment(Singleton):
         return self.cinder
 
     def upload_image_to_glance(self, name, local_path=None, location=None, format='raw', min_disk=0, min_ram=0,
-                               container_format='bare', is_public=False, properties={}):
+                               container_format='bare', is_public=False, properties={}, data=None, size=None):
         """
 
         @param name: human readable name for image in glance
         @param local_path: path to an image file 
         @param location: URL for image file
+        @param data: file-like object to read the image from instead of
+        local_path, such as a StreamingDownload
+        @param size: size of the image in bytes, if known, when data is given
         @param format: 'raw', 'vhd', 'vmdk', 'vdi', 'iso', 'qcow2', 'aki',
         'ari', 'ami'
         @param min_disk: integer of minimum disk size in GB that a nova instance
@@ -116,43 +262,100 @@ class StackEnvironment(Singleton):
         @param properties: dictionary where keys are property names such as
         ramdisk_id and kernel_id and values are the property values
         @return: glance image id @raise Exception:
+
+        Uploads of data run in an upload slot of the TransferScheduler.
         """
         image_meta = {'container_format': container_format, 'disk_format': format, 'is_public': is_public,
                       'min_disk': min_disk, 'min_ram': min_ram, 'name': name, 'properties': properties}
+        local_file = None
+        if data is not None:
+            image_meta['data'] = data
+            if size is not None:
+                image_meta['size'] = size
+        else:
+            try:
+                local_file = open(local_path, "r")
+                image_meta['data'] = local_file
+                image_meta['size'] = os.path.getsize(local_path)
+            except Exception, e:
+                if location:
+                    image_meta['location'] = location
+                else:
+                    raise e
+
+        transfer = None
         try:
-            image_meta['data'] = open(local_path, "r")
-        except Exception, e:
-            if location:
-                image_meta['location'] = location
-            else:
-                raise e
-        
-        image = self.glance.images.create(name=name)
+            if 'data' in image_meta:
+                transfer = TransferScheduler().acquire(TransferScheduler.UPLOAD, description=name)
+                image_meta['data'] = transfer.wrap(image_meta['data'])
+
+            def _upload():
+                if local_file is not None:
+                    local_file.seek(0)
+                return self._create_image(image_meta)
+            # A stream handed to us cannot be read again
+            image = self.call_authenticated(_upload, retry=data is None)
+        finally:
+            if transfer is not None:
+                transfer.release()
+            if local_file is not None:
+                local_file.close()
+        if image.status != 'active':
+            image = self.wait_for_image(image.id)
+        self.log.debug("Finished uploading to Glance")
+        return image.id
+
+    def _create_image(self, image_meta):
+        image = self.glance.images.create(name=image_meta['name'])
         self.log.debug("Started uploading to Glance")
-        image.update(**image_meta)
-        while image.status != 'active':
-            image = self.glance.images.get(image.id)
+        try:
+            image.update(**image_meta)
+        except:
+            exc_info = sys.exc_info()
+            # Do not leave a half uploaded image behind
+            try:
+                image.delete()
+            except Exception, e:
+                self.log.debug("Unable to delete partly uploaded image (%s): %s" % (image.id, e))
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return image
+
+    def wait_for_image(self, image_id, timeout=None):
+        """
+        Wait for a glance image to become active - see Waiter.
+
+        @param image_id: glance image id
+        @param timeout: Seconds to wait (default: IMAGE_TIMEOUT)
+        @return: The active image
+        @raise Exception: When the image enters error status
+        @raise WaitTimeout: When the timeout passes first
+        """
+        def _active(image):
             if image.status == 'error':
                 raise Exception('Error uploading image to Glance.')
-            sleep(1)
-        self.log.debug("Finished uploading to Glance")
-        return image.id
+            if image.status == 'active':
+                return image
+        return self.monitor.wait(StatusMonitor.IMAGE, image_id, _active,
+                                 'glance image (%s) to become active' % image_id, timeout or self.IMAGE_TIMEOUT)
 
     def download_image_from_glance(self, image_id):
-        glance_obj = self.glance.images.get(image_id)
+        glance_obj = self.call_authenticated(lambda: self.glance.images.get(image_id))
         with NamedTemporaryFile() as image_file:
             for chunk in glance_obj.data:
                 image_file.write(chunk)
         return image_file
 
     def upload_volume_to_cinder(self, name, volume_size=None, local_path=None, location=None, format='raw',
-                                container_format='bare', is_public=False, keep_image=True):
+                                container_format='bare', is_public=False, keep_image=True, data=None, size=None):
         """
 
         @param name: human readable name for volume in cinder
         @param volume_size: integer size in GB of volume
         @param local_path: path to an image file 
         @param location: URL to an image file
+        @param data: file-like object to read the image from instead of
+        local_path
+        @param size: size of the image in bytes, if known, when data is given
         @param format: 'raw', 'vhd', 'vmdk', 'vdi', 'iso', 'qcow2', 'aki',
         'ari', 'ami'
         @param container_format: currently not used by OpenStack components, so
@@ -163,7 +366,7 @@ class StackEnvironment(Singleton):
         @return: tuple (glance image id, cinder volume id)
         """
         image_id = self.upload_image_to_glance(name, local_path=local_path,
-                location=location, format=format, is_public=is_public)
+                location=location, format=format, is_public=is_public, data=data, size=size)
         volume_id = self._migrate_from_glance_to_cinder(image_id, volume_size)
         if not keep_image:
             #TODO: spawn a thread to delete image after volume is created
@@ -184,7 +387,7 @@ class StackEnvironment(Singleton):
 
         @param image_id: glance image id
         """
-        self.glance.images.get(image_id).delete()
+        self.call_authenticated(lambda: self.glance.images.get(image_id).delete())
 
     def delete_volume(self, volume_id):
         """
@@ -194,21 +397,31 @@ class StackEnvironment(Singleton):
         self.cinder.volumes.get(volume_id).delete()
 
     def _migrate_from_glance_to_cinder(self, image_id, volume_size):
-        image = self.glance.images.get(image_id)
+        image = self.call_authenticated(lambda: self.glance.images.get(image_id))
         if not volume_size:
         # Gigabytes rounded up
             volume_size = int(image.size/(1024*1024*1024)+1)
 
-        self.log.debug("Started copying to Cinder")
-        volume = self.cinder.volumes.create(volume_size,
-                display_name=image.name, imageRef=image.id)
-        while volume.status != 'available':
-            volume = self.cinder.volumes.get(volume.id)
-            if volume.status == 'error':
-                volume.delete()
-                raise Exception('Error occured copying glance image %s to \
-                volume %s' % (image_id, volume.id))
-            sleep(1)
+        # The copy happens between glance and cinder, so it takes an upload slot but none of
+        # our bandwidth
+        transfer = TransferScheduler().acquire(TransferScheduler.UPLOAD, description=image.name)
+        try:
+            self.log.debug("Started copying to Cinder")
+            volume = self.cinder.volumes.create(volume_size,
+                    display_name=image.name, imageRef=image.id)
+
+            def _available(current):
+                if current.status == 'error':
+                    current.delete()
+                    raise Exception('Error occured copying glance image %s to \
+                    volume %s' % (image_id, current.id))
+                if current.status == 'available':
+                    return current
+            if volume.status != 'available':
+                volume = self.monitor.wait(StatusMonitor.VOLUME, volume.id, _available,
+                                           'cinder volume (%s) to become available' % volume.id, self.VOLUME_TIMEOUT)
+        finally:
+            transfer.release()
         self.log.debug("Finished copying to Cinder")
         return volume.id
 
@@ -230,28 +443,9 @@ class StackEnvironment(Singleton):
         @return: 'queued', 'saving', 'active', 'killed', 'deleted', or
         'pending_delete'
         """
-        image = self.glance.images.get(image_id)
+        image = self.call_authenticated(lambda: self.glance.images.get(image_id))
         return image.status
 
-    def _create_blank_image(self, size):
-        #TODO(dkliban): Store blank image in cache.
-        blank_image_file = NamedTemporaryFile()
-        blank_image_name = blank_image_file.name
-        blank_image_file.close()
-        rc = os.system("qemu-img create -f qcow2 %s %dG" %
-                (blank_image_name, size))
-        if rc == 0:
-            return blank_image_name
-        else:
-            raise Exception("Unable to create blank image")
-
-    def _remove_blank_image(self, blank_image_name):
-        rc = os.system("rm %s" % blank_image_name)
-        if rc == 0:
-            return
-        else:
-            raise Exception("Unable to create blank image")
-
     def launch_install_instance(self, root_disk=None, install_iso=None,
             secondary_iso=None, floppy=None, aki=None, ari=None, cmdline=None,
             userdata=None, direct_boot=False, flavor=None, floating_ip=False):
@@ -283,18 +477,13 @@ class StackEnvironment(Singleton):
         if root_disk:
             #if root disk needs to be created
             if root_disk[0] == 'blank':
-                root_disk_size = root_disk[1]
-                #Create a blank qcow2 image and uploads it
-                blank_image_name = self._create_blank_image(root_disk_size)
                 if aki and ari and cmdline:
                     root_disk_properties = {'kernel_id': aki, 'ramdisk_id': ari, 'os_command_line': cmdline}
                 else:
                     root_disk_properties = {}
-                root_disk_image_id = self.upload_image_to_glance('blank %dG disk' % root_disk_size,
-                                                                 local_path=blank_image_name,
-                                                                 format='qcow2',
-                                                                 properties=root_disk_properties)
-                self._remove_blank_image(blank_image_name)
+                # Imported here as CacheManager itself uses this module
+                from CacheManager import CacheManager
+                root_disk_image_id = CacheManager().blank_disk_image(root_disk[1], root_disk_properties)
             elif root_disk[0] == 'glance':
                 root_disk_image_id = root_disk[1]
             else:
@@ -366,34 +555,35 @@ class StackEnvironment(Singleton):
         """
         key_pair = self.nova.keypairs.create(root_disk)
         self.log.debug('Starting nova instance with glance image %s' % root_disk)
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         instance = self.nova.servers.create(name, image, flavor, key_name=key_pair.name)
 
         # Wait for the instance to be active before returning.
-        for index in range(1, 360, 5):
-            status = self.nova.servers.get(instance.id).status
-            if status == 'ACTIVE':
-                return NovaInstance(instance, self, key_pair=key_pair,
-                        floating_ip=floating_ip)
-            elif status == 'ERROR':
-                self.log.debug('Instance (%s: %s) has status %s.' % (instance.name, instance.id, instance.status))
-                return None
-            else:
-                self.log.debug('Waiting for instance (%s) to become active...' % instance.name)
-                sleep(5)
-        return None
+        def _started(server):
+            if server.status in ('ACTIVE', 'ERROR'):
+                return server.status
+        try:
+            status = self.monitor.wait(StatusMonitor.SERVER, instance.id, _started,
+                                       'instance (%s) to become active' % instance.name, self.INSTANCE_TIMEOUT)
+        except WaitTimeout, e:
+            self.log.debug(str(e))
+            return None
+        if status == 'ERROR':
+            self.log.debug('Instance (%s: %s) has status %s.' % (instance.name, instance.id, status))
+            return None
+        return NovaInstance(instance, self, key_pair=key_pair, floating_ip=floating_ip)
 
     def _launch_network_install(self, root_disk, userdata, flavor=None):
         #TODO: check the kickstart file in userdata for sanity
         self.log.debug("Starting instance for network install")
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         instance = self.nova.servers.create("Install from network", image,
                 flavor, userdata=userdata)
         return instance
 
     def _launch_single_cdrom_install(self, root_disk, userdata, install_iso,
             flavor=None):
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         self.log.debug("Starting instance for single cdrom install")
         if install_iso:
             if self.is_cdrom():
@@ -436,14 +626,14 @@ class StackEnvironment(Singleton):
                     },
                     ]
 
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         instance = self.nova.servers.create("Install with dual cdroms", image,
                 flavor, meta={}, block_device_mapping_v2=block_device_mapping_v2)
         return instance
 
     def _launch_direct_boot(self, root_disk, userdata, install_iso=None,
             flavor=None):
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         if install_iso:
             #assume that install iso is already a cinder volume
             block_device_mapping_v2 = [
@@ -489,7 +679,7 @@ class StackEnvironment(Singleton):
                     },
                     ]
 
-        image = self.glance.images.get(root_disk)
+        image = self.call_authenticated(lambda: self.glance.images.get(root_disk))
         instance = self.nova.servers.create("windows-volume-backed", image,
                 flavor, meta={}, block_device_mapping_v2=block_device_mapping_v2)
         return instance
@@ -500,10 +690,10 @@ class StackEnvironment(Singleton):
 
         @return: True if cinder service is available
         """
-        if not self.cinder:
+        if not self.capabilities.get(self.endpoint, "cinder",
+                                     lambda: 'volume' in self.keystone.service_catalog.get_endpoints()):
             return False
-        else:
-            return True
+        return self.cinder is not None
 
     def is_cdrom(self):
         """
@@ -512,11 +702,7 @@ class StackEnvironment(Singleton):
 
         @return: True if volume can be attached as cdrom
         """
-        nova_extension_manager = ListExtManager(self.nova)
-        for ext in nova_extension_manager.show_all():
-            if ext.name == "BlockDeviceMappingV2Boot" and ext.is_loaded():
-                return True
-        return False
+        return self.capabilities.get(self.endpoint, "block_device_mapping_v2", self._probe_block_device_mapping_v2)
 
     def is_floppy(self):
         #TODO: check if floppy is available.  
@@ -526,6 +712,12 @@ class StackEnvironment(Singleton):
 
         @return: Currently this always returns True.  
         """
+        return self.capabilities.get(self.endpoint, "block_device_mapping_v2", self._probe_block_device_mapping_v2)
+
+    def _probe_glance_endpoint(self):
+        return self.keystone.service_catalog.get_endpoints()['image'][0]['adminURL']
+
+    def _probe_block_device_mapping_v2(self):
         nova_extension_manager = ListExtManager(self.nova)
         for ext in nova_extension_manager.show_all():
             if ext.name == "BlockDeviceMappingV2Boot" and ext.is_loaded():
@@ -0,0 +1,235 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import threading
+import time
+from Waiter import Waiter
+
+
+class StatusMonitor(object):
+    """
+    Keep the state of every server, image and volume some wait is interested in up to date
+    every INTERVAL seconds.  When enough resources of a kind are tracked, they are refreshed
+    with a single servers.list(), images.list() or volumes.list() - paged, for images - which
+    is filtered down to the tracked IDs locally.  A tracked resource missing from its list -
+    deleted, or in a state the list leaves out - is fetched on its own, and a resource that
+    can no longer be fetched is reported through the exception the fetch raised.
+
+    Listing only pays off when it takes fewer calls than fetching each resource.  A kind is
+    listed when at least LIST_THRESHOLD of its resources are tracked and more than the last
+    listing of it cost in calls, counting its pages and the resources missing from it.
+    Otherwise, for instance with a large glance catalog, each resource is fetched on its own.
+
+    Callers normally use wait(), which runs a Waiter whose check reads the monitored state
+    rather than calling the API, and which is woken as soon as the resource changes.
+
+    @param stack_env: The StackEnvironment whose clients to use
+    """
+
+    SERVER = "server"
+    IMAGE = "image"
+    VOLUME = "volume"
+    # Seconds between refreshes
+    INTERVAL = 3
+    # Images requested per page from glance
+    IMAGE_PAGE_SIZE = 1000
+    # Fewest tracked resources of a kind worth listing them all for
+    LIST_THRESHOLD = 3
+
+    def __init__(self, stack_env):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.stack_env = stack_env
+        # Latest resource, or exception raised fetching it, keyed by (kind, id)
+        self._resources = { }
+        # Callbacks called with (kind, id) when a resource changes, keyed by (kind, id)
+        self._watchers = { }
+        self._lock = threading.Lock()
+        self._thread = None
+        # Number of list and single resource calls made, for the log
+        self.calls = 0
+        # Calls taken by the last refresh of each kind that listed it
+        self._list_costs = { }
+
+    def watch(self, kind, resource_id, callback):
+        """
+        Track a resource and call callback with kind and resource_id whenever it changes.
+        The resource is fetched straight away if it is not tracked yet.
+        """
+        key = (kind, resource_id)
+        self._lock.acquire()
+        try:
+            self._watchers.setdefault(key, [ ]).append(callback)
+            fetch = key not in self._resources
+        finally:
+            self._lock.release()
+        if fetch:
+            self._store(key, self._fetch(kind, resource_id))
+        self._start()
+
+    def unwatch(self, kind, resource_id, callback):
+        """
+        Stop calling callback.  The resource is no longer tracked once nobody watches it.
+        """
+        key = (kind, resource_id)
+        self._lock.acquire()
+        try:
+            callbacks = self._watchers.get(key, [ ])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._watchers.pop(key, None)
+                self._resources.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def current(self, kind, resource_id):
+        """
+        @return: The latest state of a tracked resource
+        @raise: The exception raised fetching the resource, if it could not be fetched
+        """
+        self._lock.acquire()
+        try:
+            resource = self._resources.get((kind, resource_id))
+        finally:
+            self._lock.release()
+        if isinstance(resource, Exception):
+            raise resource
+        return resource
+
+    def wait(self, kind, resource_id, check, description, timeout=None):
+        """
+        Wait for a resource to reach some state - see Waiter.
+
+        @param check: function called with the latest state of the resource, returning None to
+        go on waiting
+        @return: The first value check returned other than None
+        @raise: The exception raised fetching the resource, once it can no longer be fetched
+        """
+        waiter = Waiter(description, timeout, initial_interval=self.INTERVAL, max_interval=self.INTERVAL * 4)
+        self.watch(kind, resource_id, waiter.wake)
+        try:
+            return waiter.wait(lambda: check(self.current(kind, resource_id)))
+        finally:
+            self.unwatch(kind, resource_id, waiter.wake)
+
+    def _fetch(self, kind, resource_id):
+        self.calls += 1
+        try:
+            if kind == self.SERVER:
+                return self.stack_env.nova.servers.get(resource_id)
+            if kind == self.IMAGE:
+                return self.stack_env.call_authenticated(lambda: self.stack_env.glance.images.get(resource_id))
+            if kind == self.VOLUME:
+                return self.stack_env.cinder.volumes.get(resource_id)
+        except Exception, e:
+            return e
+        raise Exception("Unknown resource kind (%s)" % kind)
+
+    def _list(self, kind):
+        """
+        @return: tuple of the listed resources and the number of calls it took
+        """
+        if kind == self.SERVER:
+            listed = self.stack_env.nova.servers.list()
+            calls = 1
+        elif kind == self.IMAGE:
+            listed = self.stack_env.call_authenticated(
+                lambda: list(self.stack_env.glance.images.list(page_size=self.IMAGE_PAGE_SIZE)))
+            calls = len(listed) / self.IMAGE_PAGE_SIZE + 1
+        elif kind == self.VOLUME:
+            listed = self.stack_env.cinder.volumes.list()
+            calls = 1
+        else:
+            raise Exception("Unknown resource kind (%s)" % kind)
+        self.calls += calls
+        return (listed, calls)
+
+    def _store(self, key, resource):
+        """
+        Record the latest state of a resource and tell its watchers if it changed.
+        """
+        self._lock.acquire()
+        try:
+            if key not in self._watchers:
+                return
+            previous = self._resources.get(key)
+            self._resources[key] = resource
+            callbacks = list(self._watchers[key])
+        finally:
+            self._lock.release()
+        if self._state(previous) != self._state(resource):
+            for callback in callbacks:
+                try:
+                    callback(*key)
+                except Exception:
+                    self.log.exception("Status callback for %s (%s) failed" % key)
+
+    def _state(self, resource):
+        if resource is None:
+            return None
+        if isinstance(resource, Exception):
+            return "error: %s" % resource
+        return getattr(resource, 'status', None)
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="StatusMonitor")
+                self._thread.daemon = True
+                self._thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            self._lock.acquire()
+            try:
+                tracked = { }
+                for (kind, resource_id) in self._watchers.keys():
+                    tracked.setdefault(kind, set()).add(resource_id)
+                if not tracked:
+                    # Nothing to do - the next watch() starts a new thread
+                    self._thread = None
+                    return
+            finally:
+                self._lock.release()
+            for (kind, resource_ids) in tracked.items():
+                self._refresh(kind, resource_ids)
+            time.sleep(self.INTERVAL)
+
+    def _refresh(self, kind, resource_ids):
+        if len(resource_ids) < self.LIST_THRESHOLD or len(resource_ids) <= self._list_costs.get(kind, 0):
+            for resource_id in resource_ids:
+                self._store((kind, resource_id), self._fetch(kind, resource_id))
+            return
+        try:
+            (listed, calls) = self._list(kind)
+        except Exception, e:
+            self.log.debug("Unable to list %ss - trying again later: %s" % (kind, e))
+            return
+        found = { }
+        for resource in listed:
+            if resource.id in resource_ids:
+                found[resource.id] = resource
+        for resource_id in resource_ids:
+            resource = found.get(resource_id)
+            if resource is None:
+                calls += 1
+                resource = self._fetch(kind, resource_id)
+            self._store((kind, resource_id), resource)
+        self._list_costs[kind] = calls
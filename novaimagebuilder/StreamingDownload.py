@@ -0,0 +1,221 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import hashlib
+import os
+import os.path
+import threading
+import email.utils
+import Queue
+import pycurl
+from Downloader import Downloader
+
+
+class StreamingDownload(object):
+    """
+    Read-only file-like view of an object while it is being downloaded, so that it can be
+    handed straight to a glance upload instead of being staged on local disk first.  The
+    download runs in a background thread and only gets ahead of the reader by BUFFER_SIZE
+    bytes.  The data can be copied into a local file along the way, and its SHA-256 is
+    computed as it passes.
+
+    Unlike Downloader, a stream cannot be resumed - a failed stream has to start over.  If the
+    object turns out to be incomplete or does not match expected_sha256, read() raises instead
+    of returning the end of the stream, so the consumer never sees it as complete.
+
+    @param url: Location to download from
+    @param filename: Optional local path to also store the object under
+    @param expected_sha256: Optional hex SHA-256 the object must match
+    @param transfer: Optional TransferScheduler Transfer every byte received is counted against
+    """
+
+    # Most bytes held in memory between the download and the reader
+    BUFFER_SIZE = 8 * 1024 * 1024
+    # libcurl hands over at most this much per write callback
+    CHUNK_SIZE = 16 * 1024
+    # Seconds start() waits for the response headers before giving up on the stream
+    HEADER_TIMEOUT = 120
+
+    def __init__(self, url, filename=None, expected_sha256=None, transfer=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.url = url
+        self.filename = filename
+        self.expected_sha256 = expected_sha256
+        # Size announced by the server, if any, once start() returns
+        self.size = None
+        # Validators announced by the server, if any, once start() returns - see Downloader.revalidate()
+        self.etag = None
+        self.last_modified = None
+        # Set once the whole object has been read
+        self.sha256 = None
+        self._hash = hashlib.sha256()
+        self._received = 0
+        self._local_file = None
+        self._chunks = Queue.Queue(max(1, self.BUFFER_SIZE / self.CHUNK_SIZE))
+        self._pending = ''
+        self._eof = False
+        self._aborted = False
+        self._headers_done = threading.Event()
+        self._thread = None
+        self._transfer = transfer
+
+    def start(self):
+        """
+        Start the download and wait until the response headers have arrived.
+
+        @return: self
+        @raise Exception: When the headers have not arrived within HEADER_TIMEOUT seconds
+        """
+        if self.filename:
+            self._local_file = open(self.filename + ".part", 'wb')
+        if self.url.startswith('file://'):
+            self.last_modified = email.utils.formatdate(os.path.getmtime(self.url[len('file://'):]), usegmt=True)
+        self._thread = threading.Thread(target=self._run, name="stream-%s" % os.path.basename(self.url))
+        self._thread.daemon = True
+        self._thread.start()
+        self._headers_done.wait(self.HEADER_TIMEOUT)
+        if not self._headers_done.is_set():
+            self.close()
+            raise Exception("Timed out after %d seconds waiting for a response from (%s)" %
+                            (self.HEADER_TIMEOUT, self.url))
+        return self
+
+    def read(self, size=-1):
+        """
+        @param size: Largest number of bytes to return, or -1 for the rest of the object
+        @return: The next bytes of the object, or an empty string at its end
+        """
+        pieces = [ self._pending ]
+        length = len(self._pending)
+        while (size < 0 or length < size) and not self._eof:
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._eof = True
+            elif isinstance(chunk, Exception):
+                self._eof = True
+                raise chunk
+            else:
+                pieces.append(chunk)
+                length += len(chunk)
+        data = ''.join(pieces)
+        if size < 0:
+            self._pending = ''
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+    def close(self):
+        """
+        Stop the download if it is still running and drop an incomplete local copy
+        """
+        self._aborted = True
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._local_file is not None:
+            self._local_file.close()
+            self._local_file = None
+            if os.path.exists(self.filename + ".part"):
+                os.remove(self.filename + ".part")
+
+    def _put(self, item):
+        # Wait for the reader to make room, but give up if it has gone away
+        while not self._aborted:
+            try:
+                self._chunks.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        # getinfo() is not allowed from inside callbacks, so track the headers ourselves
+        response = {'code': None, 'length': None, 'etag': None, 'last-modified': None}
+
+        def _header(line):
+            if line.startswith('HTTP/'):
+                # Start of a new response after a redirect
+                fields = line.split()
+                response['code'] = None
+                response['length'] = None
+                response['etag'] = None
+                response['last-modified'] = None
+                if len(fields) > 1 and fields[1].isdigit():
+                    response['code'] = int(fields[1])
+            elif line.lower().startswith('content-length:'):
+                response['length'] = int(line.split(':', 1)[1].strip())
+            elif line.lower().startswith('etag:'):
+                response['etag'] = line.split(':', 1)[1].strip()
+            elif line.lower().startswith('last-modified:'):
+                response['last-modified'] = line.split(':', 1)[1].strip()
+            elif not line.strip() and response['code'] is not None and 200 <= response['code'] < 300:
+                self.size = response['length']
+                self.etag = response['etag']
+                self.last_modified = response['last-modified']
+                self._headers_done.set()
+
+        def _data(buf):
+            self._headers_done.set()
+            if self._transfer is not None:
+                self._transfer.consume(len(buf))
+            self._hash.update(buf)
+            self._received += len(buf)
+            if self._local_file is not None:
+                self._local_file.write(buf)
+            if not self._put(buf):
+                # Returning a short count aborts the transfer
+                return 0
+
+        c = None
+        try:
+            c = pycurl.Curl()
+            c.setopt(c.URL, self.url)
+            c.setopt(c.CONNECTTIMEOUT, Downloader.CONNECT_TIMEOUT)
+            c.setopt(c.LOW_SPEED_LIMIT, Downloader.LOW_SPEED_LIMIT)
+            c.setopt(c.LOW_SPEED_TIME, Downloader.LOW_SPEED_TIME)
+            c.setopt(c.HEADERFUNCTION, _header)
+            c.setopt(c.WRITEFUNCTION, _data)
+            c.setopt(c.FOLLOWLOCATION, 1)
+            c.setopt(c.FAILONERROR, 1)
+            c.setopt(c.NOSIGNAL, 1)
+            self.log.debug("Started streaming (%s)" % self.url)
+            c.perform()
+            self._finish()
+            self._put(None)
+        except Exception, e:
+            if not self._aborted:
+                self.log.debug("Streaming (%s) failed: %s" % (self.url, e))
+                self._put(Exception("Streaming (%s) failed: %s" % (self.url, e)))
+        finally:
+            # Whatever happened, start() must not go on waiting
+            self._headers_done.set()
+            if c is not None:
+                c.close()
+
+    def _finish(self):
+        if self.size is not None and self._received != self.size:
+            raise Exception("got %d of %d bytes" % (self._received, self.size))
+        sha256 = self._hash.hexdigest()
+        if self.expected_sha256 and sha256 != self.expected_sha256.lower():
+            raise Exception("expected sha256 %s but got %s" % (self.expected_sha256, sha256))
+        if self._local_file is not None:
+            self._local_file.close()
+            self._local_file = None
+            os.rename(self.filename + ".part", self.filename)
+        self.size = self._received
+        self.sha256 = sha256
+        self.log.debug("Finished streaming (%s)" % self.url)
@@ -0,0 +1,84 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import os
+import os.path
+from swiftclient import client as swift_client
+
+
+class SwiftObjectStore(object):
+    """
+    Object store client for ObjectBlobStore keeping the objects in a Swift container.  Uses
+    the same OS_USERNAME, OS_PASSWORD, OS_TENANT_NAME and OS_AUTH_URL environment variables
+    as StackEnvironment.  The container is created if it does not exist.
+
+    @param container: Name of the container
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, container):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.container = container
+        try:
+            username = os.environ['OS_USERNAME']
+            password = os.environ['OS_PASSWORD']
+            tenant = os.environ['OS_TENANT_NAME']
+            auth_url = os.environ['OS_AUTH_URL']
+        except Exception, e:
+            raise Exception("Unable to retrieve auth info from environment variables. exception: %s" % e.message)
+        self.swift = swift_client.Connection(authurl=auth_url, user=username, key=password, tenant_name=tenant,
+                                             auth_version='2')
+        self.swift.put_container(self.container)
+
+    def head(self, key):
+        try:
+            headers = self.swift.head_object(self.container, key)
+        except swift_client.ClientException, e:
+            if e.http_status == 404:
+                return None
+            raise
+        return int(headers['content-length'])
+
+    def download(self, key, filename):
+        (headers, body) = self.swift.get_object(self.container, key, resp_chunk_size=self.CHUNK_SIZE)
+        local_file = open(filename, 'wb')
+        try:
+            for chunk in body:
+                local_file.write(chunk)
+        finally:
+            local_file.close()
+
+    def upload(self, key, filename):
+        local_file = open(filename, 'rb')
+        try:
+            self.swift.put_object(self.container, key, contents=local_file,
+                                  content_length=os.path.getsize(filename), chunk_size=self.CHUNK_SIZE)
+        finally:
+            local_file.close()
+
+    def read(self, key):
+        try:
+            (headers, body) = self.swift.get_object(self.container, key)
+        except swift_client.ClientException, e:
+            if e.http_status == 404:
+                return None
+            raise
+        return body
+
+    def write(self, key, data):
+        self.swift.put_object(self.container, key, contents=data)
@@ -0,0 +1,150 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import os.path
+import time
+
+
+class TokenCache(object):
+    """
+    Keystone tokens kept in a JSON file between runs, so that StackEnvironment only
+    authenticates when it has no token that is still valid for the auth URL, user and
+    tenant.  Tokens are kept with the rest of what keystone returned, including the service
+    catalog, and are no longer handed out MARGIN seconds before they expire.  A token that is
+    rejected before then should be dropped with remove().
+
+    The file grants access to the cloud, so it is only readable by its owner, in a directory
+    only its owner can enter.  When the file cannot be used, tokens are not cached.
+
+    @param filename: JSON file the tokens are kept in
+    """
+
+    # Seconds before its expiry a token is no longer used.  Keystone tokens usually last an
+    # hour, so this is kept short - a token that runs out in the middle of a build is rejected
+    # and replaced, see StackEnvironment.call_authenticated()
+    MARGIN = 300
+
+    def __init__(self, filename):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.filename = filename
+
+    def get(self, auth_url, username, tenant):
+        """
+        @return: dict of what keystone returned when the token was issued, or None if there is
+        no token valid for at least another MARGIN seconds
+        """
+        try:
+            fd = self._open_locked(fcntl.LOCK_SH)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT:
+                self.log.debug("Unable to open token cache (%s): %s" % (self.filename, e))
+            return None
+        try:
+            entry = self._load(fd).get(self._key(auth_url, username, tenant))
+        finally:
+            os.close(fd)
+        if not isinstance(entry, dict) or entry.get("expires", 0) - self.MARGIN <= time.time():
+            return None
+        return entry.get("auth_ref")
+
+    def store(self, auth_url, username, tenant, auth_ref, expires):
+        """
+        Keep a token, dropping any that have expired.
+
+        @param auth_ref: JSON serializable dict of what keystone returned
+        @param expires: Time the token expires, in seconds since the epoch
+        """
+        try:
+            fd = self._open_locked(fcntl.LOCK_EX, create=True)
+        except (IOError, OSError), e:
+            self.log.debug("Unable to open token cache (%s) - not caching the token: %s" % (self.filename, e))
+            return
+        try:
+            now = time.time()
+            tokens = { }
+            for (key, entry) in self._load(fd).items():
+                if isinstance(entry, dict) and entry.get("expires", 0) > now:
+                    tokens[key] = entry
+            tokens[self._key(auth_url, username, tenant)] = {"expires": expires, "auth_ref": auth_ref}
+            data = json.dumps(tokens)
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def remove(self, auth_url, username, tenant):
+        """
+        Forget the token for the auth URL, user and tenant, for instance once it is rejected.
+        """
+        try:
+            fd = self._open_locked(fcntl.LOCK_EX)
+        except (IOError, OSError), e:
+            return
+        try:
+            tokens = self._load(fd)
+            if tokens.pop(self._key(auth_url, username, tenant), None) is not None:
+                data = json.dumps(tokens)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def _key(self, auth_url, username, tenant):
+        return hashlib.sha256("%s|%s|%s" % (auth_url, username, tenant)).hexdigest()
+
+    def _open_locked(self, operation, create=False):
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory, 0700)
+        fd = os.open(self.filename, flags, 0600)
+        try:
+            # In case the file was made by something else
+            os.fchmod(fd, 0600)
+            fcntl.flock(fd, operation)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def _load(self, fd):
+        os.lseek(fd, 0, os.SEEK_SET)
+        data = ""
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            data += chunk
+        if not data:
+            return { }
+        try:
+            tokens = json.loads(data)
+        except ValueError:
+            self.log.warning("Ignoring unreadable token cache (%s)" % self.filename)
+            return { }
+        if not isinstance(tokens, dict):
+            return { }
+        return tokens
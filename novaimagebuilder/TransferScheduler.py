@@ -0,0 +1,267 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import errno
+import fcntl
+import json
+import os
+import os.path
+import time
+import urlparse
+from Singleton import Singleton
+
+
+class TransferScheduler(Singleton):
+    """
+    Host-wide limits on the transfers made by every novaimagebuilder process on this machine,
+    for downloads of install media and uploads to glance and cinder separately.
+
+    A transfer runs in one of SLOTS slots of its direction, and waits for a free one when they
+    are all taken.  The slots are flock()ed files in STATE_DIR under the cache root, so they
+    are shared between the processes using the same cache and a slot is freed when the process
+    holding it dies.  RESERVED_SLOTS of them
+    are kept for HIGH priority transfers, those a build is actively waiting on, and LOW
+    priority transfers (such as those of nova-install --cache_warm) also hold back while a
+    HIGH priority transfer is waiting for a slot.
+
+    The bytes transferred are counted against a token bucket per direction, kept in a state
+    file under STATE_DIR, holding all transfers together to RATES bytes per second.  Downloads
+    from a source host listed in HOST_RATES are also counted against a bucket of that host,
+    holding every download from it to its rate.  Each transfer settles with its buckets every
+    SETTLE_SIZE bytes and sleeps off any debt, so a download is held to whichever of the two
+    rates is lower.
+
+    Every process on the host is expected to use the same settings.
+    """
+
+    DOWNLOAD = "download"
+    UPLOAD = "upload"
+    HIGH = "high"
+    LOW = "low"
+
+    # Directory the slots and token buckets are kept in, under CACHE_ROOT
+    STATE_DIR = "_transfers/"
+    # Root of the cache whose processes share the limits (default: CacheManager.CACHE_ROOT)
+    CACHE_ROOT = None
+    # Most transfers running at once in each direction
+    SLOTS = {DOWNLOAD: 4, UPLOAD: 4}
+    # Slots only HIGH priority transfers may use
+    RESERVED_SLOTS = {DOWNLOAD: 1, UPLOAD: 1}
+    # Bytes per second for all transfers in each direction together, or None for no limit
+    RATES = {DOWNLOAD: None, UPLOAD: None}
+    # Bytes per second for all downloads from each source host together, keyed by host name.
+    # The key "*" applies to every host not listed.
+    HOST_RATES = { }
+    # Priority of transfers not given one
+    DEFAULT_PRIORITY = HIGH
+    # Seconds between attempts to get a slot
+    POLL_INTERVAL = 0.5
+    # Bytes counted locally before settling with the shared token bucket
+    SETTLE_SIZE = 1024 * 1024
+
+    def _singleton_init(self):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        cache_root = self.CACHE_ROOT
+        if cache_root is None:
+            # Imported here as CacheManager itself uses this module
+            from CacheManager import CacheManager
+            cache_root = CacheManager.CACHE_ROOT
+        self.state_dir = cache_root + self.STATE_DIR
+        if not os.path.exists(self.state_dir):
+            os.makedirs(self.state_dir, mode=0755)
+
+    def acquire(self, direction, priority=None, description=None, url=None):
+        """
+        Wait for a slot to run a transfer in.  The caller must release() the returned
+        Transfer once done, and should consume() every byte it moves through it.
+
+        @param direction: DOWNLOAD or UPLOAD
+        @param priority: HIGH or LOW (default: DEFAULT_PRIORITY)
+        @param description: What is being transferred, for the log
+        @param url: Source of a download, whose host rate from HOST_RATES applies to it
+        @return: Transfer holding the slot
+        """
+        if direction not in (self.DOWNLOAD, self.UPLOAD):
+            raise Exception("Unknown transfer direction (%s)" % direction)
+        priority = priority or self.DEFAULT_PRIORITY
+        if priority not in (self.HIGH, self.LOW):
+            raise Exception("Unknown transfer priority (%s)" % priority)
+        start = time.time()
+        slot_fd = self._wait_for_slot(direction, priority)
+        waited = time.time() - start
+        if waited >= self.POLL_INTERVAL:
+            self.log.debug("Waited %ds for a %s slot for (%s)" % (waited, direction, description))
+        host = None
+        if direction == self.DOWNLOAD and url:
+            host = urlparse.urlparse(url).hostname
+        return Transfer(self, direction, slot_fd, host)
+
+    def _state_filename(self, name):
+        return self.state_dir + name
+
+    def _try_lock(self, filename, operation):
+        """
+        @return: fd of filename locked with operation, or None if it is locked by someone else
+        """
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return fd
+        except IOError, e:
+            os.close(fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                raise
+            return None
+
+    def _high_priority_waiting(self, direction):
+        # HIGH priority waiters hold a shared lock on the waiting file
+        fd = self._try_lock(self._state_filename(direction + ".waiting"), fcntl.LOCK_EX)
+        if fd is None:
+            return True
+        os.close(fd)
+        return False
+
+    def _wait_for_slot(self, direction, priority):
+        slots = max(1, self.SLOTS[direction])
+        if priority == self.LOW:
+            slots = max(1, slots - self.RESERVED_SLOTS.get(direction, 0))
+        waiting_fd = None
+        if priority == self.HIGH:
+            waiting_fd = os.open(self._state_filename(direction + ".waiting"), os.O_RDWR | os.O_CREAT, 0644)
+            fcntl.flock(waiting_fd, fcntl.LOCK_SH)
+        try:
+            while True:
+                if priority == self.HIGH or not self._high_priority_waiting(direction):
+                    for slot in range(slots):
+                        fd = self._try_lock(self._state_filename("%s-%d.slot" % (direction, slot)), fcntl.LOCK_EX)
+                        if fd is not None:
+                            return fd
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            if waiting_fd is not None:
+                os.close(waiting_fd)
+
+    def _host_rate(self, host):
+        if not host:
+            return None
+        return self.HOST_RATES.get(host, self.HOST_RATES.get("*"))
+
+    def _settle(self, direction, amount, host=None):
+        """
+        Count amount bytes against the token bucket of direction, and against that of host if
+        it has a rate.
+
+        @return: Seconds to sleep until the rates allow them
+        """
+        delay = self._settle_bucket(direction + ".bucket", self.RATES.get(direction), amount)
+        host_rate = self._host_rate(host)
+        if host_rate:
+            delay = max(delay, self._settle_bucket("host-%s.bucket" % host, host_rate, amount))
+        return delay
+
+    def _settle_bucket(self, name, rate, amount):
+        """
+        Count amount bytes against the token bucket kept in the state file name.
+
+        @param rate: Bytes per second of the bucket, or None for no limit
+        @return: Seconds to sleep until the rate allows them
+        """
+        if not rate:
+            return 0
+        fd = os.open(self._state_filename(name), os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            now = time.time()
+            try:
+                state = json.loads(os.read(fd, 4096))
+                tokens = min(rate, state['tokens'] + max(0, now - state['time']) * rate)
+            except (ValueError, KeyError, TypeError):
+                # New or damaged bucket - start full
+                tokens = rate
+            tokens -= amount
+            data = json.dumps({'tokens': tokens, 'time': now})
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        if tokens < 0:
+            return -tokens / float(rate)
+        return 0
+
+
+class Transfer(object):
+    """
+    A transfer holding a slot of the TransferScheduler.  Data moved by the transfer is
+    counted with consume(), or by reading it through the file object returned by wrap().
+    """
+
+    def __init__(self, scheduler, direction, slot_fd, host=None):
+        self.scheduler = scheduler
+        self.direction = direction
+        self.host = host
+        self.bytes = 0
+        self._slot_fd = slot_fd
+        self._unsettled = 0
+
+    def consume(self, amount):
+        """
+        Account for amount bytes, sleeping until the rates of the transfer allow them.
+        """
+        self.bytes += amount
+        self._unsettled += amount
+        if self._unsettled >= self.scheduler.SETTLE_SIZE:
+            self._settle()
+
+    def wrap(self, file_obj):
+        """
+        @return: file object reading from file_obj, counting what is read with consume()
+        """
+        return _ThrottledFile(self, file_obj)
+
+    def release(self):
+        """
+        Free the slot of the transfer.
+        """
+        if self._slot_fd is None:
+            return
+        try:
+            self._settle()
+        finally:
+            os.close(self._slot_fd)
+            self._slot_fd = None
+
+    def _settle(self):
+        amount = self._unsettled
+        self._unsettled = 0
+        delay = self.scheduler._settle(self.direction, amount, self.host)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _ThrottledFile(object):
+    def __init__(self, transfer, file_obj):
+        self._transfer = transfer
+        self._file_obj = file_obj
+
+    def read(self, size=-1):
+        data = self._file_obj.read(size)
+        self._transfer.consume(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file_obj, name)
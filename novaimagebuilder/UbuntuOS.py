@@ -19,6 +19,10 @@ from OSInfo import OSInfo
 
 class UbuntuOS(BaseOS):
 
+    # Netboot kernels and ramdisks under installer-<arch>/current/ are replaced upstream, so
+    # cached copies are revalidated once they are this many seconds old
+    URL_CONTENT_TTL = 24 * 60 * 60
+
     def __init__(self, osinfo_dict, install_type, install_media_location, install_config, install_script = None):
         super(UbuntuOS, self).__init__(osinfo_dict, install_type, install_media_location, install_config, install_script)
 
@@ -60,13 +64,18 @@ class UbuntuOS(BaseOS):
         #If direct boot option is available, prepare kernel and ramdisk
         if self.install_config['direct_boot']:
             if self.install_type == "iso":
-                iso_locations = self.cache.retrieve_and_cache_object(
-                        "install-iso", self, self.install_media_location, True)
-                self.iso_volume = iso_locations['cinder']
-                self.iso_aki = self.cache.retrieve_and_cache_object(
-                        "install-iso-kernel", self, None, True)['glance']
-                self.iso_ari = self.cache.retrieve_and_cache_object(
-                        "install-iso-initrd", self, None, True)['glance']            
+                # Kernel and ramdisk are read straight out of the remote ISO, so
+                # the ISO itself need not be kept locally and is uploaded meanwhile.
+                # They are submitted first so that the ISO fill leaves them to these calls.
+                kernel = self.cache.retrieve_and_cache_object_async(
+                        "install-iso-kernel", self, self.install_media_location, True)
+                ramdisk = self.cache.retrieve_and_cache_object_async(
+                        "install-iso-initrd", self, self.install_media_location, True)
+                iso = self.cache.retrieve_and_cache_object_async(
+                        "install-iso", self, self.install_media_location, False)
+                self.iso_aki = kernel.get()['glance']
+                self.iso_ari = ramdisk.get()['glance']
+                self.iso_volume = iso.get()['cinder']
                 self.log.debug ("Prepared cinder iso (%s), aki (%s) and ari \
                         (%s) for install instance" % (self.iso_volume, 
                             self.iso_aki, self.iso_ari))    
@@ -75,12 +84,14 @@ class UbuntuOS(BaseOS):
                         self.url_content_dict()["install-url-kernel"])
                 ramdisk_location = "%s%s" % (self.install_media_location, 
                         self.url_content_dict()["install-url-initrd"])
-                self.tree_aki = self.cache.retrieve_and_cache_object(
+                kernel = self.cache.retrieve_and_cache_object_async(
                         "install-url-kernel", self, kernel_location, 
-                        True)['glance']
-                self.tree_ari = self.cache.retrieve_and_cache_object(
+                        False, ttl=self.URL_CONTENT_TTL)
+                ramdisk = self.cache.retrieve_and_cache_object_async(
                         "install-url-initrd", self, ramdisk_location,
-                        True)['glance']
+                        False, ttl=self.URL_CONTENT_TTL)
+                self.tree_aki = kernel.get()['glance']
+                self.tree_ari = ramdisk.get()['glance']
                 self.log.debug ("Prepared cinder aki (%s) and ari (%s) for \
                         install instance" % (self.tree_aki,
                             self.tree_ari))
@@ -88,13 +99,15 @@ class UbuntuOS(BaseOS):
         #Else, download kernel and ramdisk and prepare syslinux image with the two
         else:
             if self.install_type == "iso":
-                iso_locations = self.cache.retrieve_and_cache_object(
-                        "install-iso", self, self.install_media_location, True)
-                self.iso_volume = iso_locations['cinder']
-                self.iso_aki = self.cache.retrieve_and_cache_object(
-                        "install-iso-kernel",  self, None, True)['local']
-                self.iso_ari = self.cache.retrieve_and_cache_object(
-                        "install-iso-initrd",  self, None, True)['local']
+                kernel = self.cache.retrieve_and_cache_object_async(
+                        "install-iso-kernel",  self, self.install_media_location, True)
+                ramdisk = self.cache.retrieve_and_cache_object_async(
+                        "install-iso-initrd",  self, self.install_media_location, True)
+                iso = self.cache.retrieve_and_cache_object_async(
+                        "install-iso", self, self.install_media_location, False)
+                self.iso_aki = kernel.get()['local']
+                self.iso_ari = ramdisk.get()['local']
+                self.iso_volume = iso.get()['cinder']
                 self.boot_disk_id = self.syslinux.create_syslinux_stub(
                         "%s syslinux" % self.os_ver_arch(), self.cmdline, 
                         self.iso_aki, self.iso_ari)
@@ -106,12 +119,14 @@ class UbuntuOS(BaseOS):
                         self.url_content_dict()["install-url-kernel"])
                 ramdisk_location = "%s%s" % (self.install_media_location, 
                         self.url_content_dict()["install-url-initrd"])
-                self.url_aki = self.cache.retrieve_and_cache_object(
+                kernel = self.cache.retrieve_and_cache_object_async(
                         "install-url-kernel",  self, kernel_location, 
-                        True)['local']
-                self.url_ari = self.cache.retrieve_and_cache_object(
+                        True, ttl=self.URL_CONTENT_TTL)
+                ramdisk = self.cache.retrieve_and_cache_object_async(
                         "install-url-initrd",  self, ramdisk_location, 
-                        True)['local']
+                        True, ttl=self.URL_CONTENT_TTL)
+                self.url_aki = kernel.get()['local']
+                self.url_ari = ramdisk.get()['local']
                 self.boot_disk_id = self.syslinux.create_syslinux_stub(
                         "%s syslinux" % self.os_ver_arch(), self.cmdline, 
                         self.url_aki, self.url_ari)
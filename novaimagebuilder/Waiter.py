@@ -0,0 +1,165 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import logging
+import random
+import threading
+import time
+
+
+class WaitTimeout(Exception):
+    """
+    Raised by Waiter when its deadline passes before the wait is over.
+    """
+    pass
+
+
+class Waiter(object):
+    """
+    Wait for something to happen to a resource in OpenStack, such as an image becoming
+    active, by calling a check function until it returns something other than None.  The
+    check is called again after INITIAL_INTERVAL seconds, and the interval grows by FACTOR
+    up to MAX_INTERVAL after each call, so short operations are noticed quickly and long
+    ones do not flood the APIs.  Each interval is shortened or lengthened at random by up to
+    JITTER of itself, so that many builds started together do not poll in step.
+
+    The check raises to make the wait fail.  Waits can run in the background with
+    wait_async(), and wake() cuts the current interval short, for instance when a
+    StatusMonitor sees the resource change.
+
+    @param description: What is being waited for, for the log and for errors
+    @param timeout: Seconds to wait before raising WaitTimeout, or None to wait for ever
+    @param initial_interval: Seconds before the second check (default: INITIAL_INTERVAL)
+    @param max_interval: Longest time between two checks (default: MAX_INTERVAL)
+    """
+
+    INITIAL_INTERVAL = 0.5
+    MAX_INTERVAL = 15
+    FACTOR = 1.5
+    JITTER = 0.2
+
+    def __init__(self, description, timeout=None, initial_interval=None, max_interval=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self.description = description
+        self.timeout = timeout
+        self.initial_interval = initial_interval or self.INITIAL_INTERVAL
+        self.max_interval = max_interval or self.MAX_INTERVAL
+        # Number of times the check was called by the last wait
+        self.checks = 0
+        self._wake = threading.Event()
+
+    def intervals(self):
+        """
+        @return: generator of the successive seconds to sleep between checks
+        """
+        interval = self.initial_interval
+        while True:
+            yield interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+            interval = min(self.max_interval, interval * self.FACTOR)
+
+    def wait(self, check):
+        """
+        @param check: function called without arguments, returning None to go on waiting
+        @return: The first value check returned other than None
+        @raise WaitTimeout: When the timeout passes first
+        """
+        self.checks = 0
+        start = time.time()
+        deadline = None
+        if self.timeout is not None:
+            deadline = start + self.timeout
+        for interval in self.intervals():
+            self.checks += 1
+            result = check()
+            if result is not None:
+                self.log.debug("Done waiting for %s after %ds and %d checks" %
+                               (self.description, time.time() - start, self.checks))
+                return result
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise WaitTimeout("Timed out after %ds waiting for %s" % (time.time() - start, self.description))
+                interval = min(interval, remaining)
+            self._wake.wait(interval)
+            self._wake.clear()
+
+    def wake(self, *args):
+        """
+        Check again straight away rather than at the end of the current interval.  Takes and
+        ignores any arguments, so that it can be used as a callback.
+        """
+        self._wake.set()
+
+    def wait_async(self, check, callback=None):
+        """
+        Run wait() in a background thread.
+
+        @param callback: Optional function called with the WaitResult once the wait is over
+        @return: WaitResult
+        """
+        result = WaitResult(callback)
+
+        def _run():
+            try:
+                result._set(self.wait(check), None)
+            except Exception, e:
+                result._set(None, e)
+        thread = threading.Thread(target=_run, name="Waiter for %s" % self.description)
+        thread.daemon = True
+        thread.start()
+        return result
+
+
+class WaitResult(object):
+    """
+    Outcome of a Waiter.wait_async(), available once ready() is True.
+    """
+
+    def __init__(self, callback=None):
+        self.log = logging.getLogger('%s.%s' % (__name__, self.__class__.__name__))
+        self._done = threading.Event()
+        self._callback = callback
+        self._value = None
+        self._error = None
+
+    def ready(self):
+        return self._done.is_set()
+
+    def successful(self):
+        return self.ready() and self._error is None
+
+    def get(self, timeout=None):
+        """
+        @param timeout: Seconds to wait for the outcome, or None to wait for ever
+        @return: The value the wait returned
+        @raise: The exception the wait raised, or WaitTimeout if timeout passes first
+        """
+        self._done.wait(timeout)
+        if not self.ready():
+            raise WaitTimeout("Wait is still running")
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _set(self, value, error):
+        self._value = value
+        self._error = error
+        self._done.set()
+        if self._callback is not None:
+            try:
+                self._callback(self)
+            except Exception:
+                self.log.exception("Wait callback failed")
@@ -53,8 +53,9 @@ class WindowsOS(BaseOS):
         # TODO: Automate
         driver_locations = self.cache.retrieve_and_cache_object("driver-iso", self, None, True)
         self.driver_iso_volume = driver_locations['cinder']
+        # The ISO is only needed locally if it has to be respun
         iso_locations = self.cache.retrieve_and_cache_object("install-iso",
-                self, self.install_media_location, True)
+                self, self.install_media_location, not self.env.is_floppy())
         if self.env.is_floppy():
             self.iso_volume = iso_locations['cinder']
             self._prepare_floppy()
@@ -66,6 +67,12 @@ class WindowsOS(BaseOS):
             self.iso_volume_delete = True
 
 
+    def cache_install_media(self):
+        # The driver ISO has to be cached beforehand, see prepare_install_instance()
+        iso_locations = self.cache.retrieve_and_cache_object("install-iso",
+                self, self.install_media_location, not self.env.is_floppy())
+        return { "install-iso": iso_locations }
+
     def start_install_instance(self):
         if self.install_type == "iso":
             self.log.debug("Launching windows install instance")
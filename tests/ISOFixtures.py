@@ -0,0 +1,41 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+# Contents of the files in the fixture ISOs - see fixtures/README
+KERNEL = 'kernel' * 2000
+INITRD = 'initrd' * 1000
+VOLUME_ID = 'TESTVOL'
+
+
+def fixture_iso(name):
+    """
+    @param name: 'plain', 'joliet' or 'rockridge'
+    @return: Path to the fixture ISO with that name, which must not be modified
+    """
+    return os.path.join(FIXTURE_DIR, name + '.iso')
+
+
+def copy_fixture_iso(name, directory):
+    """
+    @return: Path to a copy of the fixture ISO in directory, free to be modified or removed
+    """
+    iso = os.path.join(directory, name + '.iso')
+    shutil.copy(fixture_iso(name), iso)
+    return iso
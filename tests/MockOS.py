@@ -31,8 +31,8 @@ class MockOS(object):
         self.install_config = install_config
         self.install_script = install_script
         self.iso_content_flag = False
-        self.iso_content_dict = None
-        self.url_content_dict = None
+        self.iso_content = None
+        self.url_content = None
 
     def os_ver_arch(self):
         return self.osinfo_dict['shortid'] + "-" + self.install_config['arch']
@@ -50,10 +50,10 @@ class MockOS(object):
         return self.iso_content_flag
 
     def iso_content_dict(self):
-        return self.iso_content_dict
+        return self.iso_content
 
     def url_content_dict(self):
-        return self.url_content_dict
+        return self.url_content
 
     def abort(self):
         pass
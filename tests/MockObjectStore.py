@@ -0,0 +1,60 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+
+class MockObjectStore(object):
+    """
+    Mock implementation of an object store client for ObjectBlobStore, keeping the objects
+    in memory.
+
+    * The objects are in the dict attribute 'objects', keyed by name.
+
+    * Every call is appended to the list attribute 'calls' as a tuple of method and key.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.calls = []
+
+    def head(self, key):
+        self.calls.append(('head', key))
+        if key not in self.objects:
+            return None
+        return len(self.objects[key])
+
+    def download(self, key, filename):
+        self.calls.append(('download', key))
+        local_file = open(filename, 'wb')
+        try:
+            local_file.write(self.objects[key])
+        finally:
+            local_file.close()
+
+    def upload(self, key, filename):
+        self.calls.append(('upload', key))
+        local_file = open(filename, 'rb')
+        try:
+            self.objects[key] = local_file.read()
+        finally:
+            local_file.close()
+
+    def read(self, key):
+        self.calls.append(('read', key))
+        return self.objects.get(key)
+
+    def write(self, key, data):
+        self.calls.append(('write', key))
+        self.objects[key] = data
@@ -79,11 +79,17 @@ class MockStackEnvironment(Singleton):
         return self.direct_boot
 
     def upload_image_to_glance(self, name, local_path=None, location=None, format='raw', min_disk=0, min_ram=0,
-                               container_format='bare', is_public=True):
+                               container_format='bare', is_public=True, properties={}, data=None, size=None):
+        if data is not None:
+            while data.read(65536):
+                pass
         return uuid.uuid4()
 
     def upload_volume_to_cinder(self, name, volume_size=None, local_path=None, location=None, format='raw',
-                                container_format='bare', is_public=True, keep_image=True):
+                                container_format='bare', is_public=True, keep_image=True, data=None, size=None):
+        if data is not None:
+            while data.read(65536):
+                pass
         return uuid.uuid4(), uuid.uuid4()
 
     def create_volume_from_image(self, image_id, volume_size=None):
@@ -0,0 +1,63 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from ISOFixtures import KERNEL, INITRD, VOLUME_ID, fixture_iso
+from novaimagebuilder.ISOReader import ISOReader
+
+
+class TestISOReader(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.isos = dict([ (name, fixture_iso(name)) for name in ('plain', 'joliet', 'rockridge') ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_file(self):
+        for iso in self.isos.values():
+            reader = ISOReader(iso)
+            self.assertEqual(reader.volume_id, VOLUME_ID)
+            self.assertEqual(''.join(reader.read_file('/images/pxeboot/vmlinuz')), KERNEL)
+            self.assertEqual(reader.getsize('/images/pxeboot/initrd.img'), len(INITRD))
+            self.assertFalse(reader.exists('/images/pxeboot/missing'))
+            reader.close()
+
+    def test_extensions(self):
+        reader = ISOReader(self.isos['rockridge'])
+        self.assertIsNotNone(reader.rock_ridge_skip)
+        self.assertEqual(sorted(reader.listdir('/images/pxeboot')), ['initrd.img', 'vmlinuz'])
+        self.assertEqual(''.join(reader.read_file('/vmlinuz')), KERNEL)
+        reader.close()
+        reader = ISOReader(self.isos['joliet'])
+        self.assertIsNotNone(reader.joliet_root)
+        self.assertEqual(sorted(reader.listdir('/images/pxeboot')), ['initrd.img', 'vmlinuz'])
+        reader.close()
+
+    def test_extract_from_read_function(self):
+        iso = open(self.isos['plain'], 'rb')
+
+        def _read(offset, length):
+            iso.seek(offset)
+            return iso.read(length)
+        reader = ISOReader(_read)
+        local = os.path.join(self.tmp_dir, 'initrd')
+        self.assertEqual(reader.extract('/images/pxeboot/initrd.img', local), len(INITRD))
+        self.assertEqual(open(local).read(), INITRD)
+        iso.close()
@@ -16,9 +16,18 @@
 
 import tempfile
 import os
+import shutil
 import sys
+import threading
+import time
+import socket
+import subprocess
+import hashlib
+import json
 from unittest import TestCase
 from MockOS import MockOS
+from MockObjectStore import MockObjectStore
+from ISOFixtures import KERNEL, INITRD, copy_fixture_iso
 
 # Force CacheManager to use MockStackEnvironment
 import MockStackEnvironment
@@ -26,6 +35,7 @@ sys.modules['StackEnvironment'] = sys.modules.pop('MockStackEnvironment')
 sys.modules['StackEnvironment'].StackEnvironment = sys.modules['StackEnvironment'].MockStackEnvironment
 import StackEnvironment
 import novaimagebuilder.CacheManager as CacheManager
+from novaimagebuilder.ObjectBlobStore import ObjectBlobStore
 
 
 CacheManager.StackEnvironment = StackEnvironment
@@ -33,18 +43,59 @@ CacheManager.StackEnvironment = StackEnvironment
 
 class TestCacheManager(TestCase):
     def setUp(self):
+        # Every test gets a cache of its own, so that nothing it indexes or stores outlives it
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_root = CacheManager.CacheManager.CACHE_ROOT
+        CacheManager.CacheManager.CACHE_ROOT = os.path.join(self.tmp_dir, 'cache') + '/'
+        CacheManager.CacheManager._instance = None
+        CacheManager.TransferScheduler._instance = None
         self.cache_mgr = CacheManager.CacheManager()
         self.os_dict = {'shortid': 'mockos'}
         self.install_config = {'arch': 'mockarch'}
         self.os = MockOS(self.os_dict, 'mock-install', 'nowhere', self.install_config)
-        self.tmp_file = tempfile.NamedTemporaryFile(delete=False)
-        self.tmp_file.close()
+        self.os_ver_arch = self.os.os_ver_arch()
+        self.source = os.path.join(self.tmp_dir, 'source')
+        open(self.source, 'w').close()
 
     def tearDown(self):
-        os.remove(self.tmp_file.name)
-        del self.tmp_file
-        del self.cache_mgr
-        del self.os
+        self.cache_mgr.release_objects()
+        if self.cache_mgr.async_pool is not None:
+            self.cache_mgr.async_pool.close()
+            self.cache_mgr.async_pool.join()
+        CacheManager.CacheManager.CACHE_ROOT = self.cache_root
+        CacheManager.CacheManager._instance = None
+        CacheManager.TransferScheduler._instance = None
+        # Index connections of finished worker threads close whenever they are collected, taking
+        # their sqlite journal files with them
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _source_url(self, content=None):
+        """
+        @param content: New content for the source file, or None to leave it as it is
+        @return: URL of the source file
+        """
+        if content is not None:
+            source = open(self.source, 'w')
+            source.write(content)
+            source.close()
+        return 'file://' + self.source
+
+    def _index_value(self, os_ver_arch, name, location=None):
+        self.cache_mgr.lock_and_get_index(shared=True)
+        try:
+            return self.cache_mgr._get_index_value(os_ver_arch, name, location)
+        finally:
+            self.cache_mgr.unlock_index()
+
+    def _remove_index_value(self, os_ver_arch, name):
+        self.cache_mgr.lock_and_get_index()
+        del self.cache_mgr.index[os_ver_arch][name]
+        self.cache_mgr.write_index_and_unlock()
+
+    def _wants_iso_content(self):
+        self.os.iso_content_flag = True
+        self.os.iso_content = {'install-iso-kernel': '/images/pxeboot/vmlinuz',
+                               'install-iso-initrd': '/images/pxeboot/initrd.img'}
 
     def test_lock_and_get_index(self):
         self.assertIsNone(self.cache_mgr.index)
@@ -54,6 +105,35 @@ class TestCacheManager(TestCase):
         self.cache_mgr.unlock_index()
         self.assertIsNone(self.cache_mgr.index)
 
+    def test_lock_and_get_index_threads(self):
+        # A second thread queues for the index instead of failing
+        self.cache_mgr.lock_and_get_index()
+        results = []
+
+        def _writer():
+            self.cache_mgr.lock_and_get_index()
+            results.append(self.cache_mgr.index is not None)
+            self.cache_mgr.unlock_index()
+        writer = threading.Thread(target=_writer)
+        writer.start()
+        writer.join(0.5)
+        self.assertTrue(writer.is_alive())
+        self.cache_mgr.unlock_index()
+        writer.join(10)
+        self.assertEqual(results, [True])
+        # Shared locks are held alongside each other
+        self.cache_mgr.lock_and_get_index(shared=True)
+
+        def _reader():
+            self.cache_mgr.lock_and_get_index(shared=True, timeout=1)
+            results.append(self.cache_mgr.index is not None)
+            self.cache_mgr.unlock_index()
+        reader = threading.Thread(target=_reader)
+        reader.start()
+        reader.join(10)
+        self.cache_mgr.unlock_index()
+        self.assertEqual(results, [True, True])
+
     def test_write_index_and_unlock(self):
         self.cache_mgr.lock_and_get_index()
         self.cache_mgr._set_index_value('TestOS1', 'Test', 'nowhere', True)
@@ -61,16 +141,11 @@ class TestCacheManager(TestCase):
         self.assertRaises(Exception, self.cache_mgr._set_index_value, ('TestOS3', 'Test', None, 0))
         self.cache_mgr.write_index_and_unlock()
         self.assertIsNone(self.cache_mgr.index)
+        self.assertTrue(self._index_value('TestOS1', 'Test', 'nowhere'))
+        self.assertIsInstance(self._index_value('TestOS2', 'Test'), dict)
         self.cache_mgr.lock_and_get_index()
-        self.assertTrue(self.cache_mgr._get_index_value('TestOS1', 'Test', 'nowhere'))
-        self.assertIsInstance(self.cache_mgr._get_index_value('TestOS2', 'Test', None), dict)
         self.assertIsNone(self.cache_mgr.index.get('TestOS3'))
-        try:
-            del self.cache_mgr.index['TestOS1']
-            del self.cache_mgr.index['TestOS2']
-            self.cache_mgr.write_index_and_unlock()
-        except KeyError:
-            pass
+        self.cache_mgr.unlock_index()
 
     def test_unlock_index(self):
         self.cache_mgr.lock_and_get_index()
@@ -78,13 +153,248 @@ class TestCacheManager(TestCase):
         self.cache_mgr.unlock_index()
         self.assertIsNone(self.cache_mgr.index)
 
+    def test_lock_object(self):
+        held = self.cache_mgr._lock_object('TestOS1', 'Test')
+        self.assertIsNotNone(held)
+        self.assertIsNone(self.cache_mgr._lock_object('TestOS1', 'Test', timeout=0.1))
+        # A different object is not affected
+        other = self.cache_mgr._lock_object('TestOS1', 'Other', timeout=0.1)
+        self.assertIsNotNone(other)
+        self.cache_mgr._unlock_object(other)
+        # A waiter is woken as soon as the holder lets go rather than on a polling interval
+        releaser = threading.Timer(0.2, self.cache_mgr._unlock_object, (held,))
+        start = time.time()
+        releaser.start()
+        waiter = self.cache_mgr._lock_object('TestOS1', 'Test', timeout=10)
+        self.assertIsNotNone(waiter)
+        self.assertLess(time.time() - start, 5)
+        self.cache_mgr._unlock_object(waiter)
+
     def test_retrieve_and_cache_object(self):
-        locations = self.cache_mgr.retrieve_and_cache_object('mock-obj', self.os, 'file://' + self.tmp_file.name, False)
+        locations = self.cache_mgr.retrieve_and_cache_object('mock-obj', self.os, self._source_url(), False)
         self.assertIsNotNone(locations)
         self.assertIsInstance(locations, dict)
+
+    def test_retrieve_and_cache_object_takes_over_dead_owner(self):
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        self.cache_mgr.lock_and_get_index()
+        self.cache_mgr._set_index_value(self.os_ver_arch, 'mock-orphan', None,
+                                        {'pending': {'host': socket.gethostname(), 'pid': dead.pid,
+                                                     'started': time.time(), 'lease': 3600}})
+        self.cache_mgr.write_index_and_unlock()
+        start = time.time()
+        locations = self.cache_mgr.retrieve_and_cache_object('mock-orphan', self.os, self._source_url(), False)
+        self.assertLess(time.time() - start, 30)
+        self.assertNotIn('pending', locations)
+
+    def test_retrieve_and_cache_object_pending_timeout(self):
+        # A live owner that never finishes
+        held = self.cache_mgr._lock_object(self.os_ver_arch, 'mock-stuck')
+        self.cache_mgr.lock_and_get_index()
+        self.cache_mgr._set_index_value(self.os_ver_arch, 'mock-stuck', None,
+                                        {'pending': self.cache_mgr._new_lease()})
+        self.cache_mgr.write_index_and_unlock()
+        self.cache_mgr.PENDING_TIMEOUT = 0.5
         try:
-            self.cache_mgr.lock_and_get_index()
-            del self.cache_mgr.index['%s-%s' % (self.os_dict['shortid'], self.install_config['arch'])]
-            self.cache_mgr.write_index_and_unlock()
-        except KeyError:
-            pass
\ No newline at end of file
+            self.assertRaisesRegexp(Exception, 'Waited 0.5 seconds on pending cache fill',
+                                    self.cache_mgr.retrieve_and_cache_object, 'mock-stuck', self.os,
+                                    self._source_url(), False)
+        finally:
+            self.cache_mgr._unlock_object(held)
+
+    def test_retrieve_and_cache_object_checksum(self):
+        source_url = self._source_url('checksummed content')
+        sha256 = hashlib.sha256('checksummed content').hexdigest()
+        self.assertRaises(Exception, self.cache_mgr.retrieve_and_cache_object, 'mock-checksum', self.os,
+                          source_url, False, '0' * 64)
+        self.assertIsNone(self._index_value(self.os_ver_arch, 'mock-checksum'))
+        locations = self.cache_mgr.retrieve_and_cache_object('mock-checksum', self.os, source_url, True, sha256)
+        self.assertEqual(locations['sha256'], sha256)
+        self.assertEqual(locations['size'], len('checksummed content'))
+
+    def test_retrieve_and_cache_object_streams(self):
+        source_url = self._source_url('streamed content' * 10000)
+        sha256 = hashlib.sha256('streamed content' * 10000).hexdigest()
+        self.assertRaises(Exception, self.cache_mgr.retrieve_and_cache_object, 'mock-stream', self.os,
+                          source_url, False, '0' * 64)
+        locations = self.cache_mgr.retrieve_and_cache_object('mock-stream', self.os, source_url, False)
+        self.assertIsNone(locations['local'])
+        self.assertEqual(locations['sha256'], sha256)
+        self.assertEqual(locations['size'], len('streamed content') * 10000)
+        self.assertFalse(os.path.exists(self.cache_mgr.CACHE_ROOT + self.os_ver_arch + '-mock-stream'))
+
+    def test_retrieve_and_cache_object_dedup(self):
+        source_url = self._source_url('shared content')
+        first = self.cache_mgr.retrieve_and_cache_object('mock-dedup1', self.os, source_url, True)
+        second = self.cache_mgr.retrieve_and_cache_object('mock-dedup2', self.os, source_url, True)
+        self.assertEqual(first['local'], second['local'])
+        self.assertEqual(first['glance'], second['glance'])
+        self.assertFalse(os.path.exists(self.cache_mgr.CACHE_ROOT + self.os_ver_arch + '-mock-dedup2'))
+
+    def test_retrieve_and_cache_object_evicts_lru(self):
+        old = self.cache_mgr.retrieve_and_cache_object('mock-evict1', self.os, self._source_url('old content'),
+                                                       True)
+        self.cache_mgr.release_objects()
+        self.cache_mgr.MAX_SIZE = len('new content')
+        new = self.cache_mgr.retrieve_and_cache_object('mock-evict2', self.os, self._source_url('new content'),
+                                                       True)
+        self.assertFalse(os.path.exists(old['local']))
+        self.assertTrue(os.path.exists(new['local']))
+        self.assertIsNone(self._index_value(self.os_ver_arch, 'mock-evict1', 'local'))
+        # Pinned objects survive even when they alone exceed the limit
+        self.cache_mgr.MAX_SIZE = 0
+        self.cache_mgr._make_room()
+        self.assertTrue(os.path.exists(new['local']))
+        self.cache_mgr.release_objects()
+        self.cache_mgr._make_room()
+        self.assertFalse(os.path.exists(new['local']))
+
+    def test_migrate_json_index(self):
+        json_filename = os.path.join(self.tmp_dir, 'index.json')
+        json_index = open(json_filename, 'w')
+        json.dump({'TestOS1': {'Test': {'local': '/nowhere', 'glance': 'UUID'}}}, json_index)
+        json_index.close()
+        self.cache_mgr._migrate_json_index(json_filename)
+        self.assertFalse(os.path.exists(json_filename))
+        self.assertTrue(os.path.exists(json_filename + '.migrated'))
+        self.assertEqual(self._index_value('TestOS1', 'Test', 'glance'), 'UUID')
+
+    def test_retrieve_and_cache_object_iso_content(self):
+        self._wants_iso_content()
+        iso_url = 'file://' + copy_fixture_iso('rockridge', self.tmp_dir)
+        # The kernel is read from the ISO in place, without caching the ISO
+        kernel = self.cache_mgr.retrieve_and_cache_object('install-iso-kernel', self.os, iso_url, True)
+        self.assertEqual(open(kernel['local']).read(), KERNEL)
+        self.assertIsNone(self._index_value(self.os_ver_arch, 'install-iso'))
+
+    def test_retrieve_and_cache_object_repairs_iso_content(self):
+        self._wants_iso_content()
+        iso = copy_fixture_iso('rockridge', self.tmp_dir)
+        iso_locations = self.cache_mgr.retrieve_and_cache_object('install-iso', self.os, 'file://' + iso, True)
+        kernel = self._index_value(self.os_ver_arch, 'install-iso-kernel')
+        self.assertEqual(open(kernel['local']).read(), KERNEL)
+        self._remove_index_value(self.os_ver_arch, 'install-iso-initrd')
+        os.remove(iso)
+        # The ISO content was filled along with the ISO - a hit does not check it again
+        self.cache_mgr.retrieve_and_cache_object('install-iso', self.os, 'file://' + iso, True)
+        self.assertIsNone(self._index_value(self.os_ver_arch, 'install-iso-initrd'))
+        # Once it is due for a check, the missing initrd is extracted from the cached ISO again
+        self.cache_mgr.ISO_CONTENT_CHECK_INTERVAL = 0
+        self.cache_mgr.retrieve_and_cache_object('install-iso', self.os, 'file://' + iso, True)
+        self.assertGreater(self._index_value(self.os_ver_arch, 'install-iso', 'content_checked'),
+                           iso_locations['content_checked'])
+        self.assertEqual(self._index_value(self.os_ver_arch, 'install-iso-kernel'), kernel)
+        repaired = self._index_value(self.os_ver_arch, 'install-iso-initrd')
+        self.assertEqual(open(repaired['local']).read(), INITRD)
+
+    def test_retrieve_and_cache_object_revalidates(self):
+        first = self.cache_mgr.retrieve_and_cache_object('mock-ttl', self.os, self._source_url('first version'),
+                                                         True, ttl=0)
+        self.assertIsNotNone(first['last_modified'])
+        # Unchanged - the cached copy is kept and only its validation time moves on
+        again = self.cache_mgr.retrieve_and_cache_object('mock-ttl', self.os, self._source_url(), True, ttl=0)
+        self.assertEqual(again['glance'], first['glance'])
+        self.assertGreater(again['validated'], first['validated'])
+        source_url = self._source_url('second version')
+        os.utime(self.source, (time.time() + 60, time.time() + 60))
+        # Within its TTL the cached copy is used without looking at the source
+        cached = self.cache_mgr.retrieve_and_cache_object('mock-ttl', self.os, source_url, True, ttl=3600)
+        self.assertEqual(cached['sha256'], first['sha256'])
+        changed = self.cache_mgr.retrieve_and_cache_object('mock-ttl', self.os, source_url, True, ttl=0)
+        self.assertNotEqual(changed['sha256'], first['sha256'])
+        self.assertEqual(open(changed['local']).read(), 'second version')
+
+    def test_retrieve_and_cache_object_async(self):
+        source_url = self._source_url('async content')
+        results = [ self.cache_mgr.retrieve_and_cache_object_async(name, self.os, source_url, True)
+                    for name in ('mock-async1', 'mock-async2') ]
+        first, second = [ result.get(60) for result in results ]
+        self.assertEqual(open(first['local']).read(), 'async content')
+        self.assertEqual(first['local'], second['local'])
+        failed = self.cache_mgr.retrieve_and_cache_object_async('mock-async3', self.os, 'file:///no/such/file', True)
+        self.assertRaises(Exception, failed.get, 60)
+
+    def test_retrieve_and_cache_object_async_iso_content(self):
+        self._wants_iso_content()
+        # Keep the kernel fetch from getting anywhere until we are done looking
+        held = self.cache_mgr._lock_object(self.os_ver_arch, 'install-iso-kernel')
+        try:
+            kernel = self.cache_mgr.retrieve_and_cache_object_async('install-iso-kernel', self.os,
+                                                                    'file:///no/such/install.iso', True)
+            # An install ISO fill leaves the kernel to its own fetch, whether or not that has started
+            self.assertEqual(self.cache_mgr._missing_iso_content(self.os), ['install-iso-initrd'])
+        finally:
+            self.cache_mgr._unlock_object(held)
+        self.assertRaises(Exception, kernel.get, 60)
+        self.assertEqual(sorted(self.cache_mgr._missing_iso_content(self.os)),
+                         ['install-iso-initrd', 'install-iso-kernel'])
+
+    def test_stats(self):
+        source_url = self._source_url('counted content')
+        before = self.cache_mgr.stats(totals=False)
+        self.cache_mgr.retrieve_and_cache_object('mock-stats', self.os, source_url, True)
+        self.cache_mgr.retrieve_and_cache_object('mock-stats', self.os, source_url, True)
+        after = self.cache_mgr.stats(totals=False)
+        self.assertEqual(after['misses'] - before['misses'], 1)
+        self.assertEqual(after['hits'] - before['hits'], 1)
+        self.assertEqual(after['fills'] - before['fills'], 1)
+        self.assertEqual(after['bytes_downloaded'] - before['bytes_downloaded'], len('counted content'))
+        self.assertEqual(after['phases']['download']['count'] - before['phases']['download']['count'], 1)
+        self.assertIn('novaimagebuilder_cache_hits_total', self.cache_mgr.stats_prometheus())
+        # Flushing moves the counts of this process into the shared totals
+        totals = self.cache_mgr.stats()
+        self.cache_mgr.release_objects()
+        self.assertEqual(self.cache_mgr.stats(totals=False)['hits'], 0)
+        self.assertEqual(self.cache_mgr.stats()['hits'], totals['hits'])
+
+    def test_object_blob_store(self):
+        source_url = self._source_url('shared content')
+        client = MockObjectStore()
+        self.cache_mgr.blob_store = ObjectBlobStore(os.path.join(self.tmp_dir, 'local'), client)
+        first = self.cache_mgr.retrieve_and_cache_object('mock-shared', self.os, source_url, True)
+        self.assertEqual(client.objects['sha256/' + first['sha256']], 'shared content')
+        # Another host has neither the index entry nor the local copy, and its source is gone
+        self.cache_mgr.release_objects()
+        self._remove_index_value(self.os_ver_arch, 'mock-shared')
+        os.remove(first['local'])
+        os.utime(self.source, None)
+        second = self.cache_mgr.retrieve_and_cache_object('mock-shared', self.os, source_url, True,
+                                                          expected_sha256=first['sha256'])
+        self.assertIn(('download', 'sha256/' + first['sha256']), client.calls)
+        self.assertEqual(open(second['local']).read(), 'shared content')
+
+    def test_blank_disk_image(self):
+        created = [ ]
+
+        def _create_blank_disk(filename, size):
+            created.append(size)
+            open(filename, 'w').close()
+        self.cache_mgr._create_blank_disk = _create_blank_disk
+        before = self.cache_mgr.stats(totals=False)
+        properties = {'kernel_id': 'aki', 'ramdisk_id': 'ari', 'os_command_line': 'ks=x'}
+        first = self.cache_mgr.blank_disk_image(10, properties)
+        self.assertEqual(self.cache_mgr.blank_disk_image(10, dict(properties)), first)
+        self.assertNotEqual(self.cache_mgr.blank_disk_image(10), first)
+        self.assertEqual(created, [10, 10])
+        # Templates are counted apart from the install media hit ratio
+        after = self.cache_mgr.stats(totals=False)
+        self.assertEqual(after['blank_disk_hits'] - before['blank_disk_hits'], 1)
+        self.assertEqual(after['blank_disk_misses'] - before['blank_disk_misses'], 2)
+        self.assertEqual(after['hits'], before['hits'])
+        self.assertEqual(after['misses'], before['misses'])
+        # Giving up on a template being created elsewhere is reported, not raced
+        held = self.cache_mgr._lock_object(self.cache_mgr.BLANK_DISK_INDEX, 'qcow2-20G')
+        self.cache_mgr.PENDING_TIMEOUT = 0.1
+        try:
+            self.assertRaises(Exception, self.cache_mgr.blank_disk_image, 20)
+        finally:
+            self.cache_mgr._unlock_object(held)
+        self.assertEqual(created, [10, 10])
+        # A template whose image is no longer usable is replaced
+        self.cache_mgr.env.image_status_index = 4
+        try:
+            self.cache_mgr.blank_disk_image(10)
+        finally:
+            self.cache_mgr.env.image_status_index = 2
+        self.assertEqual(created, [10, 10, 10])
@@ -0,0 +1,134 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from unittest import TestCase
+import novaimagebuilder.CacheWarmer as CacheWarmerModule
+from novaimagebuilder.CacheWarmer import CacheWarmer
+
+
+class MockMedia(object):
+    def __init__(self, arch, url, installer=True):
+        self.arch = arch
+        self.url = url
+        self.installer = installer
+
+    def get_architecture(self):
+        return self.arch
+
+    def get_url(self):
+        return self.url
+
+    def get_installer(self):
+        return self.installer
+
+
+class MockOSInfo(object):
+    OSES = {'fedora19': {'shortid': 'fedora19',
+                         'media_list': [MockMedia('i386', 'http://mirror/f19-i386.iso'),
+                                        MockMedia('x86_64', 'http://mirror/f19-live.iso', installer=False),
+                                        MockMedia('x86_64', 'http://mirror/f19-x86_64.iso')],
+                         'tree_list': [MockMedia('x86_64', 'http://mirror/f19/x86_64/os/')]},
+            'rhel6.4': {'shortid': 'rhel6.4', 'media_list': [],
+                        'tree_list': [MockMedia('x86_64', 'http://mirror/rhel/x86_64/os/')]}}
+
+    def os_for_shortid(self, shortid):
+        return self.OSES.get(shortid)
+
+
+class MockDelegate(object):
+    def __init__(self, shortid, cache):
+        self.shortid = shortid
+        self.cache = cache
+
+    def os_ver_arch(self):
+        return self.shortid + '-x86_64'
+
+    def cache_install_media(self):
+        return self.cache.media[self.shortid]
+
+
+class MockCache(object):
+    def __init__(self):
+        # What cache_install_media() returns for each OS
+        self.media = { }
+        # What cached_objects() returns for each os_ver_arch
+        self.cached = { }
+        self.released = 0
+
+    def cached_objects(self, os_ver_arch):
+        return self.cached.get(os_ver_arch, { })
+
+    def release_objects(self):
+        self.released += 1
+
+
+class TestCacheWarmer(TestCase):
+    def setUp(self):
+        self.cache = MockCache()
+        self.builders = [ ]
+        test = self
+
+        class MockBuilder(object):
+            def __init__(self, shortid, install_location=None, install_type=None, install_config=None):
+                test.builders.append((shortid, install_type, install_location))
+                self.os_delegate = MockDelegate(shortid, test.cache)
+        self.originals = (CacheWarmerModule.OSInfo, CacheWarmerModule.Builder, CacheWarmerModule.CacheManager)
+        CacheWarmerModule.OSInfo = MockOSInfo
+        CacheWarmerModule.Builder = MockBuilder
+        CacheWarmerModule.CacheManager = lambda: self.cache
+
+    def tearDown(self):
+        (CacheWarmerModule.OSInfo, CacheWarmerModule.Builder, CacheWarmerModule.CacheManager) = self.originals
+
+    def test_default_media(self):
+        warmer = CacheWarmer()
+        self.assertEqual(warmer._default_media(MockOSInfo.OSES['fedora19'], None),
+                         ('iso', 'http://mirror/f19-x86_64.iso'))
+        self.assertEqual(warmer._default_media(MockOSInfo.OSES['fedora19'], 'tree'),
+                         ('tree', 'http://mirror/f19/x86_64/os/'))
+        self.assertEqual(warmer._default_media(MockOSInfo.OSES['rhel6.4'], None),
+                         ('tree', 'http://mirror/rhel/x86_64/os/'))
+        self.assertRaises(Exception, warmer._default_media, MockOSInfo.OSES['rhel6.4'], 'iso')
+        self.assertRaises(Exception, CacheWarmer(arch='ppc64')._default_media, MockOSInfo.OSES['fedora19'], None)
+
+    def test_run(self):
+        self.cache.media['fedora19'] = {'install-iso': {'local': '/cache/iso', 'glance': 'new', 'sha256': 'a'},
+                                        'install-iso-kernel': {'local': '/cache/k', 'glance': 'k', 'sha256': 'b'}}
+        self.cache.cached['fedora19-x86_64'] = {'install-iso-kernel': {'local': '/cache/k', 'glance': 'k',
+                                                                       'sha256': 'b'}}
+        self.cache.media['rhel6.4'] = {'install-tree-kernel': {'local': None, 'glance': 'g', 'sha256': 'c'}}
+        warmer = CacheWarmer(workers=2)
+        warmer.add('fedora19')
+        warmer.add('rhel6.4', location='http://other/rhel/os/')
+        warmer.add('beos5')
+        reports = warmer.run()
+        self.assertEqual(self.cache.released, 1)
+        self.assertEqual([ report['shortid'] for report in reports ], ['fedora19', 'rhel6.4', 'beos5'])
+        (fedora, rhel, beos) = reports
+        self.assertIsNone(fedora['error'])
+        self.assertEqual(fedora['install_type'], 'iso')
+        self.assertEqual(fedora['location'], 'http://mirror/f19-x86_64.iso')
+        self.assertTrue(fedora['objects']['install-iso']['fetched'])
+        self.assertTrue(fedora['objects']['install-iso']['uploaded'])
+        # Already cached before the run
+        self.assertFalse(fedora['objects']['install-iso-kernel']['fetched'])
+        self.assertFalse(fedora['objects']['install-iso-kernel']['uploaded'])
+        self.assertEqual(rhel['install_type'], 'tree')
+        self.assertEqual(rhel['location'], 'http://other/rhel/os/')
+        self.assertIn(('rhel6.4', 'tree', 'http://other/rhel/os/'), self.builders)
+        # An unknown OS only fails its own report
+        self.assertIsNotNone(beos['error'])
+        self.assertEqual(beos['objects'], { })
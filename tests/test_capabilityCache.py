@@ -0,0 +1,62 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import shutil
+import tempfile
+from unittest import TestCase
+from novaimagebuilder.CapabilityCache import CapabilityCache
+
+
+class TestCapabilityCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = self.tmp_dir + '/capabilities.json'
+        self.probes = [ ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _probe(self):
+        self.probes.append(True)
+        return len(self.probes)
+
+    def test_get_probes_once(self):
+        cache = CapabilityCache(self.filename)
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 1)
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 1)
+        # Another process finds the result on disk
+        self.assertEqual(CapabilityCache(self.filename).get('cloud', 'cdrom', self._probe), 1)
+        self.assertEqual(CapabilityCache(self.filename).get('other', 'cdrom', self._probe), 2)
+        cache.invalidate('cloud')
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 3)
+        self.assertEqual(CapabilityCache(self.filename).get('other', 'cdrom', self._probe), 2)
+
+    def test_get_expires(self):
+        cache = CapabilityCache(self.filename, ttl=0)
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 1)
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 2)
+
+    def test_get_missing_directory(self):
+        filename = self.tmp_dir + '/missing/capabilities.json'
+        self.assertEqual(CapabilityCache(filename).get('cloud', 'cdrom', self._probe), 1)
+        self.assertEqual(CapabilityCache(filename).get('cloud', 'cdrom', self._probe), 1)
+
+    def test_get_unwritable(self):
+        # A file where the directory should be
+        open(self.tmp_dir + '/file', 'w').close()
+        cache = CapabilityCache(self.tmp_dir + '/file/capabilities.json')
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 1)
+        self.assertEqual(cache.get('cloud', 'cdrom', self._probe), 1)
@@ -0,0 +1,229 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from unittest import TestCase
+from novaimagebuilder.Downloader import Downloader
+
+
+class MockHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, content):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockHTTPHandler)
+        self.content = content
+        self.etag = '"v1"'
+        self.ranges = True
+        # Seconds to sleep per KiB sent
+        self.delay = 0
+        # Range header of each GET, or None for the whole object
+        self.requests = [ ]
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up part way through are expected
+        pass
+
+
+class MockHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self._send_headers(len(self.server.content))
+
+    def do_GET(self):
+        content = self.server.content
+        requested = self.headers.getheader('Range')
+        self.server.requests.append(requested)
+        if requested and self.server.ranges:
+            (start, end) = requested[len('bytes='):].split('-')
+            end = int(end or len(content) - 1)
+            body = content[int(start):end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %s-%d/%d' % (start, end, len(content)))
+        else:
+            body = content
+            self.send_response(200)
+        self._send_headers(len(body))
+        for offset in range(0, len(body), 1024):
+            self.wfile.write(body[offset:offset + 1024])
+            if self.server.delay:
+                time.sleep(self.server.delay)
+
+    def _send_headers(self, length):
+        self.send_header('Content-Length', str(length))
+        self.send_header('ETag', self.server.etag)
+        if self.server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+
+class TestDownloader(TestCase):
+    CONTENT = ''.join([ chr(i % 251) for i in range(256 * 1024) ])
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'install.iso')
+        self.sha256 = hashlib.sha256(self.CONTENT).hexdigest()
+        self.server = MockHTTPServer(self.CONTENT)
+        self.url = 'http://127.0.0.1:%d/install.iso' % self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _downloader(self, **kwargs):
+        downloader = Downloader(self.url, self.filename, **kwargs)
+        downloader.SEGMENT_MIN_SIZE = 16 * 1024
+        return downloader
+
+    def test_download_segmented(self):
+        reserved = [ ]
+        downloader = self._downloader(connections=4, expected_sha256=self.sha256, reserve_space=reserved.append)
+        self.assertEqual(downloader.download(), self.filename)
+        self.assertEqual(open(self.filename, 'rb').read(), self.CONTENT)
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertEqual(downloader.etag, '"v1"')
+        self.assertEqual(reserved, [len(self.CONTENT)])
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertIn('bytes=0-65535', self.server.requests)
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        self.assertFalse(os.path.exists(self.filename + '.part.state'))
+
+    def test_download_without_ranges(self):
+        self.server.ranges = False
+        downloader = self._downloader(connections=4)
+        downloader.download()
+        self.assertEqual(self.server.requests, [None])
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertEqual(open(self.filename, 'rb').read(), self.CONTENT)
+
+    def test_download_ranges_ignored(self):
+        downloader = self._downloader(connections=4)
+        # Advertises byte ranges, then sends the whole object anyway
+        downloader._probe()
+        self.server.ranges = False
+        downloader._probe = lambda: None
+        downloader.download()
+        self.assertEqual(self.server.requests[-1], None)
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertEqual(open(self.filename, 'rb').read(), self.CONTENT)
+
+    def test_download_checksum_mismatch(self):
+        downloader = self._downloader(expected_sha256='0' * 64)
+        self.assertRaises(Exception, downloader.download)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+        self.assertFalse(os.path.exists(self.filename + '.part.state'))
+
+    def _partial_download(self, done):
+        """
+        Leave behind what a download interrupted after done bytes of each segment would
+        """
+        downloader = self._downloader(connections=4)
+        downloader._probe()
+        segments = downloader._plan_segments()
+        downloader._create_part_file()
+        part_file = open(self.filename + '.part', 'r+b')
+        for segment in segments:
+            segment['done'] = done
+            part_file.seek(segment['start'])
+            part_file.write(self.CONTENT[segment['start']:segment['start'] + done])
+        part_file.close()
+        downloader._save_state(segments)
+        return segments
+
+    def test_download_resumes(self):
+        segments = self._partial_download(1000)
+        reserved = [ ]
+        downloader = self._downloader(connections=4, reserve_space=reserved.append)
+        downloader.download()
+        self.assertEqual(sorted(self.server.requests),
+                         sorted([ 'bytes=%d-%d' % (segment['start'] + 1000, segment['end']) for segment in segments ]))
+        self.assertEqual(reserved, [len(self.CONTENT) - 4000])
+        # Bytes from before the interruption are part of the checksum
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertEqual(open(self.filename, 'rb').read(), self.CONTENT)
+
+    def test_download_changed_object_restarts(self):
+        self._partial_download(1000)
+        self.server.etag = '"v2"'
+        downloader = self._downloader(connections=4)
+        downloader.download()
+        self.assertIn('bytes=0-65535', self.server.requests)
+        self.assertEqual(downloader.sha256, self.sha256)
+
+    def test_download_resumes_after_kill(self):
+        self.server.delay = 0.02
+        script = ("import sys; sys.path[:0] = %r\n"
+                  "from novaimagebuilder.Downloader import Downloader\n"
+                  "downloader = Downloader(%r, %r, connections=4)\n"
+                  "downloader.SEGMENT_MIN_SIZE = 16 * 1024\n"
+                  "downloader.STATE_SAVE_INTERVAL = 0\n"
+                  "downloader.download()\n" % (sys.path, self.url, self.filename))
+        child = subprocess.Popen([sys.executable, '-c', script])
+        state_filename = self.filename + '.part.state'
+        deadline = time.time() + 30
+        done = 0
+        while time.time() < deadline and child.poll() is None:
+            try:
+                segments = json.load(open(state_filename)).get('segments') or [ ]
+                done = sum([ segment['done'] for segment in segments ])
+            except (IOError, ValueError):
+                pass
+            if done > 0:
+                break
+            time.sleep(0.05)
+        os.kill(child.pid, signal.SIGKILL)
+        child.wait()
+        self.assertGreater(done, 0)
+        self.assertFalse(os.path.exists(self.filename))
+
+        self.server.delay = 0
+        del self.server.requests[:]
+        downloader = self._downloader(connections=4)
+        downloader.download()
+        # Every segment picks up where the killed download left it
+        self.assertNotIn('bytes=0-65535', self.server.requests)
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertEqual(open(self.filename, 'rb').read(), self.CONTENT)
+
+    def test_download_file(self):
+        source = os.path.join(self.tmp_dir, 'source.iso')
+        open(source, 'wb').write(self.CONTENT)
+        downloader = Downloader('file://' + source, self.filename)
+        downloader.download()
+        self.assertEqual(downloader.sha256, self.sha256)
+        self.assertIsNotNone(downloader.last_modified)
+        self.assertTrue(downloader.revalidate(last_modified=downloader.last_modified))
@@ -0,0 +1,102 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from novaimagebuilder.FileCopier import FileCopier
+
+
+class TestFileCopier(TestCase):
+    CONTENT = 'install media' * 100000
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmp_dir, 'source.iso')
+        open(self.source, 'w').write(self.CONTENT)
+        self.target = os.path.join(self.tmp_dir, 'cached')
+        self.sha256 = hashlib.sha256(self.CONTENT).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _copier(self, **kwargs):
+        copier = FileCopier(self.source, self.target, **kwargs)
+        # Not a valid ioctl, so reflinks are unsupported wherever the test runs
+        copier.FICLONE = 0
+        return copier
+
+    def test_copy(self):
+        reserved = [ ]
+        copier = self._copier(expected_sha256=self.sha256.upper(), reserve_space=reserved.append)
+        self.assertEqual(copier.copy(), self.target)
+        self.assertEqual(open(self.target).read(), self.CONTENT)
+        self.assertEqual(copier.sha256, self.sha256)
+        self.assertEqual(copier.size, len(self.CONTENT))
+        self.assertIsNotNone(copier.last_modified)
+        self.assertIn(copier.method, ('copy_file_range', 'sendfile', 'read/write'))
+        self.assertEqual(reserved, [len(self.CONTENT)])
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+    def test_copy_falls_back(self):
+        copier = self._copier()
+        copier._copy_file_range = lambda source, target: False
+        copier.copy()
+        self.assertIn(copier.method, ('sendfile', 'read/write'))
+        os.remove(self.target)
+        copier = self._copier()
+        copier._copy_file_range = lambda source, target: False
+        copier._sendfile = lambda source, target: False
+        copier.copy()
+        self.assertEqual(copier.method, 'read/write')
+        self.assertEqual(copier.sha256, self.sha256)
+        self.assertEqual(open(self.target).read(), self.CONTENT)
+
+    def test_copy_hardlink(self):
+        copier = self._copier(link=True)
+        copier.copy()
+        self.assertEqual(copier.method, 'hardlink')
+        self.assertEqual(os.stat(self.target).st_ino, os.stat(self.source).st_ino)
+        self.assertEqual(copier.sha256, self.sha256)
+
+    def test_copy_checksum_mismatch(self):
+        copier = self._copier(expected_sha256='0' * 64)
+        self.assertRaises(Exception, copier.copy)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+    def test_copy_size_mismatch(self):
+        copier = self._copier()
+        copier._copy_file_range = lambda source, target: False
+        copier._sendfile = lambda source, target: False
+
+        def _short_stream(source, target):
+            target.write(source.read(100))
+        copier._stream = _short_stream
+        self.assertRaises(Exception, copier.copy)
+        self.assertFalse(os.path.exists(self.target))
+        self.assertFalse(os.path.exists(self.target + '.part'))
+
+    def test_unsupported(self):
+        copier = self._copier()
+        self.assertFalse(copier._unsupported('reflink', IOError(errno.EOPNOTSUPP, 'not supported')))
+        try:
+            raise IOError(errno.EIO, 'broken disk')
+        except IOError, e:
+            self.assertRaises(IOError, copier._unsupported, 'reflink', e)
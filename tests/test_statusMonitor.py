@@ -0,0 +1,135 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+from unittest import TestCase
+from novaimagebuilder.StatusMonitor import StatusMonitor
+from novaimagebuilder.Waiter import WaitTimeout
+
+
+class MockResource(object):
+    def __init__(self, resource_id, status):
+        self.id = resource_id
+        self.status = status
+
+
+class MockImages(object):
+    """
+    Glance images, of which list() only shows the active ones
+    """
+
+    def __init__(self):
+        self.images = { }
+        self.calls = [ ]
+
+    def get(self, image_id):
+        self.calls.append(('get', image_id))
+        if image_id not in self.images:
+            raise Exception("No image (%s)" % image_id)
+        return MockResource(image_id, self.images[image_id])
+
+    def list(self, page_size=None):
+        self.calls.append(('list', page_size))
+        return [ MockResource(image_id, status) for (image_id, status) in sorted(self.images.items())
+                 if status == 'active' ]
+
+
+class MockGlance(object):
+    def __init__(self):
+        self.images = MockImages()
+
+
+class MockEnvironment(object):
+    def __init__(self):
+        self.glance = MockGlance()
+
+    def call_authenticated(self, operation, retry=True):
+        return operation()
+
+
+class TestStatusMonitor(TestCase):
+    def setUp(self):
+        self.env = MockEnvironment()
+        self.images = self.env.glance.images
+        self.monitor = StatusMonitor(self.env)
+        self.monitor.LIST_THRESHOLD = 3
+        self.monitor.IMAGE_PAGE_SIZE = 10
+
+    def _watch(self, image_ids):
+        changes = [ ]
+
+        def _changed(kind, resource_id):
+            changes.append(resource_id)
+        # Keep the refresh thread out of the way
+        self.monitor._start = lambda: None
+        for image_id in image_ids:
+            self.monitor.watch(StatusMonitor.IMAGE, image_id, _changed)
+        del self.images.calls[:]
+        del changes[:]
+        return changes
+
+    def test_refresh_few_fetches_each(self):
+        self.images.images = {'a': 'saving', 'b': 'active'}
+        changes = self._watch(['a', 'b'])
+        self.images.images['a'] = 'active'
+        self.monitor._refresh(StatusMonitor.IMAGE, set(['a', 'b']))
+        self.assertEqual(sorted(self.images.calls), [('get', 'a'), ('get', 'b')])
+        self.assertEqual(changes, ['a'])
+        self.assertEqual(self.monitor.current(StatusMonitor.IMAGE, 'a').status, 'active')
+
+    def test_refresh_many_lists(self):
+        self.images.images = dict([ (str(i), 'active') for i in range(5) ])
+        self.images.images['saving'] = 'saving'
+        watched = set(['0', '1', '2', '3', 'saving'])
+        changes = self._watch(watched)
+        self.images.images['0'] = 'killed'
+        self.monitor._refresh(StatusMonitor.IMAGE, watched)
+        # One page, plus the image the listing leaves out
+        self.assertEqual(sorted(self.images.calls), [('get', '0'), ('get', 'saving'), ('list', 10)])
+        self.assertEqual(changes, ['0'])
+        self.assertEqual(self.monitor._list_costs[StatusMonitor.IMAGE], 3)
+
+    def test_refresh_large_catalog_fetches_each(self):
+        # Many pages of unrelated images
+        self.images.images = dict([ ('other%d' % i, 'active') for i in range(45) ])
+        self.images.images.update({'a': 'saving', 'b': 'saving', 'c': 'saving', 'd': 'active'})
+        watched = set(['a', 'b', 'c', 'd'])
+        self._watch(watched)
+        self.monitor._refresh(StatusMonitor.IMAGE, watched)
+        # Five pages, plus the three images the listing leaves out
+        self.assertEqual(sorted(self.images.calls), [('get', 'a'), ('get', 'b'), ('get', 'c'), ('list', 10)])
+        self.assertEqual(self.monitor._list_costs[StatusMonitor.IMAGE], 8)
+        # The listing took more calls than fetching the images would have - do not list again
+        del self.images.calls[:]
+        self.monitor._refresh(StatusMonitor.IMAGE, watched)
+        self.assertEqual(sorted(self.images.calls), [('get', 'a'), ('get', 'b'), ('get', 'c'), ('get', 'd')])
+
+    def test_refresh_missing_resource(self):
+        self.images.images = {'a': 'saving'}
+        self._watch(['a'])
+        del self.images.images['a']
+        self.monitor._refresh(StatusMonitor.IMAGE, set(['a']))
+        self.assertRaises(Exception, self.monitor.current, StatusMonitor.IMAGE, 'a')
+
+    def test_wait(self):
+        self.monitor.INTERVAL = 0.05
+        self.images.images = {'a': 'saving'}
+        threading.Timer(0.2, self.images.images.__setitem__, ('a', 'active')).start()
+        status = self.monitor.wait(StatusMonitor.IMAGE, 'a', lambda image: image.status == 'active' or None,
+                                   'image (a) to become active', 10)
+        self.assertTrue(status)
+        self.assertRaises(WaitTimeout, self.monitor.wait, StatusMonitor.IMAGE, 'a', lambda image: None,
+                          'image (a) to go away', 0.2)
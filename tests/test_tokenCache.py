@@ -0,0 +1,51 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import time
+from unittest import TestCase
+from novaimagebuilder.TokenCache import TokenCache
+
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = self.tmp_dir + '/tokens/tokens.json'
+        self.cache = TokenCache(self.filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store_and_get(self):
+        self.assertIsNone(self.cache.get('http://keystone', 'user', 'tenant'))
+        auth_ref = {'token': {'id': 'secret'}}
+        self.cache.store('http://keystone', 'user', 'tenant', auth_ref, time.time() + TokenCache.MARGIN * 2)
+        self.assertEqual(TokenCache(self.filename).get('http://keystone', 'user', 'tenant'), auth_ref)
+        self.assertIsNone(self.cache.get('http://keystone', 'user', 'other'))
+        self.assertEqual(stat.S_IMODE(os.stat(self.filename).st_mode), 0600)
+        self.assertEqual(stat.S_IMODE(os.stat(os.path.dirname(self.filename)).st_mode), 0700)
+        self.cache.remove('http://keystone', 'user', 'tenant')
+        self.assertIsNone(self.cache.get('http://keystone', 'user', 'tenant'))
+
+    def test_get_expiring(self):
+        self.cache.store('http://keystone', 'user', 'tenant', {'token': {}}, time.time() + TokenCache.MARGIN / 2)
+        self.assertIsNone(self.cache.get('http://keystone', 'user', 'tenant'))
+        # A token with most of keystone's default hour left is used again
+        self.cache.store('http://keystone', 'user', 'tenant', {'token': {}}, time.time() + 3500)
+        self.assertEqual(self.cache.get('http://keystone', 'user', 'tenant'), {'token': {}})
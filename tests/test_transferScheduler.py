@@ -0,0 +1,130 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+from unittest import TestCase
+from novaimagebuilder.TransferScheduler import TransferScheduler
+
+
+class TestTransferScheduler(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        TransferScheduler._instance = None
+        TransferScheduler.CACHE_ROOT = self.tmp_dir + '/'
+        self.scheduler = TransferScheduler()
+        self.scheduler.SLOTS = {TransferScheduler.DOWNLOAD: 2, TransferScheduler.UPLOAD: 2}
+        self.scheduler.RESERVED_SLOTS = {TransferScheduler.DOWNLOAD: 1, TransferScheduler.UPLOAD: 1}
+        self.scheduler.RATES = {TransferScheduler.DOWNLOAD: None, TransferScheduler.UPLOAD: None}
+        self.scheduler.HOST_RATES = { }
+        self.scheduler.POLL_INTERVAL = 0.05
+
+    def tearDown(self):
+        TransferScheduler._instance = None
+        TransferScheduler.CACHE_ROOT = None
+        shutil.rmtree(self.tmp_dir)
+
+    def _acquire_in_thread(self, direction, priority):
+        acquired = [ ]
+
+        def _acquire():
+            acquired.append(self.scheduler.acquire(direction, priority))
+        thread = threading.Thread(target=_acquire)
+        thread.daemon = True
+        thread.start()
+        return (thread, acquired)
+
+    def test_state_dir(self):
+        self.assertTrue(os.path.isdir(self.tmp_dir + '/' + TransferScheduler.STATE_DIR))
+
+    def test_acquire_waits_for_slot(self):
+        first = self.scheduler.acquire(TransferScheduler.DOWNLOAD)
+        second = self.scheduler.acquire(TransferScheduler.DOWNLOAD)
+        (thread, acquired) = self._acquire_in_thread(TransferScheduler.DOWNLOAD, TransferScheduler.HIGH)
+        thread.join(0.5)
+        self.assertEqual(acquired, [ ])
+        # Uploads have slots of their own
+        self.scheduler.acquire(TransferScheduler.UPLOAD).release()
+        first.release()
+        thread.join(10)
+        self.assertEqual(len(acquired), 1)
+        second.release()
+        acquired[0].release()
+
+    def test_acquire_low_priority(self):
+        high = self.scheduler.acquire(TransferScheduler.DOWNLOAD, TransferScheduler.HIGH)
+        # The only slot left is reserved
+        (thread, acquired) = self._acquire_in_thread(TransferScheduler.DOWNLOAD, TransferScheduler.LOW)
+        thread.join(0.5)
+        self.assertEqual(acquired, [ ])
+        high.release()
+        thread.join(10)
+        self.assertEqual(len(acquired), 1)
+        # A HIGH priority transfer still gets the reserved slot
+        self.scheduler.acquire(TransferScheduler.DOWNLOAD, TransferScheduler.HIGH).release()
+        acquired[0].release()
+        self.assertRaises(Exception, self.scheduler.acquire, 'sideways')
+
+    def test_settle(self):
+        self.assertEqual(self.scheduler._settle(TransferScheduler.DOWNLOAD, 10 ** 9), 0)
+        self.scheduler.RATES[TransferScheduler.DOWNLOAD] = 1000
+        # The bucket starts with one second worth - twice that is a second in debt
+        self.assertAlmostEqual(self.scheduler._settle(TransferScheduler.DOWNLOAD, 2000), 1, places=1)
+        # The debt is shared by every transfer in the direction, but not with the other one
+        self.assertGreater(self.scheduler._settle(TransferScheduler.DOWNLOAD, 1000), 1.5)
+        self.assertEqual(self.scheduler._settle(TransferScheduler.UPLOAD, 10 ** 9), 0)
+
+    def test_settle_host(self):
+        host_rates = {'mirror.example.com': 1000, '*': 10 ** 9}
+        self.scheduler.HOST_RATES = host_rates
+        self.assertAlmostEqual(self.scheduler._settle(TransferScheduler.DOWNLOAD, 2000, 'mirror.example.com'), 1,
+                               places=1)
+        # The debt is kept in the state directory, so another process inherits it
+        TransferScheduler._instance = None
+        other = TransferScheduler()
+        other.HOST_RATES = host_rates
+        self.assertGreater(other._settle(TransferScheduler.DOWNLOAD, 1000, 'mirror.example.com'), 1.5)
+        # Every other host has a bucket of its own
+        self.assertEqual(other._settle(TransferScheduler.DOWNLOAD, 2000, 'other.example.com'), 0)
+        transfer = other.acquire(TransferScheduler.DOWNLOAD, url='http://other.example.com/install.iso')
+        self.assertEqual(transfer.host, 'other.example.com')
+        transfer.release()
+        transfer = other.acquire(TransferScheduler.UPLOAD, url='http://mirror.example.com/install.iso')
+        self.assertIsNone(transfer.host)
+        transfer.release()
+
+    def test_transfer_consume(self):
+        self.scheduler.SETTLE_SIZE = 100
+        settled = [ ]
+        real_settle = self.scheduler._settle
+
+        def _settle(direction, amount, host=None):
+            settled.append(amount)
+            return real_settle(direction, amount, host)
+        self.scheduler._settle = _settle
+        transfer = self.scheduler.acquire(TransferScheduler.UPLOAD)
+        transfer.consume(60)
+        self.assertEqual(settled, [ ])
+        wrapped = transfer.wrap(StringIO('x' * 90))
+        self.assertEqual(wrapped.read(), 'x' * 90)
+        self.assertEqual(settled, [150])
+        transfer.consume(10)
+        transfer.release()
+        self.assertEqual(settled, [150, 10])
+        self.assertEqual(transfer.bytes, 160)
@@ -0,0 +1,87 @@
+# coding=utf-8
+
+#   Copyright 2013 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import threading
+import time
+from unittest import TestCase
+from novaimagebuilder.Waiter import Waiter, WaitTimeout
+
+
+class TestWaiter(TestCase):
+    def _check_after(self, checks):
+        calls = [ ]
+
+        def _check():
+            calls.append(time.time())
+            if len(calls) >= checks:
+                return len(calls)
+        return (_check, calls)
+
+    def test_intervals(self):
+        waiter = Waiter('intervals', initial_interval=1, max_interval=4)
+        waiter.JITTER = 0
+        intervals = waiter.intervals()
+        self.assertEqual([ intervals.next() for i in range(6) ], [1, 1.5, 2.25, 3.375, 4, 4])
+        waiter.JITTER = 0.2
+        for interval in [ waiter.intervals().next() for i in range(20) ]:
+            self.assertTrue(0.8 <= interval <= 1.2)
+
+    def test_wait(self):
+        waiter = Waiter('three checks', initial_interval=0.01, max_interval=0.02)
+        (check, calls) = self._check_after(3)
+        self.assertEqual(waiter.wait(check), 3)
+        self.assertEqual(waiter.checks, 3)
+
+    def test_wait_timeout(self):
+        waiter = Waiter('nothing', timeout=0.3, initial_interval=0.05)
+        (check, calls) = self._check_after(1000)
+        start = time.time()
+        self.assertRaises(WaitTimeout, waiter.wait, check)
+        self.assertLess(time.time() - start, 2)
+        self.assertGreater(len(calls), 1)
+
+    def test_wait_check_raises(self):
+        def _check():
+            raise ValueError('broken')
+        self.assertRaises(ValueError, Waiter('failure').wait, _check)
+
+    def test_wake(self):
+        waiter = Waiter('woken', initial_interval=60)
+        (check, calls) = self._check_after(2)
+        threading.Timer(0.2, waiter.wake, ('image', 'id')).start()
+        start = time.time()
+        self.assertEqual(waiter.wait(check), 2)
+        self.assertLess(time.time() - start, 10)
+
+    def test_wait_async(self):
+        done = [ ]
+        waiter = Waiter('async', initial_interval=0.01)
+        (check, calls) = self._check_after(2)
+        result = waiter.wait_async(check, done.append)
+        self.assertEqual(result.get(10), 2)
+        self.assertTrue(result.successful())
+        self.assertEqual(done, [result])
+
+        def _fail():
+            raise ValueError('broken')
+        failed = Waiter('async failure').wait_async(_fail)
+        self.assertRaises(ValueError, failed.get, 10)
+        self.assertTrue(failed.ready())
+        self.assertFalse(failed.successful())
+
+        slow = Waiter('slow', initial_interval=60).wait_async(lambda: None)
+        self.assertRaises(WaitTimeout, slow.get, 0.1)
+        self.assertFalse(slow.ready())